@@ -0,0 +1,107 @@
+"""
+Benchmark: demux cost of the server (threads engine) against the number
+of sessions alive.
+
+The Receiver is filled with idle sessions (and as many blacklisted
+addresses) and every datagram is run through what its loop does for it:
+the demux to the session of its CID and the reaping of the sessions
+that finished, with one of them finishing (and being replaced) every
+CHURN datagrams. The cost is compared with a full scan of the sessions
+after every datagram, which is how the finished ones were found before.
+
+Usage (from the src directory):
+    python3 -m benchmarks.demux [-s SESSIONS ...] [-d DATAGRAMS]
+"""
+from argparse import ArgumentParser
+from time import perf_counter as now
+
+# Lib
+from lib.client_handler import ClientHandler
+from lib.logger import FATAL_LEVEL, logger
+from lib.rdt_interface import Connection, new_cid
+from lib.receiver import Receiver
+from lib.socket_udp import Socket
+import lib.protocol as prt
+
+CHURN = 100  # datagrams for every session that finishes
+PAYLOAD_SIZE = 1024
+# settings of every session (as a client would get them)
+PARAMS = prt.negotiate(prt.decode_session_request(
+    prt.encode_session_request(prt.DOWNLOAD_FILE_OP)))
+
+
+def connect(receiver: Receiver, addr: tuple
+            ) -> 'tuple[ClientHandler, memoryview]':
+    # Idle session (already confirmed) and a datagram of its client
+    cid = new_cid(receiver.owner, receiver.clients)
+    connection = Connection(receiver.skt, addr, cid)
+    handler = receiver.clients[cid] = ClientHandler(
+        connection, PARAMS, None, receiver.finished.append)
+    handler.confirmed = True
+    return handler, memoryview(connection.header + bytes(PAYLOAD_SIZE))
+
+
+def scan(receiver: Receiver) -> None:
+    # What the loop did before: every handler asked whether it finished
+    receiver.clients = {cid: handler
+                        for cid, handler in receiver.clients.items()
+                        if not handler.is_done()}
+
+
+def run(sessions: int, datagrams: int, reap) -> float:
+    """
+    Seconds per datagram of the demux plus the given reaping, with the
+    given number of sessions alive.
+    """
+    skt = Socket()
+    skt.bind('127.0.0.1', 0)
+    receiver = Receiver(skt, sessions=1)
+    # the loop is stopped, its steps are run here instead
+    receiver.stop(True)
+
+    live = [connect(receiver, ('127.0.0.2', port))
+            for port in range(sessions)]
+    for port in range(sessions):
+        receiver.tmp_blacklist.add(('127.0.0.3', port))
+    next_port = sessions
+
+    start = now()
+    for i in range(datagrams):
+        handler, datagram = live[i % sessions]
+        receiver._demux(handler.addr, [datagram], None)
+        handler.queue.clear()
+        if (i + 1) % CHURN == 0:
+            # its session ends (with nothing left to run)
+            handler._run(iter(()))
+        reap(receiver)
+        if handler.is_done():
+            # and a new client takes its place
+            live[i % sessions] = connect(receiver, ('127.0.0.2', next_port))
+            next_port += 1
+    elapsed = now() - start
+
+    receiver.sessions.stop()
+    return elapsed / datagrams
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("-s", "--sessions", type=int, nargs='+',
+                        default=[10, 100, 1000, 10000],
+                        help="sessions alive (one run for each)")
+    parser.add_argument("-d", "--datagrams", type=int, default=20000,
+                        help="datagrams of every run")
+    args = parser.parse_args()
+    logger.setLevel(FATAL_LEVEL)
+
+    print(f"{'sessions':>9} {'notified':>12} {'full scan':>12}")
+    for sessions in args.sessions:
+        notified = run(sessions, args.datagrams, Receiver._reap)
+        # the scan is much slower, fewer datagrams are enough
+        scanned = run(sessions, max(CHURN, args.datagrams // 10), scan)
+        print(f"{sessions:>9} {1e6 * notified:>10.2f}us "
+              f"{1e6 * scanned:>10.2f}us")
+
+
+if __name__ == "__main__":
+    main()
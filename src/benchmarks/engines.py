@@ -0,0 +1,107 @@
+"""
+Benchmark: server engines (a thread per client vs a single event loop).
+
+A server is started with each engine on localhost and many clients (one
+process each) download the same small file at once, a few times in a
+row, so the server has many sessions alive at the same time. The
+elapsed time, the requests served per second and the latency of the
+requests are reported.
+
+Usage (from the src directory):
+    python3 -m benchmarks.engines [-c CLIENTS] [-r REQUESTS] [-s SIZE]
+                                  [-b RCVBUF]
+"""
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from os import chdir, getcwd, urandom
+from statistics import mean, quantiles
+from tempfile import TemporaryDirectory
+from time import perf_counter as now
+
+# Lib
+from lib.event_receiver import EventReceiver
+from lib.logger import FATAL_LEVEL, logger
+from lib.multistream import open_session
+from lib.receiver import Receiver
+from lib.socket_udp import Socket
+import lib.protocol as prt
+
+ENGINES = {
+    'threads': Receiver,
+    'events': EventReceiver,
+}
+FILENAME = 'bench.bin'
+
+
+def client(port: int, requests: int) -> 'list[float]':
+    # Downloads the file `requests` times, returns the latencies
+    latencies = []
+    for _ in range(requests):
+        start = now()
+        skt, rdt = open_session(('127.0.0.1', port), '', None, None,
+                                prt.DOWNLOAD_FILE_OP)
+        filesize, offset, codec = rdt.run(prt.download_request(
+            rdt, FILENAME))
+        rdt.run(prt.recv_file(rdt, filesize, len, offset=offset,
+                              codec=codec))
+        latencies.append(now() - start)
+        skt.close()
+    return latencies
+
+
+def run(engine: str, clients: int, requests: int, rcvbuf: int) -> dict:
+    skt = Socket(rcvbuf)
+    skt.bind('127.0.0.1', 0)
+    port = skt.skt.getsockname()[1]
+    receiver = ENGINES[engine](skt)
+
+    try:
+        start = now()
+        with Pool(clients) as pool:
+            latencies = pool.starmap(client, [(port, requests)] * clients)
+        elapsed = now() - start
+    finally:
+        receiver.stop(True)
+
+    latencies = [latency for run in latencies for latency in run]
+    return {
+        "elapsed": elapsed,
+        "rate": len(latencies) / elapsed,
+        "latency": mean(latencies),
+        "p95": quantiles(latencies, n=20)[-1],
+    }
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("-c", "--clients", type=int, default=64,
+                        help="concurrent clients")
+    parser.add_argument("-r", "--requests", type=int, default=4,
+                        help="downloads per client")
+    parser.add_argument("-s", "--size", type=int, default=2**16,
+                        help="bytes of the file")
+    parser.add_argument("-b", "--rcvbuf", type=int, default=2**22,
+                        help="receive buffer of the server socket (bytes)")
+    args = parser.parse_args()
+    logger.setLevel(FATAL_LEVEL)
+
+    cwd = getcwd()
+    with TemporaryDirectory() as storage:
+        chdir(storage)
+        with open(FILENAME, 'wb') as f:
+            f.write(urandom(args.size))
+
+        print(f"{'engine':>8} {'elapsed':>9} {'requests/s':>11} "
+              f"{'latency':>9} {'p95':>9}")
+        for engine in ENGINES:
+            result = run(engine, args.clients, args.requests,
+                         args.rcvbuf)
+            print(f"{engine:>8} {result['elapsed']:>8.2f}s "
+                  f"{result['rate']:>11.1f} "
+                  f"{1000 * result['latency']:>7.1f}ms "
+                  f"{1000 * result['p95']:>7.1f}ms")
+        chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
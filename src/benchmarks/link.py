@@ -0,0 +1,94 @@
+"""
+Simulated network path used by the benchmarks.
+
+Each direction is a drop-tail bottleneck: datagrams are serialized at
+`rate` bytes/s through a queue of `queue_size` datagrams (the ones that
+arrive to a full queue are dropped) and are delivered `delay` seconds
+after leaving it. Departure times are computed when a datagram is
+offered, so no extra threads are needed to move the datagrams.
+"""
+from collections import deque
+from heapq import heappop, heappush
+from itertools import count
+from random import Random
+from threading import Condition
+from time import perf_counter as now
+
+# Lib
+from lib.socket_udp import SocketTimeout
+
+
+class Link:
+
+    def __init__(self, rate: float, delay: float, queue_size: int,
+                 loss: float = 0, seed: int = 0) -> None:
+        self.rate = rate
+        self.delay = delay
+        self.queue_size = queue_size
+        self.loss = loss
+        self.random = Random(seed)
+        self.departures = deque()
+        self.in_flight = []
+        self.order = count()
+        self.cv = Condition()
+        self.sent = 0
+        self.dropped = 0
+        return
+
+    def send(self, *data) -> int:
+        """
+        Offers a datagram to the link (same contract as SendCallback).
+        """
+        datagram = b''.join(data)
+        with self.cv:
+            self.sent += 1
+            current = now()
+            while self.departures and self.departures[0] <= current:
+                self.departures.popleft()
+
+            if len(self.departures) >= self.queue_size or\
+                    self.random.random() < self.loss:
+                self.dropped += 1
+                return len(datagram)
+
+            start = self.departures[-1] if self.departures else current
+            departure = max(start, current) + len(datagram) / self.rate
+            self.departures.append(departure)
+            heappush(self.in_flight,
+                     (departure + self.delay, next(self.order), datagram))
+            self.cv.notify()
+        return len(datagram)
+
+    def recv(self, timeout: float = None, start_time: float = 0) -> bytes:
+        """
+        Receives the next delivered datagram (same contract as
+        RecvCallback).
+        """
+        with self.cv:
+            while True:
+                current = now()
+                if self.in_flight and self.in_flight[0][0] <= current:
+                    return heappop(self.in_flight)[2]
+
+                wait_time = None
+                if self.in_flight:
+                    wait_time = self.in_flight[0][0] - current
+                if timeout is not None:
+                    remaining = timeout - (current - start_time)
+                    if remaining <= 0:
+                        raise SocketTimeout()
+                    if wait_time is None or remaining < wait_time:
+                        wait_time = remaining
+                self.cv.wait(wait_time)
+
+
+class Path:
+    """
+    Both directions of a simulated path.
+    """
+
+    def __init__(self, rate: float, delay: float, queue_size: int,
+                 loss: float = 0) -> None:
+        self.forward = Link(rate, delay, queue_size, loss, 1)
+        self.backward = Link(rate, delay, queue_size, loss, 2)
+        return
@@ -0,0 +1,89 @@
+"""
+Benchmark: loss and retransmission rate with and without pacing.
+
+A file is sent through a simulated bottleneck (see benchmarks/link.py)
+with every combination of congestion controller and pacing mode, and the
+datagrams dropped by the bottleneck queue and the re-transmitted ones
+are reported.
+
+Usage (from the src directory):
+    python3 -m benchmarks.pacing [-s SIZE] [-r RATE] [-d DELAY] [-b QUEUE]
+"""
+from argparse import ArgumentParser
+from math import ceil
+from threading import Thread
+from time import perf_counter as now
+
+# Lib
+from benchmarks.link import Path
+from lib.congestion import create_congestion_controller
+from lib.datagram_size import DatagramSizer
+from lib.go_back_n_v2 import GoBackNV2
+from lib.misc import get_size_readable
+from lib.pacing import create_pacer
+from lib.protocol import CHUNK_SIZE
+
+
+# fixed, so every run sends the same datagrams
+DATAGRAM_SIZE = 2**14
+
+
+def transfer(path: Path, size: int, window: int, cc: str, pacing: str):
+    sender = GoBackNV2(path.forward.send, path.backward.recv, window,
+                       cc=create_congestion_controller(cc, window),
+                       pacer=create_pacer(pacing),
+                       sizer=DatagramSizer(DATAGRAM_SIZE, DATAGRAM_SIZE))
+    receiver = GoBackNV2(path.backward.send, path.forward.recv, window)
+
+    chunks = [bytes(min(CHUNK_SIZE, size - i))
+              for i in range(0, size, CHUNK_SIZE)]
+
+    def recv_all():
+        for chunk in chunks:
+            receiver.recv(len(chunk))
+
+    th = Thread(target=recv_all)
+    th.start()
+    start = now()
+    sender.send_stream(chunks)
+    th.join()
+    elapsed = now() - start
+
+    payload = DATAGRAM_SIZE - sender.header_size
+    needed = sum(ceil(len(chunk) / payload) for chunk in chunks)
+    sent = path.forward.sent
+    return {
+        "goodput": size / elapsed,
+        "loss": path.forward.dropped / sent,
+        "retransmissions": (sent - needed) / needed
+    }
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("-s", "--size", type=int, default=2**23,
+                        help="bytes to transfer")
+    parser.add_argument("-r", "--rate", type=float, default=10e6,
+                        help="bottleneck rate (bytes/s)")
+    parser.add_argument("-d", "--delay", type=float, default=0.02,
+                        help="one way delay (s)")
+    parser.add_argument("-b", "--queue", type=int, default=16,
+                        help="bottleneck queue size (datagrams)")
+    parser.add_argument("-w", "--window", type=int, default=64,
+                        help="RDT window size (datagrams)")
+    args = parser.parse_args()
+
+    print(f"{'cc':>6} {'pacing':>7} {'goodput':>12} {'loss':>8} "
+          f"{'retransmissions':>16}")
+    for cc in ('none', 'aimd', 'cubic'):
+        for pacing in ('', 'rtt'):
+            path = Path(args.rate, args.delay, args.queue)
+            result = transfer(path, args.size, args.window, cc, pacing)
+            goodput = get_size_readable(result['goodput'])
+            print(f"{cc:>6} {pacing or 'off':>7} {goodput + '/s':>12} "
+                  f"{100 * result['loss']:>7.2f}% "
+                  f"{100 * result['retransmissions']:>15.2f}%")
+
+
+if __name__ == "__main__":
+    main()
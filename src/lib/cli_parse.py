@@ -9,6 +9,7 @@ except ImportError:
 # Lib
 from lib.logger import DEBUG_LEVEL, INFO_LEVEL, FATAL_LEVEL
 from lib.constants import DEFAULT_ADDR, DEFAULT_PORT
+from lib.rdt_selection import PACING
 
 
 def _parse_args(add_args=None):
@@ -28,6 +29,15 @@ def _parse_args(add_args=None):
                         default=DEFAULT_ADDR, help="service IP address")
     parser.add_argument("-p", "--port", dest="PORT", type=int,
                         default=DEFAULT_PORT, help="service port")
+    parser.add_argument("--rcvbuf", dest="RCVBUF", type=int,
+                        default=None, help="socket receive buffer size in "
+                        "bytes (SO_RCVBUF, default: the system one)")
+    parser.add_argument("--sndbuf", dest="SNDBUF", type=int,
+                        default=None, help="socket send buffer size in "
+                        "bytes (SO_SNDBUF, default: the system one)")
+    parser.add_argument("--no-compression", dest="COMPRESSION",
+                        action="store_false", default=True,
+                        help="do not accept nor send compressed data")
 
     if add_args is not None:
         add_args(parser)
@@ -39,10 +49,27 @@ def _add_name_arg(parser):
                         required=True, help="file name")
 
 
+def _add_pacing_arg(parser):
+    parser.add_argument("-P", "--pacing", dest="PACING", type=str,
+                        default=PACING, help="pace the transfer at a fixed "
+                        "rate (bytes/s) or at cwnd/RTT ('rtt')")
+
+
+def _add_streams_arg(parser):
+    parser.add_argument("-S", "--streams", dest="STREAMS", type=int,
+                        default=1, help="transfer the file in this many "
+                        "byte ranges, each one over its own session")
+
+
 def _args_upload(parser):
     parser.add_argument("-s", "--src", dest="FILEPATH", type=str,
                         required=True, help="source file path")
     _add_name_arg(parser)
+    _add_pacing_arg(parser)
+    _add_streams_arg(parser)
+    parser.add_argument("-D", "--delta", dest="DELTA", action="store_true",
+                        default=False, help="only send the differences "
+                        "with the file the server already has")
 
 
 def parse_args_upload():
@@ -53,6 +80,8 @@ def _args_download(parser):
     parser.add_argument("-d", "--dst",  dest="FILEPATH", type=str,
                         required=True, help="destination file path")
     _add_name_arg(parser)
+    _add_pacing_arg(parser)
+    _add_streams_arg(parser)
 
 
 def parse_args_download():
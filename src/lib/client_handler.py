@@ -1,86 +1,216 @@
 from collections import deque
-from os import listdir, path
-from threading import Condition, Thread
+from os import listdir, path, remove, replace
+from threading import Condition, Event, Lock, Semaphore, Thread
 from itertools import count as it_count
 from time import perf_counter as now
-from typing import Optional
+from typing import Callable, Optional
 
 # Lib
+from lib.compression import supported_codecs
 from lib.logger import logger
 from lib.misc import filesize
 from lib.stats import stats
 from lib.misc import get_size_readable, get_time_readable
-from lib.rdt_selection import create_rdt
+from lib.rdt_interface import Connection, Steps
+from lib.rdt_selection import PACING, WINDOW_SIZE, create_rdt
 import lib.protocol as prt
 
 # Exceptions
-from lib.socket_udp import SocketTimeout
+from lib.socket_udp import BufferPool, Socket, SocketTimeout
+
+
+# datagrams a ClientHandler may have queued (the ones that arrive while
+# it is full are dropped, and re-transmitted by the client)
+MAX_QUEUE_SIZE = max(64, 2 * WINDOW_SIZE)
+# secs the late ranges of an upload in ranges that failed are refused
+FAILED_UPLOAD_TTL = 60
 
 
 class ServerStopped(Exception):
     pass
 
 
-class ClientHandler:
+def _covers(ranges: 'set[tuple[int, int]]', size: int) -> bool:
+    # Whether the ranges (start, length) cover all the bytes of a file
+    end = 0
+    for start, length in sorted(ranges):
+        if start > end:
+            return False
+        end = max(end, start + length)
+    return end >= size
+
+
+def _expire_failed_uploads() -> None:
+    # (called with Session.range_lock held) they are kept the same time,
+    # so the expired ones are the first ones
+    limit = now() - FAILED_UPLOAD_TTL
+    for key, time in list(Session.failed_uploads.items()):
+        if time >= limit:
+            break
+        del Session.failed_uploads[key]
+
+
+def session_params(skt: Socket, addr: tuple,
+                   hello: bytearray) -> Optional[dict]:
+    """
+    Settings of the session a new client opens with its HELLO (see
+    lib.protocol.negotiate). None if no session is opened: the datagram
+    is not a HELLO, or the client is told the server does not support
+    what it offers.
+    """
+    offer = prt.decode_session_request(hello)
+    if offer is None:
+        return None
+    params = prt.negotiate(offer)
+    if params is None:
+        logger.info(f'Client {addr[0]}:{addr[1]} refused, its session is '
+                    'not supported.')
+        Connection(skt, addr)(prt.encode_session_response(None))
+    return params
+
+
+class Session:
+    """
+    Handles the request of a client over its own RDT.
+
+    The handlers are RDT operations (see lib.rdt_interface.Steps), so a
+    session can run on a thread of its own, blocking on its RDT (see
+    ClientHandler), or be driven by the events of a server loop (see
+    lib.event_receiver).
+
+    Its datagrams are sent through its Connection, and the server gives
+    it the ones with its CID (from any address, see migrate). Until the
+    client sends one of them (confirmed), the server answers the HELLOs
+    from its address with the settings of the session (see greet).
+    """
 
     id_it = it_count()
-
-    def __init__(self, send, addr):
-        self.id = next(ClientHandler.id_it)
-        self.addr = addr
-        self.queue_cv = Condition()
-        self.queue = deque()
-        self.rdt = create_rdt(send, self.pop)
+    # (filename, transfer id) -> ranges (start, length) received of an
+    # upload in ranges
+    range_uploads = {}
+    # (filename, transfer id) -> time an upload in ranges failed (in the
+    # order they failed, see _expire_failed_uploads)
+    failed_uploads = {}
+    range_lock = Lock()
+
+    def __init__(self, connection: Connection, recv, params: dict,
+                 pacing=PACING, recv_window=None):
+        self.id = next(Session.id_it)
+        self.name = f'{self.__class__.__name__}:{self.id}'
+        self.connection = connection
+        self.addr = connection.addr
+        self.cid = connection.cid
+        self.confirmed = False
+        self.rdt = create_rdt(connection, recv, params, pacing, recv_window)
+        self.hello_reply = prt.encode_session_response(params)
         self.running = True
-        self.th = Thread(target=self._run, name=f'ClientHandler:{self.id}')
-        self.th.start()
+        logger.debug(f"[{self.name}] Negotiated: {params}.")
 
-    def _handle_download_file(self, args: dict) -> None:
+    def _handle_download_file(self, args: dict) -> Steps:
         stats["requests"]["download-file"] += 1
         filename = args['filename']
 
         try:
-            size = filesize(filename)
-            prt.download_response(self.rdt, filesize(filename))
+            f = open(filename, 'rb')
         except FileNotFoundError:
             logger.info(f'Client {self.addr[0]}:{self.addr[1]} requested '
                         'an unavailable file.')
-            prt.send_file_not_found(self.rdt)
+            yield from prt.send_file_not_found(self.rdt)
             return
 
-        logger.info(
-            f'File "{filename}" being downloaded from '
-            f'{self.addr[0]}:{self.addr[1]}...')
+        with f:
+            # the client may already have the first bytes of the file
+            offset = prt.resume_offset(f, args['offset'], args['checksum'])
+            codec = prt.file_codec(f, offset, args['codecs'])
+            size = filesize(filename)
+            yield from prt.download_response(self.rdt, size, offset, codec)
 
-        start = now()
+            logger.info(
+                f'File "{filename}" being downloaded from '
+                f'{self.addr[0]}:{self.addr[1]}' +
+                (f' (resumed from byte {offset})' if offset else '') +
+                (' (compressed)' if codec else '') + '...')
 
-        with open(filename, 'rb') as f:
-            prt.send_file(self.rdt, f)
+            start = now()
+            yield from prt.send_file(self.rdt, f, offset=offset,
+                                     codec=codec)
 
         stats["files"]["downloads"] += 1
         elapsed = now() - start
+        size -= offset
         stats["transfer-speeds"].append(size/elapsed)
         logger.info(
             f'File "{filename}" downloaded from {self.addr[0]}:{self.addr[1]}'
             f' (elapsed: {get_time_readable(elapsed)}, avg transf speed: '
             f'{get_size_readable(size/elapsed)}/s).')
 
-    def _handle_upload_file(self, args) -> None:
+    def _handle_upload_file(self, args) -> Steps:
         stats["requests"]["upload-file"] += 1
-        prt.upload_response(self.rdt)
-        start = now()
-
         filename: str = args['filename']
         filesize: int = args['filesize']
 
+        # The file is written next to the old one until it is complete,
+        # so an interrupted upload can be resumed (the client checks
+        # that the bytes we kept are the ones of its file)
+        partial = filename + prt.PARTIAL_SUFFIX
+        yield from prt.upload_response(
+            self.rdt, *prt.partial_prefix(partial, filesize),
+            supported_codecs())
+        start = now()
+        offset, codec = yield from prt.recv_file_header(self.rdt)
+
         logger.info(
             f'Uploading file "{filename}" from '
-            f'{self.addr[0]}:{self.addr[1]}...')
+            f'{self.addr[0]}:{self.addr[1]}' +
+            (f' (resumed from byte {offset})' if offset else '') +
+            (' (compressed)' if codec else '') + '...')
+
+        with open(partial, 'ab') as f:
+            f.truncate(offset)
+            yield from prt.recv_file(self.rdt, filesize, f.write,
+                                     offset=offset, codec=codec)
+
+        replace(partial, filename)
+        filesize -= offset
+        time_elapsed = (now() - start)
+        stats["transfer-speeds"].append(filesize/time_elapsed)
+        logger.info(
+            f'File "{filename}" uploaded from {self.addr[0]}:{self.addr[1]} '
+            f'(elapsed: {get_time_readable(time_elapsed)}, avg transf speed: '
+            f'{get_size_readable(filesize/time_elapsed)}/s).')
+        stats["files"]["uploads"] += 1
+
+    def _handle_delta_upload(self, args) -> Steps:
+        stats["requests"]["upload-file"] += 1
+        filename: str = args['filename']
+        filesize: int = args['filesize']
 
-        with open(filename, 'wb') as f:
-            for file_chunk in prt.recv_file(self.rdt, filesize):
-                f.write(file_chunk)
+        # The client only sends what our file does not have (the blocks
+        # it has are copied from it), the new one is written next to it
+        # (in a partial file of its own, a delta upload is not resumed)
+        partial = prt.unique_partial(filename)
+        old = open(filename, 'rb') if path.isfile(filename) else None
+        try:
+            block_size = yield from prt.delta_upload_response(self.rdt,
+                                                              old)
+            start = now()
+
+            logger.info(
+                f'Uploading file "{filename}" from '
+                f'{self.addr[0]}:{self.addr[1]} (delta)...')
 
+            with open(partial, 'wb') as f:
+                yield from prt.recv_delta(self.rdt, old, filesize,
+                                          block_size, f.write)
+        except BaseException:
+            if path.isfile(partial):
+                remove(partial)
+            raise
+        finally:
+            if old is not None:
+                old.close()
+
+        replace(partial, filename)
         time_elapsed = (now() - start)
         stats["transfer-speeds"].append(filesize/time_elapsed)
         logger.info(
@@ -89,77 +219,298 @@ class ClientHandler:
             f'{get_size_readable(filesize/time_elapsed)}/s).')
         stats["files"]["uploads"] += 1
 
-    def _handle_list_files(self, args: dict) -> None:
+    def _handle_download_range(self, args: dict) -> Steps:
+        stats["requests"]["download-file"] += 1
+        filename = args['filename']
+        start = args['start']
+
+        try:
+            f = open(filename, 'rb')
+        except FileNotFoundError:
+            logger.info(f'Client {self.addr[0]}:{self.addr[1]} requested '
+                        'an unavailable file.')
+            yield from prt.send_file_not_found(self.rdt,
+                                               prt.RANGE_RESPONSE_SIZE)
+            return
+
+        with f:
+            size = filesize(filename)
+            # (a range of size 0 only asks for the size of the file)
+            length = max(0, min(args['length'], size - start))
+            yield from prt.range_response(self.rdt, size, length)
+            if not length:
+                return
+
+            logger.info(
+                f'Bytes {start}-{start + length} of "{filename}" being '
+                f'downloaded from {self.addr[0]}:{self.addr[1]}...')
+
+            start_time = now()
+            yield from prt.send_file(self.rdt, f, offset=start,
+                                     end=start + length)
+
+        elapsed = now() - start_time
+        stats["transfer-speeds"].append(length/elapsed)
+        logger.info(
+            f'Bytes {start}-{start + length} of "{filename}" downloaded from '
+            f'{self.addr[0]}:{self.addr[1]} (elapsed: '
+            f'{get_time_readable(elapsed)}, avg transf speed: '
+            f'{get_size_readable(length/elapsed)}/s).')
+
+    def _handle_upload_range(self, args: dict) -> Steps:
+        stats["requests"]["upload-file"] += 1
+        filename: str = args['filename']
+        filesize: int = args['filesize']
+        start: int = args['start']
+        length: int = max(0, min(args['length'], filesize - start))
+
+        # Every range is written in place in the partial file (created by
+        # the first one of the transfer), the last one to finish puts
+        # the file in its place. If one of them fails the transfer is
+        # dropped (the client has to upload the file again), and its
+        # ranges that arrive later are refused
+        key = (filename, args['transfer_id'])
+        partial = prt.unique_partial(*key)
+        with Session.range_lock:
+            _expire_failed_uploads()
+            failed = key in Session.failed_uploads
+            if not failed and key not in Session.range_uploads:
+                Session.range_uploads[key] = set()
+                with open(partial, 'wb') as f:
+                    f.truncate(filesize)
+        if failed:
+            logger.info(
+                f'Bytes {start}-{start + length} of "{filename}" refused '
+                f'to {self.addr[0]}:{self.addr[1]} (the upload failed).')
+            yield from prt.send_transfer_failed(self.rdt)
+            return
+        try:
+            yield from prt.range_response(self.rdt, filesize, length)
+            start_time = now()
+
+            logger.info(
+                f'Uploading bytes {start}-{start + length} of "{filename}" '
+                f'from {self.addr[0]}:{self.addr[1]}...')
+
+            with open(partial, 'r+b') as f:
+                f.seek(start)
+                yield from prt.recv_file(self.rdt, start + length, f.write,
+                                         offset=start)
+        except BaseException:
+            with Session.range_lock:
+                if Session.range_uploads.pop(key, None) is not None:
+                    Session.failed_uploads[key] = now()
+                    if path.isfile(partial):
+                        remove(partial)
+            raise
+
+        with Session.range_lock:
+            # (None if another range of the transfer failed meanwhile)
+            ranges = Session.range_uploads.get(key)
+            completed = False
+            if ranges is not None:
+                ranges.add((start, length))
+                # (stored again: in a Manager dict it is a copy)
+                Session.range_uploads[key] = ranges
+                completed = _covers(ranges, filesize)
+                if completed:
+                    del Session.range_uploads[key]
+                    replace(partial, filename)
+
+        time_elapsed = (now() - start_time)
+        stats["transfer-speeds"].append(length/time_elapsed)
+        logger.info(
+            f'Bytes {start}-{start + length} of "{filename}" uploaded from '
+            f'{self.addr[0]}:{self.addr[1]} (elapsed: '
+            f'{get_time_readable(time_elapsed)}, avg transf speed: '
+            f'{get_size_readable(length/time_elapsed)}/s).')
+        if completed:
+            logger.info(f'File "{filename}" uploaded (all the ranges).')
+            stats["files"]["uploads"] += 1
+
+    def _handle_list_files(self, args: dict) -> Steps:
         stats["requests"]["list-files"] += 1
 
         files_list = []
         for file in listdir():
-            if path.isdir(file):
-                # skipping subdirectories
+            if path.isdir(file) or prt.is_partial(file):
+                # skipping subdirectories and uploads not completed
                 continue
             files_list.append((file, path.getsize(file), path.getmtime(file)))
 
-        prt.send_list(self.rdt, files_list)
+        yield from prt.send_list(self.rdt, files_list, args['codecs'])
 
         logger.info(
             f"Files list sent to {self.addr[0]}:{self.addr[1]}.")
 
-    def _run(self):
-        try:
-            logger.debug(f"[ClientHandler:{self.id}] Started.")
+    def _handle(self) -> Steps:
+        logger.debug(f"[{self.name}] Started.")
 
-            opcode, args = prt.recv_request(self.rdt)
+        opcode, args = yield from prt.recv_request(self.rdt)
 
-            if opcode == prt.DOWNLOAD_FILE_OP:
-                logger.debug(
-                    f"[ClientHandler:{self.id}] Handling "
-                    "download-file request.")
-                self._handle_download_file(args)
+        if opcode == prt.DOWNLOAD_FILE_OP:
+            logger.debug(f"[{self.name}] Handling download-file request.")
+            yield from self._handle_download_file(args)
 
-            elif opcode == prt.UPLOAD_FILE_OP:
-                logger.debug(
-                    f"[ClientHandler:{self.id}] Handling upload-file request.")
-                self._handle_upload_file(args)
+        elif opcode == prt.UPLOAD_FILE_OP:
+            logger.debug(f"[{self.name}] Handling upload-file request.")
+            yield from self._handle_upload_file(args)
 
-            elif opcode == prt.LIST_FILES_OP:
-                logger.debug(
-                    f"[ClientHandler:{self.id}] Handling list-files request.")
-                self._handle_list_files(args)
+        elif opcode == prt.DELTA_UPLOAD_OP:
+            logger.debug(
+                f"[{self.name}] Handling delta upload-file request.")
+            yield from self._handle_delta_upload(args)
 
-            else:
-                stats["requests"]["invalid"] += 1
-                prt.send_unknown_error(self.rdt)
+        elif opcode == prt.DOWNLOAD_RANGE_OP:
+            logger.debug(
+                f"[{self.name}] Handling download-file range request.")
+            yield from self._handle_download_range(args)
 
-            logger.debug(f"[ClientHandler:{self.id}] Finished.")
-            self.running = False
-        except KeyboardInterrupt:
-            pass
-        except (ServerStopped, BrokenPipeError):
+        elif opcode == prt.UPLOAD_RANGE_OP:
+            logger.debug(
+                f"[{self.name}] Handling upload-file range request.")
+            yield from self._handle_upload_range(args)
+
+        elif opcode == prt.LIST_FILES_OP:
+            logger.debug(f"[{self.name}] Handling list-files request.")
+            yield from self._handle_list_files(args)
+
+        else:
+            stats["requests"]["invalid"] += 1
+            yield from prt.send_unknown_error(self.rdt)
+
+        if (cc := getattr(self.rdt, 'cc', None)) is not None:
+            stats["cwnd"].append(cc.get_stats())
+
+        logger.debug(f"[{self.name}] Finished.")
+
+    def _refuse(self, retry_after: int) -> Steps:
+        # the server can not take the session now: the client is told
+        # when to try again
+        opcode, _ = yield from prt.recv_request(self.rdt)
+        logger.info(f'Client {self.addr[0]}:{self.addr[1]} refused, the '
+                    f'server is busy (retry after {retry_after} s).')
+        if opcode not in prt.RESPONSE_SIZES:
+            yield from prt.send_unknown_error(self.rdt)
+            return
+        yield from prt.send_busy(self.rdt, opcode, retry_after)
+
+    def _report_error(self, error: BaseException) -> None:
+        # Why the session ended before it was done (called while the
+        # error is being handled)
+        if isinstance(error, (ServerStopped, BrokenPipeError)):
             logger.fatal(
-                f"[ClientHandler:{self.id}] Stopping execution forced. "
+                f"[{self.name}] Stopping execution forced. "
                 "Server was stopped.")
-        except SocketTimeout:
+        elif isinstance(error, SocketTimeout):
             logger.fatal(
-                f"[ClientHandler:{self.id}] Socket "
-                "error: Connection timed-out.")
-        except BaseException:
+                f"[{self.name}] Socket error: Connection timed-out.")
+        elif not isinstance(error, KeyboardInterrupt):
             logger.exception("Unexpected error during execution:")
+
+    def greet(self) -> None:
+        """
+        Answers the HELLO of the client (again, if the reply was lost).
+        """
+        self.connection(self.hello_reply)
+
+    def migrate(self, addr: tuple) -> None:
+        """
+        The client showed up at another address (e.g. a NAT rebinding):
+        the rest of the session is sent there.
+        """
+        logger.info(f'Client {self.addr[0]}:{self.addr[1]} moved to '
+                    f'{addr[0]}:{addr[1]}.')
+        stats["requests"]["migrated"] += 1
+        self.addr = self.connection.addr = addr
+
+    def is_done(self):
+        return not self.running
+
+
+class ClientHandler(Session):
+    """
+    Session running on a thread (of the SessionPool, see run): the
+    datagrams of the client are pushed to its queue by the Receiver, and
+    its RDT blocks popping them.
+
+    The queue is bounded (MAX_QUEUE_SIZE): the newest datagrams are
+    dropped while it is full, and its free room is advertised in the
+    ACKs as the receive window, so the client does not send more than
+    the handler can take (e.g. while it waits for the disk).
+
+    Once the session ends (however it does) on_done is called with the
+    handler, from its thread.
+    """
+
+    def __init__(self, connection: Connection, params: dict,
+                 pool: BufferPool = None,
+                 on_done: Callable[['ClientHandler'], None] = None):
+        self.queue_cv = Condition()
+        self.queue = deque()
+        super().__init__(connection, self.pop, params, recv_window=self.free)
+        # buffer of the last datagram popped, given back on the next pop
+        self.pool = pool
+        self.buffer = None
+        # set once the session was run
+        self.done = Event()
+        self.on_done = on_done
+
+    def _run(self, steps: Steps):
+        try:
+            self.rdt.run(steps)
+            self.running = False
+        except BaseException as e:
+            self._report_error(e)
+        finally:
+            self.done.set()
+            if self.on_done is not None:
+                self.on_done(self)
         return
 
-    def push(self, data):
+    def run(self):
         """
-        Push some data to the queue. Thread-safe function.
+        Handles the request of the client (blocking the thread that
+        calls it until the session ends).
+        """
+        self._run(self._handle())
+
+    def refuse(self, retry_after: int, slots: Semaphore):
+        """
+        Answers the request of the client with a busy status, on a
+        thread of its own (one of the given slots, released at the end).
+        """
+        def run():
+            try:
+                self._run(self._refuse(retry_after))
+            finally:
+                slots.release()
+
+        Thread(target=run, name=self.name).start()
+
+    def push(self, data, buffer: bytearray = None) -> bool:
+        """
+        Push some data to the queue, unless it is full. Thread-safe
+        function.
 
         Parameters:
         data(bytearray): data chunk.
+        [buffer(bytearray)]: pool buffer holding the data.
 
         Returns:
-        None.
+        Whether the data was queued (False if it was dropped).
         """
         with self.queue_cv:
-            self.queue.append(data)
+            if len(self.queue) >= MAX_QUEUE_SIZE:
+                stats['queue-drops'] += 1
+                return False
+            self.queue.append((data, buffer))
             self.queue_cv.notify()
-        return
+        return True
+
+    def free(self) -> int:
+        # datagrams the queue can take now (the receive window)
+        return MAX_QUEUE_SIZE - len(self.queue)
 
     def pop(self, timeout: Optional[int] = None,
             start_time: Optional[int] = 0):
@@ -174,8 +525,13 @@ class ClientHandler:
         [start_time(int)]: init time from the timer.
 
         Returns:
-        data(bytearray): data package from the queue.
+        data(bytearray): data package from the queue (valid until the
+        next pop).
         """
+        if self.buffer is not None:
+            self.pool.put(self.buffer)
+            self.buffer = None
+
         if not self.running:
             raise ServerStopped()
 
@@ -187,14 +543,15 @@ class ClientHandler:
                 if not self.queue_cv.wait(wait_time):
                     raise SocketTimeout()
 
-        return self.queue.popleft()
+            data, buffer = self.queue.popleft()
+
+        if self.pool is not None:
+            self.buffer = buffer
+        return data
 
     def join(self, force=False):
         if force:
             self.running = False
 
-        self.th.join()
-        logger.debug(f"[ClientHandler:{self.id}] Joined.")
-
-    def is_done(self):
-        return not self.running
+        self.done.wait()
+        logger.debug(f"[{self.name}] Joined.")
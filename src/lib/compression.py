@@ -0,0 +1,113 @@
+import zlib
+from queue import Queue
+from threading import Event, Thread
+from typing import Callable, Iterable, Iterator
+
+NO_CODEC = 0
+ZLIB_CODEC = 1
+
+ZLIB_LEVEL = 1  # the fastest one, most of the ratio of logs and CSVs
+SAMPLE_SIZE = 2**16  # bytes compressed to decide if it is worth it
+MAX_SAMPLE_RATIO = 0.9  # compressed / original size of a useful codec
+FRAME_LEN_SIZE = 4
+PIPELINE_DEPTH = 4  # compressed chunks the worker may have ready
+
+
+class Codec:
+    """
+    Compression codec for the file and list transfers.
+
+    Streams are compressed chunk by chunk, and every chunk is flushed
+    so the receiver can decompress it as soon as it arrives (the state
+    is kept across the chunks of a stream).
+    """
+
+    def compressor(self) -> Callable[[bytearray], bytes]:
+        raise NotImplementedError
+
+    def decompressor(self) -> Callable[[bytearray], bytes]:
+        raise NotImplementedError
+
+
+class ZlibCodec(Codec):
+
+    def __init__(self, level: int = ZLIB_LEVEL) -> None:
+        self.level = level
+        return
+
+    def compressor(self) -> Callable[[bytearray], bytes]:
+        compressobj = zlib.compressobj(self.level)
+
+        def compress(chunk: bytearray) -> bytes:
+            return compressobj.compress(chunk) +\
+                compressobj.flush(zlib.Z_SYNC_FLUSH)
+        return compress
+
+    def decompressor(self) -> Callable[[bytearray], bytes]:
+        return zlib.decompressobj().decompress
+
+
+# codec id -> codec, ordered by preference (ids go in a bitmask)
+CODECS = {
+    ZLIB_CODEC: ZlibCodec(),
+}
+
+
+def supported_codecs(enabled: bool = True) -> int:
+    """
+    Bitmask of the codecs we can decompress (advertised to the peer).
+    """
+    if not enabled:
+        return 0
+    mask = 0
+    for codec in CODECS:
+        mask |= 1 << codec
+    return mask
+
+
+def choose_codec(accepted: int, sample: bytearray) -> int:
+    """
+    First codec accepted by the peer (bitmask) that compresses the
+    sample enough, NO_CODEC if none of them does (e.g. the data is
+    already compressed).
+    """
+    for id, codec in CODECS.items():
+        if not accepted & (1 << id) or not sample:
+            continue
+        if len(codec.compressor()(sample)) <= MAX_SAMPLE_RATIO * len(sample):
+            return id
+    return NO_CODEC
+
+
+def compress_chunks(chunks: Iterable, codec: int) -> Iterator[bytes]:
+    """
+    Compresses the chunks in a worker thread (zlib releases the GIL), so
+    the next chunks are being compressed while the RDT sends the last
+    ones. Every compressed chunk is a frame: [LEN, DATA].
+    """
+    compress = CODECS[codec].compressor()
+    frames = Queue(PIPELINE_DEPTH)
+    stopped = Event()
+
+    def work():
+        try:
+            for chunk in chunks:
+                if stopped.is_set():
+                    return
+                data = compress(chunk)
+                frames.put(len(data).to_bytes(FRAME_LEN_SIZE, "big") + data)
+            frames.put(None)
+        except BaseException as e:
+            frames.put(e)
+
+    Thread(target=work, name='Compressor', daemon=True).start()
+    try:
+        while (frame := frames.get()) is not None:
+            if isinstance(frame, BaseException):
+                raise frame
+            yield frame
+    finally:
+        # the worker may be blocked on a full queue
+        stopped.set()
+        while not frames.empty():
+            frames.get_nowait()
@@ -0,0 +1,170 @@
+from time import perf_counter as now
+
+INITIAL_WINDOW = 4  # datagrams
+MIN_SSTHRESH = 2  # datagrams
+
+# CUBIC constants (RFC 8312)
+CUBIC_C = 0.4
+CUBIC_BETA = 0.7
+
+
+class CongestionController:
+    """
+    Congestion controller interface for the windowed RDTs.
+
+    The sender reports the ACK, duplicated ACKs and timeout events, and
+    the controller answers with the congestion window (cwnd, measured in
+    datagrams) that the sender may have in flight. The given max_window
+    is the RDT window size, so it is never exceeded.
+    """
+
+    def __init__(self, max_window: int) -> None:
+        self.max_window = max_window
+        self.cwnd = max_window
+        self.ssthresh = max_window
+        self.start_time = None
+        self.slow_start_exit = None
+        self.max_cwnd = 0
+        self.cwnd_sum = 0
+        self.samples = 0
+        return
+
+    def get_window(self) -> int:
+        return max(1, min(int(self.cwnd), self.max_window))
+
+    def on_ack(self, acked: int) -> None:
+        """
+        Called when `acked` new datagrams were acknowledged.
+        """
+        if self.start_time is None:
+            self.start_time = now()
+        self._increase(acked)
+        self._sample()
+        return
+
+    def on_dup_acks(self) -> None:
+        """
+        Called when a loss was detected by duplicated ACKs.
+        """
+        self._exit_slow_start()
+        self._decrease()
+        return
+
+    def on_timeout(self) -> None:
+        """
+        Called when the retransmission timer expired.
+        """
+        self._exit_slow_start()
+        self._decrease()
+        self.cwnd = 1
+        return
+
+    def get_stats(self) -> dict:
+        return {
+            "final": self.get_window(),
+            "max": self.max_cwnd,
+            "mean": self.cwnd_sum / self.samples if self.samples else 0,
+            "slow-start-exit": self.slow_start_exit
+        }
+
+    def _increase(self, acked: int) -> None:
+        return
+
+    def _decrease(self) -> None:
+        return
+
+    def _exit_slow_start(self) -> None:
+        if self.slow_start_exit is None and self.start_time is not None:
+            self.slow_start_exit = now() - self.start_time
+
+    def _sample(self) -> None:
+        window = self.get_window()
+        self.max_cwnd = max(self.max_cwnd, window)
+        self.cwnd_sum += window
+        self.samples += 1
+
+
+class FixedWindow(CongestionController):
+    """
+    No congestion control: the whole window is always used.
+    """
+
+    def on_timeout(self) -> None:
+        return
+
+
+class AIMD(CongestionController):
+    """
+    Slow start followed by additive increase / multiplicative decrease
+    (TCP Reno like).
+    """
+
+    def __init__(self, max_window: int) -> None:
+        super().__init__(max_window)
+        self.cwnd = min(INITIAL_WINDOW, max_window)
+        return
+
+    def _increase(self, acked: int) -> None:
+        if self.cwnd < self.ssthresh:
+            # slow start: +1 datagram per ACKed datagram
+            self.cwnd = min(self.cwnd + acked, self.max_window)
+            if self.cwnd >= self.ssthresh:
+                self._exit_slow_start()
+            return
+
+        # congestion avoidance: +1 datagram per window
+        self.cwnd = min(self.cwnd + acked / self.cwnd, self.max_window)
+
+    def _decrease(self) -> None:
+        self.ssthresh = max(self.cwnd / 2, MIN_SSTHRESH)
+        self.cwnd = self.ssthresh
+
+
+class Cubic(AIMD):
+    """
+    CUBIC like window growth: after a loss the window grows following a
+    cubic function of the time elapsed since then, centered at the
+    window where the loss happened (w_max).
+    """
+
+    def __init__(self, max_window: int) -> None:
+        super().__init__(max_window)
+        self.w_max = max_window
+        self.epoch = None
+        self.k = 0
+        return
+
+    def _increase(self, acked: int) -> None:
+        if self.cwnd < self.ssthresh:
+            super()._increase(acked)
+            return
+
+        if self.epoch is None:
+            self.epoch = now()
+            self.k = max(0, (self.w_max - self.cwnd) / CUBIC_C) ** (1 / 3)
+
+        t = now() - self.epoch
+        target = CUBIC_C * (t - self.k) ** 3 + self.w_max
+        if target > self.cwnd:
+            self.cwnd += acked * (target - self.cwnd) / self.cwnd
+        else:
+            self.cwnd += acked * 0.01 / self.cwnd
+        self.cwnd = min(self.cwnd, self.max_window)
+
+    def _decrease(self) -> None:
+        self.w_max = self.cwnd
+        self.ssthresh = max(self.cwnd * CUBIC_BETA, MIN_SSTHRESH)
+        self.cwnd = self.ssthresh
+        self.epoch = None
+
+
+CONGESTION_CONTROLLERS = {
+    'none': FixedWindow,
+    'aimd': AIMD,
+    'cubic': Cubic
+}
+
+
+def create_congestion_controller(name: str,
+                                 max_window: int) -> CongestionController:
+    return CONGESTION_CONTROLLERS.get(name, AIMD)(max_window)
@@ -0,0 +1,108 @@
+# Lib
+from lib.rdt_interface import MAX_DATAGRAM_SIZE
+
+# Ethernet MTU (1500) - IPv4 and UDP headers: never fragmented
+BASE_DATAGRAM_SIZE = 1472
+# Sizes tried above the base one (jumbo frames, then loopback like MTUs)
+DATAGRAM_SIZES = (8972, 16384, 32768, 65507)
+
+PROBE_INTERVAL = 16  # datagrams acked before probing the next size
+MAX_PROBE_INTERVAL = 1024
+PROBE_ACKS = 2  # probe datagrams that must be acked to use their size
+LOSS_ALPHA = 1 / 32
+MAX_LOSS_RATE = 0.1  # loss rate that makes the size go down a level
+
+
+class DatagramSizer:
+    """
+    Datagram size selection for a session (PLPMTUD like, RFC 8899).
+
+    Datagrams start at a size that is never fragmented, and bigger sizes
+    are probed once enough datagrams were acked: if the probe datagrams
+    are acked the size is kept, otherwise probing backs off. When the
+    loss rate at the current size gets too high (e.g. a fragment of
+    every big datagram is being dropped) the size goes down a level.
+
+    Sizes are limited by max_size and by the max size advertised by the
+    peer (see MAX_SIZE_OPT); until the peer advertises it, only the base
+    size is used.
+    """
+
+    def __init__(self, max_size: int = MAX_DATAGRAM_SIZE,
+                 base_size: int = BASE_DATAGRAM_SIZE) -> None:
+        self.max_size = max_size
+        self.sizes = sorted({min(size, max_size)
+                             for size in (base_size, *DATAGRAM_SIZES)
+                             if size >= base_size})
+        self.peer_max = None
+        self.level = 0
+        self.probing = False
+        self.probe_acked = 0
+        self.probe_interval = PROBE_INTERVAL
+        self.acked = 0
+        self.loss_rate = 0
+        return
+
+    def get_size(self) -> int:
+        if self.probing:
+            return self.sizes[self.level + 1]
+        return self.sizes[self.level]
+
+    def set_peer_max(self, size: int) -> None:
+        if size == self.peer_max:
+            return
+        self.peer_max = size
+        while self.level > 0 and self.sizes[self.level] > size:
+            self.level -= 1
+        self.probing = self.probing and self._can_probe()
+
+    def on_ack(self, size: int) -> None:
+        """
+        Called for every datagram acked, with its size.
+        """
+        if size > self.sizes[self.level]:
+            # a probe (or a datagram sent before the size went down)
+            if self.probing:
+                self.probe_acked += 1
+                if self.probe_acked >= PROBE_ACKS:
+                    self._set_level(self.level + 1)
+            return
+
+        self.loss_rate *= 1 - LOSS_ALPHA
+        self.acked += 1
+        if not self.probing and self.acked >= self.probe_interval and\
+                self._can_probe():
+            self.probing = True
+            self.probe_acked = 0
+
+    def on_loss(self, size: int) -> None:
+        """
+        Called when a datagram of the given size was lost.
+        """
+        if size > self.sizes[self.level]:
+            if self.probing:
+                self._back_off()
+            return
+
+        self.loss_rate += LOSS_ALPHA * (1 - self.loss_rate)
+        if self.loss_rate > MAX_LOSS_RATE and self.level > 0 and\
+                size > self.sizes[self.level - 1]:
+            self._set_level(self.level - 1)
+            self._back_off()
+
+    def _can_probe(self) -> bool:
+        return self.level + 1 < len(self.sizes) and\
+            self.peer_max is not None and\
+            self.sizes[self.level + 1] <= self.peer_max
+
+    def _set_level(self, level: int) -> None:
+        self.level = level
+        self.probing = False
+        self.acked = 0
+        self.loss_rate = 0
+
+    def _back_off(self) -> None:
+        self.probing = False
+        self.acked = 0
+        self.probe_interval = min(2 * self.probe_interval,
+                                  MAX_PROBE_INTERVAL)
@@ -0,0 +1,207 @@
+from hashlib import blake2b
+from itertools import accumulate, compress, count
+from math import isqrt
+from typing import Iterator, Optional
+
+MIN_BLOCK_SIZE = 2**11  # 2 KB
+MAX_BLOCK_SIZE = 2**15  # 32 KB (so weak checksums fit in 64 bits)
+WEAK_SIZE = 8
+STRONG_SIZE = 16
+# weight of the sum of the bytes in the weak checksum (above the bits of
+# the weighted sum, for the max block size)
+SUM_WEIGHT = 2**37
+# offsets whose weak checksums are computed at once (the batch doubles
+# while no block is found)
+MIN_SEARCH_BATCH = 2**12
+MAX_SEARCH_BATCH = 2**16
+
+# delta instructions
+LITERAL = 0  # [LITERAL, LEN] + data
+COPY = 1  # [COPY, FIRST, COUNT]: blocks of the old file
+
+
+def get_block_size(size: int) -> int:
+    # sqrt(size) like rsync: the signature and the literals grow alike
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, isqrt(size)))
+
+
+def strong_checksum(block: bytearray) -> bytes:
+    return blake2b(block, digest_size=STRONG_SIZE).digest()
+
+
+def weak_checksum(block: bytearray) -> int:
+    """
+    Weak (rolling) checksum of a block, as in rsync: the sum of its
+    bytes (A) and the sum of each byte weighted by its distance to the
+    end of the block (B, the sum of the prefix sums), as a single
+    integer SUM_WEIGHT * A + B. It is exact (there is no modulus) and
+    computed in C, never byte by byte in Python.
+    """
+    return SUM_WEIGHT * sum(block) + sum(accumulate(block))
+
+
+def rolling_checksums(data: bytearray, block_size: int) -> memoryview:
+    """
+    Weak checksums of the blocks at every offset of `data`, all of them
+    at once with big integer arithmetic instead of rolling them byte by
+    byte. The bytes are spread in 64-bit slots of an integer X (as the
+    coefficients of a polynomial in z = 2**64), so the checksums are
+    the coefficients of X * W, with W = sum((L - i + SUM_WEIGHT) z**i).
+    W has a closed form with (1 - z)**2 as denominator, so the product
+    takes a few linear operations (shifts, small multiplications and a
+    division) instead of a convolution.
+    """
+    size = len(data)
+    spread = bytearray(WEAK_SIZE * size)
+    spread[::WEAK_SIZE] = data
+    x = int.from_bytes(spread, "little")
+
+    # W * (1 - z)**2 = (1 + c) - c z - (L + 1 + c) z**L + (L + c) z**(L + 1)
+    bits = 8 * WEAK_SIZE
+    c = SUM_WEIGHT
+    product = x * (1 + c) - ((x * c) << bits) -\
+        ((x * (block_size + 1 + c)) << (bits * block_size)) +\
+        ((x * (block_size + c)) << (bits * (block_size + 1)))
+    product //= ((1 << bits) - 1)**2
+
+    # the coefficient of the block at k is the one of its last byte
+    checksums = memoryview(product.to_bytes(
+        WEAK_SIZE * (size + block_size), "little")).cast("Q")
+    return checksums[block_size - 1:size]
+
+
+class Signature:
+    """
+    Checksums of the blocks of a file (the last one is left out if it
+    is not complete): a weak one, to look for the blocks at any offset,
+    and a strong one to confirm them.
+    """
+
+    def __init__(self, block_size: int) -> None:
+        self.block_size = block_size
+        self.strong = []
+        # weak checksum -> indexes of the blocks
+        self.weak = {}
+        return
+
+    def add(self, weak: int, strong: bytes) -> None:
+        self.weak.setdefault(weak, []).append(len(self.strong))
+        self.strong.append(strong)
+
+    def __len__(self) -> int:
+        return len(self.strong)
+
+    def find(self, weak: int, block: bytearray) -> Optional[int]:
+        strong = None
+        for index in self.weak.get(weak, ()):
+            strong = strong or strong_checksum(block)
+            if self.strong[index] == strong:
+                return index
+        return None
+
+
+def file_signature(f, block_size: int,
+                   batch: int) -> 'Iterator[tuple[int, bytes]]':
+    """
+    Checksums of the blocks of a file, read `batch` bytes at a time (a
+    multiple of the block size).
+    """
+    batch -= batch % block_size
+    view = memoryview(bytearray(batch))
+    while (size := f.readinto(view)):
+        for i in range(0, size - block_size + 1, block_size):
+            block = view[i:i + block_size]
+            yield weak_checksum(block), strong_checksum(block)
+        if size < batch:
+            break
+
+
+def _search(buffer: bytearray, start: int, end: int,
+            signature: Signature) -> 'tuple[int, Optional[int]]':
+    # first offset in [start, end) where a block of the signature is,
+    # and its index (end and None if there is none)
+    size = signature.block_size
+    with memoryview(buffer) as view:
+        checksums = rolling_checksums(view[start:end + size - 1], size)
+        # (most batches of changed data have no block at all)
+        if signature.weak.keys().isdisjoint(checksums):
+            return end, None
+        hits = compress(zip(count(start), checksums),
+                        map(signature.weak.__contains__, checksums))
+        for hit, weak in hits:
+            if (index := signature.find(
+                    weak, view[hit:hit + size])) is not None:
+                return hit, index
+    return end, None
+
+
+def delta(f, signature: Signature) -> 'Iterator[tuple]':
+    """
+    Instructions to rebuild the file from the old one (the one of the
+    signature): (COPY, first block, count) or (LITERAL, data).
+
+    After a block is found, the next block of the old file is tried
+    at the next offset (only its strong checksum), so unchanged runs are
+    found at the speed of the hash. Otherwise the weak checksums of the
+    next offsets are computed in batches, and only the ones found in the
+    signature are confirmed with the strong checksum.
+    """
+    size = signature.block_size
+    buffer = bytearray()
+    pos = 0  # offset in buffer where the search goes on
+    literal = 0  # start of the bytes that were not found yet
+    expected = 0  # block tried first
+    copy = None  # [first, count] of the last blocks found
+    batch = MIN_SEARCH_BATCH
+    eof = not len(signature)
+
+    while True:
+        if len(buffer) - pos < size + MAX_SEARCH_BATCH and not eof:
+            # the bytes before the literal are not needed anymore
+            if literal < pos:
+                if copy is not None:
+                    yield (COPY, *copy)
+                    copy = None
+                yield LITERAL, bytes(buffer[literal:pos])
+            del buffer[:pos]
+            pos = literal = 0
+            chunk = f.read(2 * MAX_SEARCH_BATCH + size)
+            eof = not chunk
+            buffer += chunk
+
+        if len(buffer) - pos < size:
+            break
+
+        if expected < len(signature) and signature.strong[expected] ==\
+                strong_checksum(memoryview(buffer)[pos:pos + size]):
+            index = expected
+        else:
+            pos, index = _search(buffer, pos,
+                                 min(len(buffer) - size + 1, pos + batch),
+                                 signature)
+            if index is None:
+                batch = min(2 * batch, MAX_SEARCH_BATCH)
+                continue
+            batch = MIN_SEARCH_BATCH
+
+        if literal < pos:
+            if copy is not None:
+                yield (COPY, *copy)
+                copy = None
+            yield LITERAL, bytes(buffer[literal:pos])
+        if copy is not None and copy[0] + copy[1] == index:
+            copy[1] += 1
+        else:
+            if copy is not None:
+                yield (COPY, *copy)
+            copy = [index, 1]
+        pos += size
+        literal = pos
+        expected = index + 1
+
+    if copy is not None:
+        yield (COPY, *copy)
+    if literal < len(buffer):
+        yield LITERAL, bytes(buffer[literal:])
+    while (chunk := f.read(MAX_SEARCH_BATCH)):
+        yield LITERAL, chunk
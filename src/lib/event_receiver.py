@@ -0,0 +1,249 @@
+from heapq import heappop, heappush
+from threading import Thread
+from time import perf_counter as now
+from typing import Optional
+
+# Lib
+from lib.socket_udp import (BufferPool, MAX_RECV_BATCH, RECV_BUFFER_SIZE,
+                            Socket, SocketTimeout)
+from lib.client_handler import ServerStopped, Session, session_params
+from lib.logger import logger
+from lib.rdt_interface import (CID_SIZE, NO_CID, Connection, decode_cid,
+                               new_cid)
+from lib.rdt_selection import PACING
+from lib.receiver import Blacklist, NEW_CONNECTION_MAX_WAIT
+from lib.stats import stats
+
+# full batches read in a row before the timers are checked (so a burst
+# of ACKs is seen before the windows that drain them are sent)
+MAX_DRAIN_BATCHES = 4
+
+
+class EventSession(Session):
+    """
+    Session driven by the events of the EventReceiver loop: its handler
+    runs until it waits for a datagram, and is resumed with the next one
+    of its client or with a SocketTimeout once its deadline is reached.
+    """
+
+    def __init__(self, connection: Connection, params: dict):
+        # pacing sleeps between datagrams, which would block the loop
+        super().__init__(connection, None, params, pacing='')
+        self.steps = self._handle()
+        # time the RDT stops waiting for a datagram (None: forever)
+        self.deadline = None
+        # deadline of the timer of the session in the loop heap
+        self.scheduled = None
+
+    def _resume(self, resume, arg) -> None:
+        try:
+            timeout, start_time = resume(arg)
+        except StopIteration:
+            self.running = False
+            return
+        except BaseException as e:
+            self._report_error(e)
+            self.running = False
+            return
+        self.deadline = start_time + timeout if timeout is not None\
+            else None
+
+    def start(self) -> None:
+        self._resume(self.steps.send, None)
+
+    def on_datagram(self, data: bytearray) -> None:
+        self._resume(self.steps.send, data)
+
+    def on_timeout(self) -> None:
+        self._resume(self.steps.throw, SocketTimeout())
+
+    def stop(self) -> None:
+        self._resume(self.steps.throw, ServerStopped())
+
+
+class EventReceiver:
+    """
+    Server engine with a single event loop instead of a thread per
+    client (see Receiver, whose interface it shares).
+
+    The loop waits for datagrams (polling the socket) up to the earliest
+    deadline of the sessions, gives every datagram to the session of
+    its CID (or opens one, see Receiver) and then fires the timers that
+    are due. The timers are
+    kept in a heap with at most one live entry per session: a new one
+    is pushed only when the deadline moves earlier, and an entry whose
+    session got a later deadline is pushed again when it pops.
+
+    Disk I/O, compression and checksums still run in the loop, blocking
+    every session while they do, and the RDTs are not paced.
+    """
+
+    def __init__(self, skt: Socket, owner: int = 0):
+        self.th = Thread(target=self._run, name='EventReceiver')
+        self.skt = skt
+        self.receiving = True
+        # (see Receiver)
+        self.owner = owner
+        self.clients: dict[int, EventSession] = {}
+        self.addrs: dict[tuple[str, int], int] = {}
+        self.tmp_blacklist = Blacklist()
+        self.pool = BufferPool(RECV_BUFFER_SIZE)
+        # (deadline, session id, session)
+        self.timers = []
+        if PACING:
+            logger.warning('[EventReceiver] Pacing is not supported by '
+                           'the event engine, sessions are not paced.')
+        self.th.start()
+
+    def _new_session(self, addr, hello) -> Optional[EventSession]:
+        # Session of a new client, None if it is not one the server
+        # supports
+        params = session_params(self.skt, addr, hello)
+        if params is None:
+            return None
+        cid = new_cid(self.owner, self.clients)
+        session = self.clients[cid] = EventSession(
+            Connection(self.skt, addr, cid), params)
+        self.addrs[addr] = cid
+        logger.debug(
+            f"[EventReceiver] {addr[0]}:{addr[1]} request assigned to "
+            f"{session.name}.")
+        stats['requests']['total'] += 1
+        session.start()
+        session.greet()
+        self._update(session)
+        return session
+
+    def _demux(self, addr, datagrams):
+        """
+        Gives the datagrams (received at once, from the same client
+        socket) to the session of their CID. The ones without a CID are
+        HELLOs (see Receiver).
+        """
+        cid = decode_cid(datagrams[0])
+        if cid == NO_CID:
+            session = self.clients.get(self.addrs.get(addr))
+            if session is not None:
+                session.greet()
+            elif addr not in self.tmp_blacklist:
+                self._new_session(addr, datagrams[0][CID_SIZE:])
+            return
+
+        session = self.clients.get(cid)
+        if session is None:
+            # of a finished session
+            return
+        if not session.confirmed:
+            session.confirmed = True
+            self.addrs.pop(session.addr, None)
+        if addr != session.addr:
+            session.migrate(addr)
+
+        for data in datagrams:
+            if not session.running:
+                break
+            session.on_datagram(data[CID_SIZE:])
+        self._update(session)
+        return
+
+    def _update(self, session: EventSession) -> None:
+        # After a session ran: it is removed if it finished, otherwise
+        # its timer is scheduled
+        if not session.running:
+            self.clients.pop(session.cid, None)
+            if not session.confirmed:
+                self.addrs.pop(session.addr, None)
+                self.tmp_blacklist.add(session.addr)
+            logger.debug(f"[{session.name}] Removed.")
+            return
+
+        deadline = session.deadline
+        if deadline is None:
+            return
+        if session.scheduled is None or deadline < session.scheduled:
+            session.scheduled = deadline
+            heappush(self.timers, (deadline, session.id, session))
+
+    def _next_timeout(self) -> float:
+        timeout = NEW_CONNECTION_MAX_WAIT
+        if self.timers:
+            timeout = min(timeout, self.timers[0][0] - now())
+        return max(timeout, 0)
+
+    def _fire_timers(self) -> None:
+        current = now()
+        while self.timers and self.timers[0][0] <= current:
+            deadline, _, session = heappop(self.timers)
+            if deadline != session.scheduled or not session.running:
+                # a stale entry (a new one was pushed before it)
+                continue
+            session.scheduled = None
+            if session.deadline is None:
+                continue
+            if session.deadline > current:
+                # it got datagrams since: the timer was restarted
+                self._update(session)
+                continue
+            session.on_timeout()
+            self._update(session)
+
+    def _read(self, timeout: float) -> Optional[int]:
+        # Reads a batch of datagrams and dispatches them. Returns the
+        # amount of reads, None once the socket was closed
+        try:
+            batch = self.skt.recvmany(self.pool, timeout, now())
+        except SocketTimeout:
+            return 0
+        except OSError:
+            # the socket was closed while waiting
+            if self.receiving:
+                raise
+            return None
+
+        self.tmp_blacklist.expire()
+        for datagrams, addr, buffer in batch:
+            if not addr:
+                self.pool.put(buffer)
+                return None
+
+            self._demux(addr, datagrams)
+            # the sessions copy the data they keep
+            self.pool.put(buffer)
+        return len(batch)
+
+    def _run(self):
+        try:
+            while self.receiving:
+                reads = self._read(self._next_timeout())
+                drained = 1
+                while reads == MAX_RECV_BATCH and\
+                        drained < MAX_DRAIN_BATCHES:
+                    reads = self._read(0)
+                    drained += 1
+                if reads is None:
+                    logger.debug("[EventReceiver] Stopped.")
+                    break
+                self._fire_timers()
+
+            logger.debug("[EventReceiver] Stopping sessions...")
+            for session in list(self.clients.values()):
+                session.stop()
+            self.clients = {}
+            self.addrs = {}
+        except BaseException:
+            logger.exception("Unexpected error during execution:")
+        return
+
+    def get_stats(self) -> dict:
+        # the kernel drops are only known along with a datagram otherwise
+        self.skt.update_drops()
+        return stats
+
+    def stop(self, force=False):
+        logger.debug('[EventReceiver] Stopping...')
+        if not force and len(self.clients) > 0:
+            raise RuntimeWarning("Some Handlers havent finished yet.")
+        self.receiving = False
+        self.skt.close()
+        self.th.join()
+        logger.debug('[EventReceiver] Joined.')
@@ -0,0 +1,163 @@
+from typing import Optional
+
+# Lib
+from lib.rdt_interface import FEC_COUNT_SIZE, FEC_LEN_SIZE, FEC_TYPE
+
+FEC_HEADER_SIZE = FEC_COUNT_SIZE + FEC_LEN_SIZE
+
+
+def _xor_value(payload: bytearray) -> int:
+    # The whole payload as a single (little endian) integer, so the XOR
+    # of a payload runs in C and shorter payloads are padded with zeros
+    return int.from_bytes(payload, "little")
+
+
+def split_parity(data: bytearray) -> 'tuple[int, int, bytearray]':
+    """
+    Splits the payload of a FEC datagram ([COUNT, LEN, XOR]) into the
+    amount of datagrams it covers, the XOR of their lengths and the XOR
+    of their payloads.
+    """
+
+    count = int.from_bytes(data[:FEC_COUNT_SIZE], "big")
+    length = int.from_bytes(data[FEC_COUNT_SIZE:FEC_HEADER_SIZE], "big")
+    return count, length, data[FEC_HEADER_SIZE:]
+
+
+def valid_group_size(group_size: int, sn_space: int) -> bool:
+    return 0 < group_size < 2**(8 * FEC_COUNT_SIZE) and\
+        sn_space % group_size == 0
+
+
+def check_group_size(group_size: int, sn_space: int) -> None:
+    assert valid_group_size(group_size, sn_space), \
+        "Invalid FEC group size, must be a power of 2 (up to 128)"
+
+
+class ParityEncoder:
+    """
+    XOR parity of groups of DATA datagrams (forward error correction).
+
+    Groups are aligned to the SNs (one starts at every SN multiple of
+    group_size), so both ends agree on them without any signaling. The
+    payloads are XORed when they are sent for the first time, along
+    with their lengths (so the receiver knows the length of the one it
+    rebuilds), and the parity is sent once the group is complete. When
+    a stream ends in the middle of a group, a parity of the datagrams
+    sent so far is flushed, and the group goes on with the next stream.
+    """
+
+    def __init__(self, group_size: int, sn_size: int) -> None:
+        check_group_size(group_size, 2**(8 * sn_size))
+        self.group_size = group_size
+        self.sn_size = sn_size
+        self.flushed = True
+        self._reset()
+        return
+
+    def _reset(self) -> None:
+        self.start = None
+        self.count = 0
+        self.xor = 0
+        self.length_xor = 0
+        self.max_length = 0
+
+    def add(self, sn: int, payload: bytearray) -> Optional[tuple]:
+        """
+        Adds a datagram sent for the first time. Returns the parity
+        datagram (header, payload) when its group is complete.
+        """
+        if self.start is None:
+            self.start = sn
+        self.count += 1
+        self.xor ^= _xor_value(payload)
+        self.length_xor ^= len(payload)
+        self.max_length = max(self.max_length, len(payload))
+        self.flushed = False
+
+        if (sn + 1) % self.group_size:
+            return None
+        parity = self.flush()
+        self._reset()
+        return parity
+
+    def flush(self) -> Optional[tuple]:
+        """
+        Parity of the datagrams added to the current group so far (None
+        if it was already sent). The group is kept open.
+        """
+        if self.flushed:
+            return None
+        self.flushed = True
+        # [FEC, SN, COUNT, LEN, XOR]
+        return (FEC_TYPE + self.start.to_bytes(self.sn_size, "big") +
+                self.count.to_bytes(FEC_COUNT_SIZE, "big") +
+                self.length_xor.to_bytes(FEC_LEN_SIZE, "big"),
+                self.xor.to_bytes(self.max_length, "little"))
+
+
+class _Group:
+
+    def __init__(self) -> None:
+        self.received = set()
+        self.xor = 0
+        self.length_xor = 0
+        return
+
+
+class ParityDecoder:
+    """
+    Rebuilds a lost DATA datagram from the parity of its group.
+
+    The receiver adds every new datagram it accepts (they can not be
+    kept, most of them are consumed right away) and the parity of the
+    group is XORed with them when it arrives: if a single datagram of
+    the ones it covers is missing, that is the result. Groups are
+    dropped as soon as all their datagrams were received.
+    """
+
+    def __init__(self, group_size: int, sn_space: int) -> None:
+        check_group_size(group_size, sn_space)
+        self.group_size = group_size
+        self.groups = {}
+        return
+
+    def _get_group(self, sn: int) -> '_Group':
+        start = sn - sn % self.group_size
+        if (group := self.groups.get(start)) is None:
+            group = self.groups[start] = _Group()
+        return group
+
+    def add(self, sn: int, payload: bytearray) -> None:
+        start = sn - sn % self.group_size
+        group = self._get_group(sn)
+        group.received.add(sn)
+        group.xor ^= _xor_value(payload)
+        group.length_xor ^= len(payload)
+        if len(group.received) == self.group_size:
+            del self.groups[start]
+
+    def recover(self, sn: int, data: bytearray
+                ) -> 'Optional[tuple[int, bytes]]':
+        """
+        Given a parity datagram (the SN of the first datagram it covers
+        and its payload), returns the datagram it rebuilds (sn, payload)
+        or None if there is not exactly one of them missing.
+        """
+        count, length_xor, xor = split_parity(data)
+        group = self._get_group(sn)
+        # groups are aligned to the SNs, so they never wrap around
+        covered = set(range(sn, sn + count))
+        # a parity flushed at the end of a stream does not cover the
+        # datagrams of the next one
+        if not group.received <= covered:
+            return None
+        missing = covered - group.received
+        if len(missing) != 1:
+            return None
+
+        lost = missing.pop()
+        payload = (group.xor ^ _xor_value(xor)).to_bytes(
+            group.length_xor ^ length_xor, "little")
+        self.add(lost, payload)
+        return lost, payload
@@ -1,62 +1,298 @@
+from time import perf_counter as now
+from typing import Callable, Iterable, Iterator, Optional
+
 # Lib
+from lib.congestion import CongestionController, FixedWindow
+from lib.datagram_size import DatagramSizer
+from lib.fec import FEC_HEADER_SIZE, ParityDecoder, ParityEncoder, split_parity
 from lib.rdt_interface import (
-    DATA_TYPE, MAX_PAYLOAD_SIZE, RDTInterface,
-    RecvCallback, SN_SIZE, SendCallback)
+    ACK_DELAY, ACK_TYPE, CID_SIZE, DATA_TYPE, MAX_DISCONNECT_TIME,
+    RDTInterface, RecvBuffer, RecvCallback, SN_SIZE, SendCallback,
+    TS_DATA_TYPE, TS_ECHO_OPT, TS_SIZE, TYPE_SIZE, WIDE_SN_SIZE,
+    decode_echo_rtt, decode_max_size, decode_recv_window, encode_max_size,
+    encode_options, encode_recv_window, timestamp)
+from lib.pacing import Pacer
 from lib.rtt_handler import RTTHandler
+from lib.stats import stats
 
 
-def encode_sn(sn: int) -> bytearray:
-    return sn.to_bytes(SN_SIZE, "big")
+def encode_sn(sn: int, size: int = SN_SIZE) -> bytearray:
+    return sn.to_bytes(size, "big")
 
 
 def decode_sn(sn: bytearray) -> int:
     return int.from_bytes(sn, "big")
 
 
+def get_sn_size(window_size: int) -> int:
+    """
+    Smallest SN wire format that can handle the given window size.
+    Windows that fit in a single byte keep the original format, bigger
+    ones switch to 32-bit SNs.
+    """
+    if 2 * window_size <= 2**(8 * SN_SIZE):
+        return SN_SIZE
+    return WIDE_SN_SIZE
+
+
+class DatagramWindow:
+    """
+    Datagrams of a stream, indexed by pn. They are created lazily (only
+    when the window reaches them) and released once they are acked, so
+    a stream of any size can be sent with a window worth of memory.
+    """
+
+    def __init__(self, datagrams: Iterator) -> None:
+        self.source = datagrams
+        self.datagrams = {}
+        self.end = 0
+        self.done = False
+        return
+
+    def __getitem__(self, pn: int) -> tuple:
+        return self.datagrams[pn]
+
+    def fill(self, end: int) -> int:
+        """
+        Creates the datagrams up to `end` (if the stream has them) and
+        returns the end of the available ones.
+        """
+        while self.end < end and not self.done:
+            datagram = next(self.source, None)
+            if datagram is None:
+                self.done = True
+                break
+            self.datagrams[self.end] = datagram
+            self.end += 1
+        return min(end, self.end)
+
+    def release(self, start: int, end: int) -> None:
+        for pn in range(start, end):
+            self.datagrams.pop(pn, None)
+
+    def finished(self, base: int) -> bool:
+        return self.fill(base + 1) == base
+
+
 class GoBackNBase(RDTInterface):
     """
     GBN protocol abstract class.
+
+    The whole SN space of the wire format is used (2**8 or 2**32), not
+    just 2 * N: after a hole is filled the base can jump a full window
+    while duplicated ACKs of the old base are still in flight, and with
+    a 2 * N space those would be taken for ACKs of the new window.
+    The 32-bit format allows windows of thousands of datagrams on high
+    BDP links.
     """
 
     def __init__(self, _send: SendCallback, _recv: RecvCallback,
-                 window_size: int = 10) -> None:
-        assert window_size <= (2**(8 * SN_SIZE))//2, "Window size is too large"
+                 window_size: int = 10, sn_size: int = None,
+                 cc: CongestionController = None,
+                 pacer: Pacer = None, ack_every: int = 1,
+                 ack_delay: float = ACK_DELAY,
+                 sizer: DatagramSizer = None,
+                 timestamps: bool = True, fec_group: int = 0,
+                 recv_window: Callable[[], int] = None) -> None:
+        self.sn_size = sn_size or get_sn_size(window_size)
+        self.sn_space = 2**(8 * self.sn_size)
+        assert window_size <= self.sn_space // 2, "Window size is too large"
         self.n = window_size
+        # DATA can carry a timestamp for the peer to echo in its ACKs
+        self.timestamps = timestamps
+        self.data_type = TS_DATA_TYPE if timestamps else DATA_TYPE
+        # (the CID is put before the header by the Connection)
+        self.header_size = CID_SIZE + TYPE_SIZE + self.sn_size +\
+            (TS_SIZE if timestamps else 0)
+        # FEC: a parity datagram every `fec_group` DATA datagrams (the
+        # receiver must buffer out of order datagrams to make use of it)
+        self.fec_encoder = self.fec_decoder = None
+        if fec_group:
+            self.fec_encoder = ParityEncoder(fec_group, self.sn_size)
+            self.fec_decoder = ParityDecoder(fec_group, self.sn_space)
+            # parity datagrams are as big as the biggest payload
+            self.header_size = max(self.header_size, CID_SIZE +
+                                   TYPE_SIZE + self.sn_size +
+                                   FEC_HEADER_SIZE)
+        # the datagram size is negotiated: our max size goes in every ACK
+        self.sizer = sizer or DatagramSizer()
+        self.ack_options = encode_max_size(self.sizer.max_size)
         self._send_datagram = _send
+        # several datagrams in a single call (where the socket can)
+        self._send_many = getattr(_send, 'many', None)
         self._recv_datagram = _recv
-        self.dict_transform = {}
+        # pn of the base of the send window (see _get_pn)
+        self.base_pn = 0
         self.sn_send = 0
         self.sn_recv = 0
-        self.rtt = RTTHandler()
+        self.output = RecvBuffer()
+        # timestamp echoed in our ACKs (of the last in order DATA)
+        self.ts_recent = None
+        # Delayed ACKs: in order datagrams are acked every `ack_every`
+        # datagrams or after `ack_delay` secs, so the RTO must be higher
+        self.ack_every = ack_every
+        self.ack_delay = ack_delay
+        self.rtt = RTTHandler(
+            min_timeout=2 * ack_delay if ack_every > 1 else 0)
+        self.cc = cc or FixedWindow(window_size)
+        self.pacer = pacer
+        # Flow control: datagrams we can take now (advertised in our
+        # ACKs, None if we take whatever arrives) and the window last
+        # advertised by the peer
+        self.recv_window = recv_window
+        self.peer_window = None
         return
 
-    def _create_datagrams(self, data: bytearray) -> 'list[bytearray]':
-        # [DATA, SN, payload]
-        return [DATA_TYPE + encode_sn(self._get_sn(int(i/MAX_PAYLOAD_SIZE))) +
-                data[i:i+MAX_PAYLOAD_SIZE]
-                for i in range(0, len(data), MAX_PAYLOAD_SIZE)]
+    def _create_datagrams(self, chunks: Iterable) -> Iterator:
+        # ([DATA, SN], payload), pns keep growing across the chunks but
+        # every chunk is split on its own, so no datagram spans two of
+        # them (the receiver reads the stream chunk by chunk). Payloads
+        # are views of the chunk, they are never copied. The timestamp
+        # is added when the datagram is sent (see _send_paced)
+        pn = 0
+        for data in chunks:
+            view = memoryview(data)
+            i = 0
+            while i < len(view):
+                size = self.sizer.get_size() - self.header_size
+                yield (self.data_type +
+                       encode_sn(self._get_sn(pn), self.sn_size),
+                       view[i:i+size])
+                i += size
+                pn += 1
+
+    def _ack(self, sn: int, ts: bytes = None) -> bytearray:
+        # [ACK, SN, options]
+        ack = ACK_TYPE + encode_sn(sn, self.sn_size) + self.ack_options
+        if self.recv_window is not None:
+            ack += encode_recv_window(max(0, self.recv_window()))
+        if ts is not None:
+            ack += encode_options({TS_ECHO_OPT: ts})
+        return ack
+
+    def _get_size(self, datagram: tuple) -> int:
+        return self.header_size + len(datagram[1])
+
+    def _add_rtt_sample(self, options: dict, sent: float = None) -> None:
+        # the echoed timestamp is preferred, `sent` is None when the
+        # datagram was re-transmitted (Karn's rule)
+        if (sample := decode_echo_rtt(options)) is None and\
+                sent is not None:
+            sample = now() - sent
+        if sample is not None:
+            self.rtt.add_sample(sample)
+
+    def _update_peer_limits(self, options: dict) -> None:
+        # max datagram size and receive window advertised in an ACK
+        if (size := decode_max_size(options)) is not None:
+            self.sizer.set_peer_max(size)
+        if (window := decode_recv_window(options)) is not None:
+            self.peer_window = window
+
+    def _window(self):
+        window = min(self.n, self.cc.get_window())
+        if self.peer_window is None:
+            return window
+        # (a window of 0 still lets the base out on a timeout, as a probe)
+        return max(1, min(window, self.peer_window))
+
+    def _parts(self, datagram: tuple) -> tuple:
+        if self.timestamps:
+            # [DATA, SN, TS, payload]
+            return datagram[0], timestamp(), datagram[1]
+        return datagram
+
+    def _send_paced(self, datagram: tuple):
+        if self.pacer is not None:
+            self.pacer.wait(self._get_size(datagram),
+                            self._window() * self.sizer.get_size(), self.rtt)
+        return self._send_datagram(*self._parts(datagram))
+
+    def _send_all(self, datagrams: list, parities: list = ()):
+        # a burst goes in a single batch, unless it has to be paced
+        if self.pacer is not None or self._send_many is None or\
+                len(datagrams) + len(parities) < 2:
+            for datagram in datagrams:
+                self._send_paced(datagram)
+            for parity in parities:
+                self._send_datagram(*parity)
+            return
+        self._send_many([self._parts(datagram) for datagram in datagrams] +
+                        list(parities))
+
+    def _add_parity(self, datagram: tuple, parities: list) -> None:
+        # the datagram is sent for the first time, its group parity is
+        # sent along with it when the group is complete
+        if self.fec_encoder is None:
+            return
+        sn = decode_sn(datagram[0][TYPE_SIZE:])
+        if (parity := self.fec_encoder.add(sn, datagram[1])) is not None:
+            parities.append(parity)
+
+    def _flush_parity(self, window: DatagramWindow, end: int,
+                      parities: list) -> None:
+        # the last datagram of the stream was sent: its group may not be
+        # complete, but its parity can not wait for the next stream
+        if self.fec_encoder is not None and window.finished(end) and\
+                (parity := self.fec_encoder.flush()) is not None:
+            parities.append(parity)
+
+    def _recover(self, sn: int, data: bytearray
+                 ) -> 'Optional[tuple[int, bytes]]':
+        # A parity datagram arrived, the datagram of its group that was
+        # lost is rebuilt. Parities of groups already consumed (their
+        # last datagram is behind the window) are dropped
+        if self.fec_decoder is None:
+            return None
+        count = split_parity(data)[0]
+        if not count or not self._in_window(
+                (sn + count - 1) % self.sn_space, self.sn_recv):
+            return None
+        if (recovered := self.fec_decoder.recover(sn, data)) is not None:
+            stats['fec-recovered'] += 1
+        return recovered
+
+    def _fec_add(self, sn: int, data: bytearray) -> None:
+        # every new datagram accepted by the receiver
+        if self.fec_decoder is not None:
+            self.fec_decoder.add(sn, data)
+
+    def _recv_timeout(self, ack_since):
+        # While an ACK is being delayed we only wait until its timer
+        # expires, otherwise we wait for the peer as usual
+        if ack_since is None:
+            return MAX_DISCONNECT_TIME, now()
+        return self.ack_delay, ack_since
 
     def _get_prev(self, sn):
-        return (sn - 1) % (2 * self.n)
+        return (sn - 1) % self.sn_space
 
     def _get_next(self, sn):
-        return (sn + 1) % (2 * self.n)
+        return (sn + 1) % self.sn_space
 
-    def _calc_transform(self, base):
-        first_pn = (base - self.n)
-        last_pn = base + self.n
-        self.dict_transform = {(i + self.sn_send) % (2*self.n): i
-                               for i in range(first_pn, last_pn)}
-        return
+    def _in_window(self, sn, start):
+        return (sn - start) % self.sn_space < self.n
 
     def _get_sn(self, pn):
-        return (pn + self.sn_send) % (2 * self.n)
+        return (pn + self.sn_send) % self.sn_space
 
     def _get_pn(self, sn):
-        return self.dict_transform[sn]
+        # The SN is taken as the pn nearest to base_pn (the base of the
+        # window): the ones in [base - S/2, base + S/2), S = sn_space
+        offset = (sn - self._get_sn(self.base_pn)) % self.sn_space
+        if offset >= self.sn_space // 2:
+            offset -= self.sn_space
+        return self.base_pn + offset
 
-    def send(self, data: bytearray, last=False):
+    def send_steps(self, data: bytearray, last=False):
+        return self.send_stream_steps([data], last)
+
+    def send_stream_steps(self, chunks: Iterable, last=True):
         assert False, "Must be implemented!"
 
-    def recv(self, length):
+    def get_max_in_flight(self) -> int:
+        # the window plus the datagram used to detect the end
+        return (self.n + 1) * (self.sizer.max_size - self.header_size)
+
+    def recv_steps(self, length):
         assert False, "Must be implemented!"
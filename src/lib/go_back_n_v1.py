@@ -2,9 +2,9 @@ from time import perf_counter as now
 
 # Lib
 from lib.rdt_interface import (
-    ACK_TYPE, DISCONNECT_TIMEOUTS,
-    MAX_DISCONNECT_TIME, MAX_LAST_TIMEOUTS, split)
-from lib.go_back_n_base import GoBackNBase, encode_sn, decode_sn
+    ACK_TYPE, DISCONNECT_TIMEOUTS, MAX_LAST_TIMEOUTS,
+    SACK_OPT, decode_options, split, split_timestamp)
+from lib.go_back_n_base import DatagramWindow, GoBackNBase, decode_sn
 from lib.logger import logger
 from lib.socket_udp import SocketTimeout
 
@@ -16,46 +16,115 @@ class GoBackNV1(GoBackNBase):
     There is no buffering on the server side; when a package that is
     not expected is received (the sequence numbers do not match), then
     it is dropped (because the sender will re-transmit it anyway).
+
+    When the receiver reports SACK blocks (see GoBackNV2), the datagrams
+    it already buffered are not re-transmitted.
     """
 
-    def send(self, data: bytearray, last_chunk=False):
+    def _add_sacked(self, sacked: set, pn: int, options: dict):
+        # bit i of the bitmap refers to the datagram pn + 1 + i
+        sack = options.get(SACK_OPT)
+        if not sack:
+            return
+
+        for i, byte in enumerate(sack):
+            for j in range(8) if byte else ():
+                if byte & (0x80 >> j):
+                    sacked.add(pn + 1 + 8 * i + j)
+
+    def _send_range(self, window, wnd_start, wnd_end, sacked, sent_at):
+        datagrams = []
+        parities = []
+        for i in range(wnd_start, wnd_end):
+            if i in sacked:
+                continue
+            datagrams.append(window[i])
+            if i not in sent_at:
+                self._add_parity(window[i], parities)
+            # Karn's rule: re-transmitted datagrams give no RTT samples
+            # (unless the timestamp is echoed)
+            sent_at[i] = now() if i not in sent_at else None
+        self._flush_parity(window, wnd_end, parities)
+        self._send_all(datagrams, parities)
+
+    def send_stream_steps(self, chunks, last_chunk=True):
         logger.debug('[gbn:send] == START SENDING ==')
-        logger.debug(f'[gbn:send] Data to send: {data[:10]} - '
-                     f'len {len(data)} -')
 
         timeouts = 0
         base = 0
-        self._calc_transform(base)
-        datagrams = self._create_datagrams(data)
+        self.base_pn = base
+        window = DatagramWindow(self._create_datagrams(chunks))
         last_datagram = False
 
-        prev_base = 0
         doubled_acks = 0
 
-        logger.debug(f'[gbn:send] Datagram count: {len(datagrams)}')
+        # pns already buffered by the receiver, and the end of the holes
+        # to fill on a fast re-transmit (None re-sends the whole window)
+        sacked = set()
+        holes_end = None
+        next_pn = 0
+        # end of the datagrams sent so far (next_pn goes back on timeouts)
+        sent_end = 0
+        # while the datagrams sent before a fast re-transmit are not all
+        # acked, more duplicated ACKs are expected (NewReno recovery)
+        recover = 0
+
+        # pn -> time it was sent (None if it was re-transmitted)
+        sent_at = {}
 
-        while base < len(datagrams):
+        while not window.finished(base):
 
             start = now()
-            wnd_end = min(base + self.n, len(datagrams))
+            wnd_end = window.fill(base + self._window())
             wnd_start = min(base, wnd_end)
-            last_datagram = (wnd_end == len(datagrams))
-            for i in range(wnd_start, wnd_end):
-                self._send_datagram(datagrams[i])
+            self._send_range(window, wnd_start,
+                             min(holes_end or wnd_end, wnd_end),
+                             sacked, sent_at)
+            if holes_end is None:
+                next_pn = wnd_end
+            holes_end = None
+            sent_end = max(sent_end, next_pn)
+            last_datagram = window.finished(next_pn)
 
             logger.debug(
                 f'[gbn:send] Sending from {wnd_start} to'
                 f' {wnd_end} with sns: '
                 f'[{self._get_sn(base)}, {self._get_sn(wnd_end)}]')
 
-            while base < len(datagrams):
+            # the window moved but the new datagrams were not sent yet:
+            # the ACKs already received are read first, so they are all
+            # sent in a single batch
+            unsent = False
+
+            while not window.finished(base):
                 try:
-                    datagram_recd = self._recv_datagram(
-                        self.rtt.get_timeout(), start)
-                    type, sn, data = split(datagram_recd)
+                    datagram_recd = yield (
+                        (0, now()) if unsent
+                        else (self.rtt.get_timeout(), start))
+                    type, sn, data = split(datagram_recd, self.sn_size)
                     sn = decode_sn(sn)
                 except SocketTimeout:
+                    if unsent:
+                        # no more ACKs, we send new packages
+                        wnd_end = window.fill(base + self._window())
+                        wnd_start = min(max(next_pn, base), wnd_end)
+                        self._send_range(window, wnd_start, wnd_end,
+                                         sacked, sent_at)
+                        next_pn = max(next_pn, wnd_end)
+                        sent_end = max(sent_end, next_pn)
+                        last_datagram = window.finished(next_pn)
+                        unsent = False
+
+                        logger.debug(
+                            f'[gbn:send] Sending new data {wnd_start} '
+                            f'to {wnd_end} (cwnd: {self._window()})'
+                            f'[{self._get_sn(base)}, '
+                            f'{self._get_sn(wnd_end)}]')
+                        continue
+
                     self.rtt.timed_out()
+                    self.cc.on_timeout()
+                    self.sizer.on_loss(self._get_size(window[base]))
                     timeouts += 1
                     logger.debug('[gbn:send] Timed out. Resending...')
                     if timeouts >= DISCONNECT_TIMEOUTS:
@@ -65,72 +134,92 @@ class GoBackNV1(GoBackNBase):
                         logger.warn('Client request assumed to have been '
                                     'fulfilled (timeouts limit has been '
                                     'reached while waiting for ACK).')
-                        base = len(datagrams) + 1
+                        base = window.end
                     break
 
                 if type != ACK_TYPE:
-                    datagram = ACK_TYPE + \
-                        encode_sn(self._get_prev(self.sn_recv))
-                    self._send_datagram(datagram)
+                    self._send_datagram(
+                        self._ack(self._get_prev(self.sn_recv)))
                     continue
 
                 # got ack
                 pn = self._get_pn(sn)
                 logger.debug(
                     f'[gbn:send] Got ack sn: {sn} and pn: {pn} (base: {base})')
+                # a delayed ACK may alias to datagrams not sent yet
+                if pn >= sent_end:
+                    continue
+                options = decode_options(data)
+                self._update_peer_limits(options)
+                self._add_sacked(sacked, pn, options)
 
-                if pn == base - 1 and prev_base == base and\
+                if pn == base - 1 and base >= recover and\
                         (doubled_acks := doubled_acks + 1) == 3:
                     doubled_acks = 0
+                    recover = next_pn
+                    self.cc.on_dup_acks()
+                    self.sizer.on_loss(self._get_size(window[base]))
+                    if sacked:
+                        holes_end = max(sacked)
                     break
 
                 if pn < base:
                     continue
 
-                prev_base = base
                 doubled_acks = 0
 
-                self.rtt.add_sample(now() - start)
+                self._add_rtt_sample(options, sent_at.get(pn))
 
-                # We send new packages
                 timeouts = 0
-                new_count = pn - base + 1
+                self.cc.on_ack(pn - base + 1)
+                for i in range(base, pn + 1):
+                    self.sizer.on_ack(self._get_size(window[i]))
+                    sent_at.pop(i, None)
+                window.release(base, pn + 1)
+                base = pn + 1
+                self.base_pn = base
+                sacked = {i for i in sacked if i >= base}
 
                 start = now()
-                wnd_end = min(base + new_count + self.n, len(datagrams))
-                wnd_start = min(base + self.n, wnd_end)
-                last_datagram = (wnd_end == len(datagrams))
-                for i in range(wnd_start, wnd_end):
-                    self._send_datagram(datagrams[i])
-
-                logger.debug(
-                    f'[gbn:send] Sending new data {wnd_start} '
-                    f'to {wnd_end}'
-                    f'[{self._get_sn(base)}, {self._get_sn(wnd_end)}]')
-
-                base = pn + 1
-                self._calc_transform(base)
+                unsent = True
 
         self.sn_send = self._get_sn(base)
 
+        logger.debug(f'[gbn:send] Datagram count: {window.end}')
         logger.debug('[gbn:send] == FINISH SENDING ==')
         return
 
-    def recv(self, length):
+    def recv_steps(self, length):
         logger.debug('[gbn:recv] == START RECEIVING ==')
         logger.debug(f'[gbn:recv] Length: {length}')
 
-        result = []
-        total_recd = 0
+        self.output.start(length)
+
+        # in order datagrams not acked yet (delayed ACKs)
+        ack_pending = 0
+        ack_since = None
+
+        while not self.output.full():
+            try:
+                datagram = yield self._recv_timeout(ack_since)
+            except SocketTimeout:
+                if ack_since is None:
+                    raise
+                logger.debug(
+                    f'[gbn:recv] Sending delayed ack '
+                    f'({self._get_prev(self.sn_recv)})...')
+                self._send_datagram(
+                    self._ack(self._get_prev(self.sn_recv), self.ts_recent))
+                ack_pending, ack_since = 0, None
+                continue
 
-        while total_recd < length:
-            type, sn, data = split(
-                self._recv_datagram(MAX_DISCONNECT_TIME, now()))
+            type, sn, data = split(datagram, self.sn_size)
             sn = decode_sn(sn)
 
             if type == ACK_TYPE:
                 logger.debug('[gbn:recv] ACK arrived, we expected DATA.')
                 continue
+            ts, data = split_timestamp(type, data)
 
             # If seq numbers dont't match we re-send the last ack
             if sn != self.sn_recv:
@@ -139,25 +228,35 @@ class GoBackNV1(GoBackNBase):
                     f'expected {self.sn_recv}). Re-sending '
                     f'last ackd SN ({self._get_prev(self.sn_recv)})...')
                 self._send_datagram(
-                    ACK_TYPE + encode_sn(self._get_prev(self.sn_recv)))
+                    self._ack(self._get_prev(self.sn_recv), self.ts_recent))
+                ack_pending, ack_since = 0, None
                 continue
 
             # If seq numbers match, we keep the data and continue
             logger.debug(
-                f'[gbn:recv] Good SN received. Data received: {data[:10]} - '
-                f'len {len(data)} -')
-            result.append(data)
-            total_recd += len(data)
+                f'[gbn:recv] Good SN received. Data received: '
+                f'{bytes(data[:10])} - len {len(data)} -')
+            self.output.write(data)
+            self.sn_recv = self._get_next(self.sn_recv)
+            # a delayed ACK echoes the first datagram it acks (RFC 7323)
+            if not ack_pending:
+                self.ts_recent = ts
+
+            ack_pending += 1
+            if ack_pending < self.ack_every and not self.output.full():
+                ack_since = ack_since or now()
+                continue
 
             logger.debug(
-                f'[gbn:recv] Sending ack ({self.sn_recv})...')
-            self._send_datagram(ACK_TYPE + encode_sn(self.sn_recv))
-            self.sn_recv = self._get_next(self.sn_recv)
+                f'[gbn:recv] Sending ack ({self._get_prev(self.sn_recv)})...')
+            self._send_datagram(
+                self._ack(self._get_prev(self.sn_recv), self.ts_recent))
+            ack_pending, ack_since = 0, None
 
-        result = b''.join(result)
+        result = self.output.get()
 
         logger.debug(f'[gbn:recv] Total data received: {result[:10]} '
-                     f'- len {len(data)} -')
+                     f'- len {len(result)} -')
         logger.debug('[gbn:recv] == FINISH RECEIVING ==')
 
         return result
@@ -1,9 +1,11 @@
 from time import perf_counter as now
 # Lib
-from lib.rdt_interface import (ACK_TYPE, MAX_DISCONNECT_TIME, split)
-from lib.go_back_n_base import encode_sn, decode_sn
+from lib.rdt_interface import (ACK_TYPE, FEC_TYPE, SACK_OPT, encode_options,
+                               split, split_timestamp)
+from lib.go_back_n_base import decode_sn
 from lib.go_back_n_v1 import GoBackNV1
 from lib.logger import logger
+from lib.socket_udp import SocketTimeout
 
 
 class GoBackNV2(GoBackNV1):
@@ -13,81 +15,132 @@ class GoBackNV2(GoBackNV1):
     Buffering added on the server side; when a package that is
     not expected is received (the sequence numbers do not match), then
     it is buffered until the needed package arrives to complete the
-    sequence.
+    sequence. The buffered datagrams are reported back with SACK blocks,
+    so the sender only has to re-transmit the holes.
+
+    The buffer outlives each recv call: datagrams of the next chunk of
+    a stream may arrive (and be acked) before that chunk is read.
+
+    With FEC enabled, a datagram rebuilt from the parity of its group
+    is handled as if it had arrived (see lib.fec).
     """
 
-    def _consume_buffer(self, result, buffer):
-        current = self.sn_recv
-        data_consumed = 0
-        while True:
-            data = buffer[current]
-            if data is None:
-                self.sn_recv = current
-                break
-            data_consumed += len(data)
-            result.append(data)
-            buffer[current] = None
-            current = (current + 1) % len(buffer)
-
-        return data_consumed
-
-    def recv(self, length):
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        # sn -> payload, for the datagrams within the window
+        self.recv_buffer = {}
+        return
+
+    def _sack_ack(self, buffer):
+        # [ACK, SN, options, SACK]: bit i of the bitmap is set when sn_recv + i
+        # is already buffered (trailing empty bytes are not sent)
+        size = 8 * ((self.n + 7) // 8)
+        bits = 0
+        for sn in buffer:
+            bits |= 1 << (size - 1 - (sn - self.sn_recv) % self.sn_space)
+
+        sack = bits.to_bytes(size // 8, "big").rstrip(b'\0')
+        return self._ack(self._get_prev(self.sn_recv), self.ts_recent) +\
+            encode_options({SACK_OPT: sack})
+
+    def _consume(self, data, buffer):
+        # data is the expected datagram, then the buffered ones follow
+        self.output.write(data)
+        self.sn_recv = self._get_next(self.sn_recv)
+        while (data := buffer.pop(self.sn_recv, None)) is not None:
+            self.output.write(data)
+            self.sn_recv = self._get_next(self.sn_recv)
+
+    def recv_steps(self, length):
         logger.debug('[gbn:recv] == START RECEIVING ==')
         logger.debug(f'[gbn:recv] Length: {length}')
 
-        result = []
-        total_recd = 0
+        self.output.start(length)
+        buffer = self.recv_buffer
+
+        # in order datagrams not acked yet (delayed ACKs)
+        ack_pending = 0
+        ack_since = None
 
-        buffer = [None for i in range(2 * self.n)]
+        while not self.output.full():
+            try:
+                datagram = yield self._recv_timeout(ack_since)
+            except SocketTimeout:
+                if ack_since is None:
+                    raise
+                logger.debug(
+                    f'[gbn:recv] Sending delayed ack '
+                    f'({self._get_prev(self.sn_recv)})...')
+                self._send_datagram(self._sack_ack(buffer))
+                ack_pending, ack_since = 0, None
+                continue
 
-        while total_recd < length:
-            type, sn, data = split(
-                self._recv_datagram(MAX_DISCONNECT_TIME, now()))
+            type, sn, data = split(datagram, self.sn_size)
             sn = decode_sn(sn)
 
             if type == ACK_TYPE:
                 logger.debug('[gbn:recv] ACK arrived, we expected DATA.')
                 continue
-
-            q, r = divmod(self.sn_recv + self.n, len(buffer))
-            valid_sn = (0 <= sn < q*r) or (self.sn_recv <= sn <
-                                           (self.sn_recv + self.n - q*r))
+            if type == FEC_TYPE:
+                if (recovered := self._recover(sn, data)) is None:
+                    continue
+                sn, data = recovered
+                ts = None
+                logger.debug(f'[gbn:recv] Rebuilt lost SN {sn} (FEC)')
+            else:
+                ts, data = split_timestamp(type, data)
 
             # If seq numbers dont't match we re-send the last ack
-            if not valid_sn:
+            if not self._in_window(sn, self.sn_recv):
                 logger.debug(
                     f'[gbn:recv] Wrong SN received ({sn}, '
                     f'expected {self.sn_recv}). Re-sending '
                     f'last ackd SN ({self._get_prev(self.sn_recv)})...')
-                self._send_datagram(
-                    ACK_TYPE + encode_sn(self._get_prev(self.sn_recv)))
+                self._send_datagram(self._sack_ack(buffer))
+                ack_pending, ack_since = 0, None
                 continue
 
-            buffer[sn] = data
+            if type != FEC_TYPE and sn not in buffer:
+                # new datagram (the rebuilt ones were added by the decoder)
+                self._fec_add(sn, data)
+
             if sn != self.sn_recv:
+                # copied, the datagram buffer is reused
+                buffer[sn] = bytes(data)
                 logger.debug(
                     f'[gbn:recv] Future SN received, buffering {sn} '
                     f'(expecting {self._get_prev(self.sn_recv)})')
-                self._send_datagram(
-                    ACK_TYPE + encode_sn(self._get_prev(self.sn_recv)))
+                self._send_datagram(self._sack_ack(buffer))
+                ack_pending, ack_since = 0, None
                 continue
 
             # sn == self.sn_recv -> We can use buffered data
-
-            total_recd += self._consume_buffer(result, buffer)
+            hole_filled = bool(buffer)
+            # out of order datagrams are not echoed, the one that fills
+            # the hole is (or the first one of a delayed ACK)
+            if ts is not None and (not ack_pending or hole_filled):
+                self.ts_recent = ts
+            self._consume(data, buffer)
             logger.debug(
                 '[gbn:recv] Good SN received. Consumed buffer, now'
                 f'expecting: {self.sn_recv}, before: {sn}')
 
+            # ACKs are only delayed while there are no holes
+            ack_pending += 1
+            if not hole_filled and ack_pending < self.ack_every and\
+                    not self.output.full():
+                ack_since = ack_since or now()
+                continue
+
             logger.debug(
                 f'[gbn:recv] Sending ack ({self._get_prev(self.sn_recv)})...')
-            self._send_datagram(
-                ACK_TYPE + encode_sn(self._get_prev(self.sn_recv)))
+            self._send_datagram(self._sack_ack(buffer))
+            ack_pending, ack_since = 0, None
 
-        result = b''.join(result)
+        result = self.output.get()
 
         logger.debug(f'[gbn:recv] Total data received: {result[:10]} '
-                     f'- len {len(data)} -')
+                     f'- len {len(result)} -')
         logger.debug('[gbn:recv] == FINISH RECEIVING ==')
 
         return result
@@ -0,0 +1,60 @@
+from operator import sub
+from threading import Thread
+from typing import Callable
+
+# Lib
+from lib.rdt_interface import Connection, RDTInterface, run_steps
+from lib.rdt_selection import create_rdt
+from lib.socket_udp import Socket
+import lib.protocol as prt
+
+MIN_RANGE_SIZE = 2**20  # 1 MB, smaller ranges are not worth a session
+
+
+def split_ranges(size: int, streams: int) -> 'list[tuple[int, int]]':
+    """
+    Splits a file in (start, length) ranges of about the same size, one
+    per stream (fewer if they would be smaller than MIN_RANGE_SIZE).
+    """
+    streams = max(1, min(streams, size // MIN_RANGE_SIZE))
+    bounds = [size * i // streams for i in range(streams + 1)]
+    return list(zip(bounds, map(sub, bounds[1:], bounds)))
+
+
+def open_session(addr: 'tuple[str, int]', pacing, rcvbuf: int,
+                 sndbuf: int, opcode: int) -> 'tuple[Socket, RDTInterface]':
+    """
+    New session with the server for a request (opcode), with its own
+    socket. Its RDT is the one negotiated with the server (see
+    lib.protocol.session_request).
+    """
+    skt = Socket(rcvbuf, sndbuf)
+    connection = Connection(skt, addr)
+    params = run_steps(prt.session_request(connection, opcode),
+                       connection.recv)
+    rdt = create_rdt(connection, connection.recv, params, pacing)
+    return skt, rdt
+
+
+def run_streams(target: Callable[[int, int], None],
+                ranges: 'list[tuple[int, int]]') -> None:
+    """
+    Runs target(start, length) for every range, each one in its own
+    thread, and waits for all of them. The first error is raised again.
+    """
+    errors = []
+
+    def run(start: int, length: int) -> None:
+        try:
+            target(start, length)
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [Thread(target=run, args=bounds, name=f'Stream:{i}')
+               for i, bounds in enumerate(ranges)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    if errors:
+        raise errors[0]
@@ -0,0 +1,71 @@
+from time import perf_counter as now, sleep
+from typing import Optional
+
+# Lib
+from lib.rtt_handler import RTTHandler
+
+PACING_GAIN = 1.25  # a bit faster than cwnd/RTT, so the window can grow
+PACING_BURST = 2  # datagrams that may be sent back-to-back
+
+
+class Pacer:
+    """
+    Token bucket pacer for the windowed RDTs.
+
+    Instead of sending a whole window in a burst, datagrams are spread
+    across the RTT. The rate (in bytes per second) is either fixed or,
+    when `rate` is None, computed from the congestion window and the
+    smoothed RTT (gain * cwnd / SRTT). Until the first RTT sample there
+    is no information to pace with, so datagrams are not delayed.
+    """
+
+    def __init__(self, rate: Optional[float] = None,
+                 burst: int = PACING_BURST,
+                 gain: float = PACING_GAIN) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.gain = gain
+        self.tokens = 0
+        self.last = None
+        return
+
+    def get_rate(self, window_bytes: int, rtt: RTTHandler) -> Optional[float]:
+        if self.rate is not None:
+            return self.rate
+        if not rtt.samples:
+            return None
+        return self.gain * window_bytes / rtt.mean_rtt
+
+    def wait(self, size: int, window_bytes: int, rtt: RTTHandler) -> None:
+        """
+        Blocks until `size` bytes can be sent.
+        """
+        rate = self.get_rate(window_bytes, rtt)
+        if rate is None or rate <= 0:
+            return
+
+        current = now()
+        if self.last is not None:
+            self.tokens = min(self.tokens + (current - self.last) * rate,
+                              self.burst * size)
+        self.last = current
+
+        if self.tokens < size:
+            sleep((size - self.tokens) / rate)
+            self.last = now()
+            self.tokens = size
+
+        self.tokens -= size
+        return
+
+
+def create_pacer(config: Optional[str]) -> Optional[Pacer]:
+    """
+    Creates a pacer from its config: '' (or None) disables pacing, 'rtt'
+    paces at cwnd/RTT and a number is taken as a fixed rate in bytes/s.
+    """
+    if not config:
+        return None
+    if config == 'rtt':
+        return Pacer()
+    return Pacer(float(config))
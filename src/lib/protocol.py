@@ -1,10 +1,24 @@
-from os import SEEK_END
-from typing import Optional
+from hashlib import blake2b
+from itertools import chain
+from os import SEEK_END, path
+from random import getrandbits
+from time import perf_counter as now
+from typing import Callable, Optional
 
 # Lib
+from lib.compression import (CODECS, FRAME_LEN_SIZE, NO_CODEC, SAMPLE_SIZE,
+                             choose_codec, compress_chunks)
+from lib.delta import (COPY, LITERAL, STRONG_SIZE, WEAK_SIZE, Signature,
+                       delta, file_signature, get_block_size)
+from lib.fec import valid_group_size
 from lib.progress import progress_bar
 from lib.logger import logger, FATAL_LEVEL
-from lib.rdt_interface import RDTInterface
+from lib.rdt_interface import (HELLO_TYPE, MAX_DATAGRAM_SIZE,
+                               MAX_DISCONNECT_TIME, SN_SIZE, TIMEOUT,
+                               TYPE_SIZE, RDTInterface, SendCallback, Steps)
+from lib.rdt_selection import (DEFAULT_RDT, FEC_GROUP, RDT_VARIANTS,
+                               RDT_VERSION, WINDOW_SIZE, supported_rdts)
+from lib.socket_udp import SocketTimeout
 
 # -----------------------------------------------------------------------------
 # constants
@@ -16,19 +30,84 @@ INT_ENCODING = 'big'
 UPLOAD_FILE_OP = 0
 DOWNLOAD_FILE_OP = 1
 LIST_FILES_OP = 2
+DELTA_UPLOAD_OP = 3
+DOWNLOAD_RANGE_OP = 4
+UPLOAD_RANGE_OP = 5
 
 # status codes
 NO_ERR = 0
 UNKNOWN_OP_ERR = 1
 FILE_NOT_FOUND_ERR = 2
+SERVER_BUSY_ERR = 3  # [STATUS, RETRY AFTER (secs)]
+UNSUPPORTED_ERR = 4  # nothing in common with the session offered (HELLO)
+TRANSFER_FAILED_ERR = 5  # another range of the upload failed
+
+# session opening (see session_request)
+PROTOCOL_VERSION = 1
+SUPPORTED_VERSIONS = 1 << PROTOCOL_VERSION  # (bit v: version v)
+NO_RDT = 0xff  # the client does not prefer any RDT
+# requests whose messages are small, a window is not worth it for them
+# (S&W is used unless an end prefers another RDT)
+SMALL_REQUESTS = (LIST_FILES_OP,)
 
 # sizes
 OPCODE_SIZE = 1
 STATUS_SIZE = 1
 INT_SIZE = 8
+CHECKSUM_SIZE = 16
+CODEC_SIZE = 1
 CHUNK_SIZE = 2**18  # 256 KB
 REQUEST_MSG_SIZE = 2**8  # 256 bytes
-MAX_STR_SIZE = REQUEST_MSG_SIZE - (INT_SIZE + OPCODE_SIZE)
+MAX_STR_SIZE = REQUEST_MSG_SIZE - \
+    (OPCODE_SIZE + 2 * INT_SIZE + CHECKSUM_SIZE + CODEC_SIZE)
+DOWNLOAD_RESPONSE_SIZE = STATUS_SIZE + 2 * INT_SIZE + CODEC_SIZE
+UPLOAD_RESPONSE_SIZE = STATUS_SIZE + INT_SIZE + CHECKSUM_SIZE + CODEC_SIZE
+LIST_RESPONSE_SIZE = STATUS_SIZE + INT_SIZE + CODEC_SIZE
+DELTA_RESPONSE_SIZE = STATUS_SIZE + 2 * INT_SIZE
+RANGE_RESPONSE_SIZE = STATUS_SIZE + 2 * INT_SIZE
+# response of every request (errors are padded to its size)
+RESPONSE_SIZES = {
+    UPLOAD_FILE_OP: UPLOAD_RESPONSE_SIZE,
+    DOWNLOAD_FILE_OP: DOWNLOAD_RESPONSE_SIZE,
+    LIST_FILES_OP: LIST_RESPONSE_SIZE,
+    DELTA_UPLOAD_OP: DELTA_RESPONSE_SIZE,
+    DOWNLOAD_RANGE_OP: RANGE_RESPONSE_SIZE,
+    UPLOAD_RANGE_OP: RANGE_RESPONSE_SIZE,
+}
+SIGNATURE_ENTRY_SIZE = WEAK_SIZE + STRONG_SIZE
+VERSION_SIZE = 1
+RDT_SIZE = 1
+LIMIT_SIZE = 4  # window and datagram size
+FEC_SIZE = 1
+# [HELLO, VERSIONS, RDTS, RDT, OPCODE, WINDOW, DATAGRAM SIZE, FEC], padded
+# so the reply is never bigger than the request (the server can not be
+# used to amplify a spoofed one)
+HELLO_SIZE = 2**6
+HELLO_REPLY_SIZE = TYPE_SIZE + STATUS_SIZE + VERSION_SIZE + RDT_SIZE + \
+    2 * LIMIT_SIZE + FEC_SIZE
+INSTRUCTION_SIZE = 1
+
+# Files being transferred are written with this suffix until completed,
+# so an interrupted transfer can be resumed from what was written
+PARTIAL_SUFFIX = '.part'
+
+
+def unique_partial(filename: str, transfer_id: Optional[int] = None) -> str:
+    """
+    Partial file of an upload that is not resumed (in ranges or delta):
+    one of its own for every transfer (a random one if no id is given),
+    so it is never taken for the one of a resumable upload.
+    """
+    if transfer_id is None:
+        transfer_id = getrandbits(8 * INT_SIZE)
+    return f'{filename}{PARTIAL_SUFFIX}.{transfer_id}'
+
+
+def is_partial(filename: str) -> bool:
+    """Whether it is the partial file of a transfer not completed."""
+    base, _, transfer_id = filename.rpartition('.')
+    return filename.endswith(PARTIAL_SUFFIX) or \
+        (base.endswith(PARTIAL_SUFFIX) and transfer_id.isdigit())
 
 # -----------------------------------------------------------------------------
 # encoders/decoders
@@ -81,43 +160,269 @@ def add_padding(bytes: bytearray, size: int) -> bytearray:
     return bytes + b'0'*(size - len(bytes))
 
 
+def checksum(f, size: int) -> bytes:
+    """
+    Checksum of the first `size` bytes of a file (the prefix that is
+    kept when a transfer is resumed).
+
+    Parameters:
+    f(FILE): The file.
+    size(int): Size of the prefix.
+
+    Returns:
+    checksum(bytes): CHECKSUM_SIZE bytes.
+    """
+    digest = blake2b(digest_size=CHECKSUM_SIZE)
+    view = memoryview(bytearray(min(CHUNK_SIZE, size)))
+    f.seek(0)
+    left = size
+    while left > 0:
+        read = f.readinto(view[:min(left, CHUNK_SIZE)])
+        if not read:
+            break
+        digest.update(view[:read])
+        left -= read
+    return digest.digest()
+
+
+def partial_prefix(filepath: str, max_size: Optional[int] = None
+                   ) -> 'tuple[int, bytes]':
+    """
+    Size and checksum of the partial file kept from an interrupted
+    transfer (nothing if there is none).
+
+    Parameters:
+    filepath(str): Path of the partial file.
+    [max_size(int)]: Only this many bytes of it are used.
+
+    Returns:
+    offset(int): Size of the partial file.
+    prefix_checksum(bytes): Its checksum.
+    """
+    if not path.isfile(filepath):
+        return 0, bytes(CHECKSUM_SIZE)
+    with open(filepath, 'rb') as f:
+        f.seek(0, SEEK_END)
+        size = f.tell()
+        if max_size is not None:
+            size = min(size, max_size)
+        return size, checksum(f, size)
+
+
+def resume_offset(f, offset: int, prefix_checksum: bytes) -> int:
+    """
+    Offset a transfer of the file can be resumed from: the given one if
+    the peer already has the same first `offset` bytes (according to
+    their checksum), otherwise 0.
+    """
+    f.seek(0, SEEK_END)
+    if not 0 < offset <= f.tell() or\
+            checksum(f, offset) != prefix_checksum:
+        return 0
+    return offset
+
+
+# -----------------------------------------------------------------------------
+# session opening
+#
+# Before its RDT runs, the client offers what it supports and its limits
+# (HELLO, re-transmitted until it is answered) and the server answers
+# with the settings of the session. Both ends create their RDT with
+# them, so they never have to be configured alike.
+
+
+def encode_session_request(opcode: int) -> bytearray:
+    """
+    HELLO of the client, offering the protocol versions and RDTs it
+    supports, the one it prefers (RDT_VERSION) and its limits.
+    """
+    rdt = RDT_VARIANTS[RDT_VERSION] if RDT_VERSION else NO_RDT
+    message = HELLO_TYPE + encode_short(SUPPORTED_VERSIONS) + \
+        encode_short(supported_rdts()) + encode_short(rdt) + \
+        encode_short(opcode) + \
+        WINDOW_SIZE.to_bytes(LIMIT_SIZE, INT_ENCODING) + \
+        MAX_DATAGRAM_SIZE.to_bytes(LIMIT_SIZE, INT_ENCODING) + \
+        encode_short(FEC_GROUP)
+    return add_padding(message, HELLO_SIZE)
+
+
+def decode_session_request(datagram: bytearray) -> Optional[dict]:
+    """
+    Offer of a client HELLO (None if the datagram is not one).
+    """
+    if len(datagram) < HELLO_SIZE or datagram[:TYPE_SIZE] != HELLO_TYPE:
+        return None
+    names = {id: name for name, id in RDT_VARIANTS.items()}
+    offer = {}
+    i = TYPE_SIZE
+    for field, size in (('versions', VERSION_SIZE), ('rdts', RDT_SIZE),
+                        ('rdt', RDT_SIZE), ('opcode', OPCODE_SIZE),
+                        ('window', LIMIT_SIZE),
+                        ('datagram_size', LIMIT_SIZE), ('fec', FEC_SIZE)):
+        offer[field] = decode_int(datagram[i:i + size])
+        i += size
+    offer['rdt'] = names.get(offer['rdt'])
+    return offer
+
+
+def negotiate(offer: dict) -> Optional[dict]:
+    """
+    Settings of a session, from the offer of its client and the ones of
+    the server (None if they have nothing in common):
+    - the newest protocol version both support.
+    - the RDT the client prefers, or else the one the server prefers, or
+      else S&W for SMALL_REQUESTS and DEFAULT_RDT for the rest (if both
+      support it).
+    - the smaller window and datagram size of both.
+    - the FEC of the client (only for gbn and sr, if valid).
+    """
+    versions = offer['versions'] & SUPPORTED_VERSIONS
+    rdts = offer['rdts'] & supported_rdts()
+    datagram_size = min(offer['datagram_size'], MAX_DATAGRAM_SIZE)
+    # (the HELLO itself must fit in a datagram)
+    if not versions or not rdts or datagram_size < HELLO_SIZE:
+        return None
+
+    default = 's&w' if offer['opcode'] in SMALL_REQUESTS else DEFAULT_RDT
+    rdt = next(name for name in (offer['rdt'], RDT_VERSION, default,
+                                 *RDT_VARIANTS)
+               if name is not None and rdts & 1 << RDT_VARIANTS[name])
+    fec = offer['fec']
+    if rdt not in ('gbn', 'sr') or \
+            not valid_group_size(fec, 2**(8 * SN_SIZE)):
+        fec = 0
+
+    return {
+        'version': versions.bit_length() - 1,
+        'rdt': rdt,
+        'window': max(1, min(offer['window'], WINDOW_SIZE)),
+        'datagram_size': datagram_size,
+        'fec': fec,
+    }
+
+
+def encode_session_response(params: Optional[dict]) -> bytearray:
+    """
+    Reply to a HELLO with the settings of the session (see negotiate),
+    or UNSUPPORTED_ERR if there are none.
+    """
+    if params is None:
+        return add_padding(HELLO_TYPE + encode_short(UNSUPPORTED_ERR),
+                           HELLO_REPLY_SIZE)
+    return HELLO_TYPE + encode_short(NO_ERR) + \
+        encode_short(params['version']) + \
+        encode_short(RDT_VARIANTS[params['rdt']]) + \
+        params['window'].to_bytes(LIMIT_SIZE, INT_ENCODING) + \
+        params['datagram_size'].to_bytes(LIMIT_SIZE, INT_ENCODING) + \
+        encode_short(params['fec'])
+
+
+def decode_session_response(reply: bytearray) -> dict:
+    check_status(reply[TYPE_SIZE:])
+    names = {id: name for name, id in RDT_VARIANTS.items()}
+    params = {}
+    i = TYPE_SIZE + STATUS_SIZE
+    for field, size in (('version', VERSION_SIZE), ('rdt', RDT_SIZE),
+                        ('window', LIMIT_SIZE),
+                        ('datagram_size', LIMIT_SIZE), ('fec', FEC_SIZE)):
+        params[field] = decode_int(reply[i:i + size])
+        i += size
+    if params['rdt'] not in names:
+        raise RuntimeError(get_error_msg(UNSUPPORTED_ERR))
+    params['rdt'] = names[params['rdt']]
+    return params
+
+
+def session_request(send: SendCallback, opcode: int) -> Steps:
+    """
+    Opens a session with the server for a request (client side). The
+    HELLO is re-transmitted, doubling the timeout, until the server
+    answers it (its reply also tells the client the CID of the session,
+    see lib.rdt_interface.Connection).
+
+    Parameters:
+    send(SendCallback): connection of the session.
+    opcode(int): request the session is for.
+
+    Returns:
+    params(dict): settings of the session (see negotiate).
+    """
+    hello = encode_session_request(opcode)
+    timeout = TIMEOUT
+    waited = 0
+    while True:
+        send(hello)
+        start = now()
+        try:
+            reply = yield timeout, start
+            while len(reply) < HELLO_REPLY_SIZE:
+                reply = yield timeout, start
+        except SocketTimeout:
+            waited += timeout
+            if waited >= MAX_DISCONNECT_TIME:
+                raise
+            timeout *= 2
+            continue
+        return decode_session_response(reply)
+
+
 # -----------------------------------------------------------------------------
 # wrappers
+#
+# They are RDT operations (generators of steps, see lib.rdt_interface):
+# clients run them with rdt.run(...), and the server handlers yield from
+# them so they can be driven by either server engine.
 
 
-def download_request(rdt: RDTInterface, filename: str) -> int:
+def download_request(rdt: RDTInterface, filename: str, offset: int = 0,
+                     prefix_checksum: bytes = bytes(CHECKSUM_SIZE),
+                     codecs: int = 0) -> Steps:
     """
     Send and validate a download request to the server.
 
     Parameters:
     rdt(RDTInterface): A reliable data transfer object.
     filename(str): namefile requested.
+    [offset(int)]: bytes of the file the client already has.
+    [prefix_checksum(bytes)]: checksum of those bytes.
+    [codecs(int)]: codecs the client accepts (see supported_codecs).
 
     Returns:
     filesize(int): size of the file to be downloaded.
+    offset(int): offset the file is sent from (0 if the bytes the client
+    has do not match the ones of the server).
+    codec(int): codec the file is compressed with.
     """
-    message = encode_short(DOWNLOAD_FILE_OP) + encode_filename(filename)
-    rdt.send(add_padding(message, REQUEST_MSG_SIZE))
+    message = encode_short(DOWNLOAD_FILE_OP) + encode_int(offset) + \
+        prefix_checksum + encode_short(codecs) + encode_filename(filename)
+    yield from rdt.send_steps(add_padding(message, REQUEST_MSG_SIZE))
 
-    response = rdt.recv(STATUS_SIZE + INT_SIZE)
-    status = decode_int(response[:STATUS_SIZE])
-    if status > 0:
-        raise RuntimeError(get_error_msg(status))
+    response = yield from rdt.recv_steps(DOWNLOAD_RESPONSE_SIZE)
+    check_status(response)
 
-    filesize = decode_int(response[STATUS_SIZE:])
-    return filesize
+    i = STATUS_SIZE
+    filesize = decode_int(response[i:i + INT_SIZE])
+    i += INT_SIZE
+    offset = decode_int(response[i:i + INT_SIZE])
+    i += INT_SIZE
+    codec = decode_int(response[i:i + CODEC_SIZE])
+    return filesize, offset, codec
 
 
-def download_response(rdt: RDTInterface, filesize: int) -> None:
+def download_response(rdt: RDTInterface, filesize: int,
+                      offset: int = 0, codec: int = NO_CODEC) -> Steps:
     """
-    Send file availability and filesize to a client.
+    Send file availability, filesize, the offset the file is sent from
+    and its codec to a client.
     """
-    message = encode_short(NO_ERR) + encode_int(filesize)
-    rdt.send(message)
+    message = encode_short(NO_ERR) + encode_int(filesize) + \
+        encode_int(offset) + encode_short(codec)
+    yield from rdt.send_steps(message)
     return
 
 
-def upload_request(rdt: RDTInterface, filename: str, filesize: int) -> None:
+def upload_request(rdt: RDTInterface, filename: str,
+                   filesize: int) -> Steps:
     """
     Send an upload request (with file information) to the server
     and validate the response.
@@ -128,41 +433,198 @@ def upload_request(rdt: RDTInterface, filename: str, filesize: int) -> None:
     filesize(int): size of the file to be uploaded.
 
     Returns:
-    None
+    offset(int): bytes of the file the server already has (from an
+    interrupted upload).
+    prefix_checksum(bytes): checksum of those bytes.
+    codecs(int): codecs the server accepts.
     """
     message = encode_short(UPLOAD_FILE_OP) + \
         encode_int(filesize) + encode_filename(filename)
-    rdt.send(add_padding(message, REQUEST_MSG_SIZE))
+    yield from rdt.send_steps(add_padding(message, REQUEST_MSG_SIZE))
 
-    status = decode_int(rdt.recv(STATUS_SIZE))
-    if status > 0:
-        raise RuntimeError(get_error_msg(status))
+    response = yield from rdt.recv_steps(UPLOAD_RESPONSE_SIZE)
+    check_status(response)
+
+    i = STATUS_SIZE
+    offset = decode_int(response[i:i + INT_SIZE])
+    i += INT_SIZE
+    prefix_checksum = bytes(response[i:i + CHECKSUM_SIZE])
+    i += CHECKSUM_SIZE
+    codecs = decode_int(response[i:i + CODEC_SIZE])
+    return offset, prefix_checksum, codecs
+
+
+def upload_response(rdt: RDTInterface, offset: int = 0,
+                    prefix_checksum: bytes = bytes(CHECKSUM_SIZE),
+                    codecs: int = 0) -> Steps:
+    """
+    All-good response for an upload request, with the bytes of the file
+    the server already has (and their checksum) and the codecs the
+    server accepts.
+    """
+    yield from rdt.send_steps(encode_short(NO_ERR) + encode_int(offset) +
+                              prefix_checksum + encode_short(codecs))
     return
 
 
-def upload_response(rdt: RDTInterface) -> None:
+def delta_upload_request(rdt: RDTInterface, filename: str,
+                         filesize: int) -> Steps:
+    """
+    Send a delta upload request to the server and receive the signature
+    of the file it has with that name (so only the differences with it
+    are sent, see send_delta).
+
+    Parameters:
+    rdt(RDTInterface): A reliable data transfer object.
+    filename(str): namefile requested.
+    filesize(int): size of the file to be uploaded.
+
+    Returns:
+    signature(Signature): checksums of the blocks of the file of the
+    server (no blocks if it does not have one).
+    """
+    message = encode_short(DELTA_UPLOAD_OP) + \
+        encode_int(filesize) + encode_filename(filename)
+    yield from rdt.send_steps(add_padding(message, REQUEST_MSG_SIZE))
+
+    response = yield from rdt.recv_steps(DELTA_RESPONSE_SIZE)
+    check_status(response)
+
+    i = STATUS_SIZE
+    signature = Signature(decode_int(response[i:i + INT_SIZE]))
+    i += INT_SIZE
+    blocks = decode_int(response[i:i + INT_SIZE])
+
+    per_chunk = CHUNK_SIZE // SIGNATURE_ENTRY_SIZE
+    while len(signature) < blocks:
+        entries = yield from rdt.recv_steps(
+            SIGNATURE_ENTRY_SIZE * min(per_chunk, blocks - len(signature)))
+        for i in range(0, len(entries), SIGNATURE_ENTRY_SIZE):
+            signature.add(
+                int.from_bytes(entries[i:i + WEAK_SIZE], 'little'),
+                bytes(entries[i + WEAK_SIZE:i + SIGNATURE_ENTRY_SIZE]))
+    return signature
+
+
+def delta_upload_response(rdt: RDTInterface, f=None) -> Steps:
     """
-    All-good response for an upload request.
+    All-good response for a delta upload request: the signature of the
+    file the server has (computed here, from the file opened in f).
+
+    Parameters:
+    rdt(RDTInterface): A reliable data transfer object.
+    [f(FILE)]: The old file (None if there is no file with that name).
+
+    Returns:
+    block_size(int): size of the blocks of the signature.
     """
-    rdt.send(encode_short(NO_ERR))
+    size = 0
+    if f is not None:
+        f.seek(0, SEEK_END)
+        size = f.tell()
+        f.seek(0)
+    block_size = get_block_size(size)
+
+    entries = bytearray()
+    if f is not None:
+        for weak, strong in file_signature(f, block_size, CHUNK_SIZE):
+            entries += weak.to_bytes(WEAK_SIZE, 'little') + strong
+    blocks = len(entries) // SIGNATURE_ENTRY_SIZE
+
+    header = encode_short(NO_ERR) + encode_int(block_size) + \
+        encode_int(blocks)
+    view = memoryview(entries)
+    yield from rdt.send_stream_steps(chain([header], (
+        view[i:i + CHUNK_SIZE] for i in range(0, len(view), CHUNK_SIZE))))
+    return block_size
+
+
+def download_range_request(rdt: RDTInterface, filename: str, start: int,
+                           length: int) -> Steps:
+    """
+    Send a request to download a range of a file (so a file can be
+    downloaded in several concurrent sessions) and validate the response.
+
+    Parameters:
+    rdt(RDTInterface): A reliable data transfer object.
+    filename(str): namefile requested.
+    start(int): offset of the first byte of the range.
+    length(int): size of the range (0 to only get the size of the file).
+
+    Returns:
+    filesize(int): size of the whole file.
+    length(int): size of the range that is sent (it is cut at the end of
+    the file).
+    """
+    message = encode_short(DOWNLOAD_RANGE_OP) + encode_int(start) + \
+        encode_int(length) + encode_filename(filename)
+    yield from rdt.send_steps(add_padding(message, REQUEST_MSG_SIZE))
+
+    response = yield from rdt.recv_steps(RANGE_RESPONSE_SIZE)
+    check_status(response)
+
+    i = STATUS_SIZE
+    filesize = decode_int(response[i:i + INT_SIZE])
+    i += INT_SIZE
+    length = decode_int(response[i:i + INT_SIZE])
+    return filesize, length
+
+
+def upload_range_request(rdt: RDTInterface, filename: str, filesize: int,
+                         start: int, length: int, transfer_id: int) -> Steps:
+    """
+    Send a request to upload a range of a file (see download_range_request)
+    and validate the response. The server puts the file together once
+    all the ranges of the transfer were received.
+
+    Parameters:
+    rdt(RDTInterface): A reliable data transfer object.
+    filename(str): namefile requested.
+    filesize(int): size of the whole file.
+    start(int): offset of the first byte of the range.
+    length(int): size of the range.
+    transfer_id(int): random id shared by the ranges of the same upload.
+
+    Returns:
+    None
+    """
+    message = encode_short(UPLOAD_RANGE_OP) + encode_int(filesize) + \
+        encode_int(start) + encode_int(length) + encode_int(transfer_id) + \
+        encode_filename(filename)
+    yield from rdt.send_steps(add_padding(message, REQUEST_MSG_SIZE))
+
+    response = yield from rdt.recv_steps(RANGE_RESPONSE_SIZE)
+    check_status(response)
     return
 
 
-def listfiles_request(rdt: RDTInterface) -> None:
+def range_response(rdt: RDTInterface, filesize: int, length: int) -> Steps:
+    """
+    All-good response for a range request, with the size of the file and
+    the one of the range.
+    """
+    yield from rdt.send_steps(encode_short(NO_ERR) + encode_int(filesize) +
+                              encode_int(length))
+    return
+
+
+def listfiles_request(rdt: RDTInterface, codecs: int = 0) -> Steps:
     """
     Send the list files request to the server.
 
     Parameters:
     rdt(RDTInterface)
+    [codecs(int)]: codecs the client accepts (see supported_codecs).
 
     Returns:
     None
     """
-    rdt.send(add_padding(encode_short(LIST_FILES_OP), REQUEST_MSG_SIZE))
+    yield from rdt.send_steps(add_padding(
+        encode_short(LIST_FILES_OP) + encode_short(codecs), REQUEST_MSG_SIZE))
     return
 
 
-def recv_request(rdt: RDTInterface) -> Optional[dict]:
+def recv_request(rdt: RDTInterface) -> Steps:
     """
     Receive the operation code and parameters.
 
@@ -174,26 +636,68 @@ def recv_request(rdt: RDTInterface) -> Optional[dict]:
     args(dict): In case of a known request, return a dictionary with necessary
     arguments. (Unknown requests will return the plain bytearray)
     """
-    request = rdt.recv(REQUEST_MSG_SIZE)
+    request = yield from rdt.recv_steps(REQUEST_MSG_SIZE)
     op_code = decode_int(request[:OPCODE_SIZE])
 
     args = {}
     if op_code == DOWNLOAD_FILE_OP:
-        args["filename"] = decode_filename(request[OPCODE_SIZE:])
-    elif op_code == UPLOAD_FILE_OP:
+        i = OPCODE_SIZE
+        args["offset"] = decode_int(request[i:i + INT_SIZE])
+        i += INT_SIZE
+        args["checksum"] = bytes(request[i:i + CHECKSUM_SIZE])
+        i += CHECKSUM_SIZE
+        args["codecs"] = decode_int(request[i:i + CODEC_SIZE])
+        i += CODEC_SIZE
+        args["filename"] = decode_filename(request[i:])
+    elif op_code in (UPLOAD_FILE_OP, DELTA_UPLOAD_OP):
         args["filesize"] = decode_int(
             request[OPCODE_SIZE:OPCODE_SIZE+INT_SIZE])
         args["filename"] = decode_filename(
             request[OPCODE_SIZE + INT_SIZE:])
+    elif op_code == DOWNLOAD_RANGE_OP:
+        i = OPCODE_SIZE
+        args["start"] = decode_int(request[i:i + INT_SIZE])
+        i += INT_SIZE
+        args["length"] = decode_int(request[i:i + INT_SIZE])
+        i += INT_SIZE
+        args["filename"] = decode_filename(request[i:])
+    elif op_code == UPLOAD_RANGE_OP:
+        i = OPCODE_SIZE
+        for arg in ("filesize", "start", "length", "transfer_id"):
+            args[arg] = decode_int(request[i:i + INT_SIZE])
+            i += INT_SIZE
+        args["filename"] = decode_filename(request[i:])
     elif op_code == LIST_FILES_OP:
-        pass
+        args["codecs"] = decode_int(
+            request[OPCODE_SIZE:OPCODE_SIZE + CODEC_SIZE])
     else:
         return op_code, request[OPCODE_SIZE:]
 
     return op_code, args
 
 
-def send_file(rdt: RDTInterface, f, progress: bool = False):
+def file_codec(f, offset: int, codecs: int) -> int:
+    """
+    Codec to send the file with, chosen by compressing a sample of its
+    first bytes (from the offset it is sent from).
+
+    Parameters:
+    f(FILE): The file.
+    offset(int): The file is sent from this offset.
+    codecs(int): codecs the peer accepts.
+
+    Returns:
+    codec(int): NO_CODEC if the file does not compress.
+    """
+    if not codecs:
+        return NO_CODEC
+    f.seek(offset)
+    return choose_codec(codecs, f.read(SAMPLE_SIZE))
+
+
+def send_file(rdt: RDTInterface, f, progress: bool = False,
+              offset: int = 0, send_header: bool = False,
+              codec: int = NO_CODEC, end: Optional[int] = None) -> Steps:
     """
     Send the file with binay format.
 
@@ -201,62 +705,219 @@ def send_file(rdt: RDTInterface, f, progress: bool = False):
     rdt(RDTInterface): .
     f(FILE): The file.
     [progress(bool)]: Flag for showing the progress bar.
+    [offset(int)]: The file is sent from this offset (resumed transfer).
+    [send_header(bool)]: Flag for sending the offset and the codec before
+    the file (when the peer does not know them yet, see recv_file_header).
+    [codec(int)]: The file is compressed with this codec.
+    [end(int)]: The file is sent up to this offset (a range of it).
 
     Returns:
     None
     """
     progress &= logger.level < FATAL_LEVEL
 
-    sent = 0
     f.seek(0, SEEK_END)
-    filesize = f.tell()
-    f.seek(0)
+    filesize = f.tell() if end is None else end
+    f.seek(offset)
+    # a chunk buffer can be reused once the RDT released its datagrams
+    buffers = -(-rdt.get_max_in_flight() // CHUNK_SIZE) + 2
+    chunks = read_chunks(f, filesize, progress, buffers, offset)
+    if codec != NO_CODEC:
+        chunks = compress_chunks(chunks, codec)
+    if send_header:
+        chunks = chain([encode_int(offset) + encode_short(codec)], chunks)
+    yield from rdt.send_stream_steps(chunks)
+
+    if progress:
+        print()
+
+
+def read_chunks(f, filesize: int, progress: bool = False,
+                buffers: int = 2, offset: int = 0):
+    """
+    Create an iterator to read a file chunk by chunk (so it can be sent
+    as a stream). Chunks are read into a ring of reused buffers, so a
+    chunk is only valid until `buffers - 1` more chunks are read.
+
+    Parameters:
+    f(FILE): The file.
+    filesize(int): Size of the file.
+    [progress(bool)]: Flag for showing the progress bar.
+    [buffers(int)]: Size of the ring of buffers.
+    [offset(int)]: Position of the file (the chunks start there).
+
+    Returns:
+    file_chunk(memoryview): A file chunk in binary format.
+    """
+    ring = [None] * buffers
+    sent = offset
+    i = 0
     if progress:
         progress_bar(sent, filesize)
-    chunk = f.read(CHUNK_SIZE)
-    last_chunk = False
-    while chunk:
-        if (sent + len(chunk)) >= filesize:
-            last_chunk = True
-
-        rdt.send(chunk, last_chunk)
-        sent += len(chunk)
+    while sent < filesize:
+        if ring[i] is None:
+            ring[i] = bytearray(min(CHUNK_SIZE, filesize - offset))
+        size = f.readinto(memoryview(ring[i])[:filesize - sent])
+        if not size:
+            break
+        yield memoryview(ring[i])[:size]
+        i = (i + 1) % buffers
+        sent += size
         if progress:
             progress_bar(sent, filesize)
-        chunk = f.read(CHUNK_SIZE)
 
-    if progress:
-        print()
 
+def recv_file_header(rdt: RDTInterface) -> Steps:
+    """
+    Receive the offset a file is sent from and its codec (see send_file).
+    """
+    header = yield from rdt.recv_steps(INT_SIZE + CODEC_SIZE)
+    return decode_int(header[:INT_SIZE]), decode_int(header[INT_SIZE:])
 
-def recv_file(rdt: RDTInterface, filesize: int, progress: bool = False):
+
+def recv_file(rdt: RDTInterface, filesize: int, write: Callable,
+              progress: bool = False, offset: int = 0,
+              codec: int = NO_CODEC) -> Steps:
     """
-    Create an iterator to recive a file.
+    Recive a file chunk by chunk.
 
     Parameters:
     rdt(RDTInterface): .
+    filesize(int): Size of the file.
+    write(Callable): Called with every file chunk (a bytearray).
     [progress(bool)]: Flag for showing the progress bar.
+    [offset(int)]: Offset the file is sent from (resumed transfer).
+    [codec(int)]: Codec the file is compressed with.
 
     Returns:
-    file_chunk(bytearray): A file chunk in binary format.
+    None
     """
     progress &= logger.level < FATAL_LEVEL
 
-    recd = 0
+    recd = offset
     if progress:
         progress_bar(recd, filesize, True)
-    while recd < filesize:
-        file_chunk = rdt.recv(min(filesize - recd, CHUNK_SIZE))
+
+    def write_chunk(file_chunk: bytearray) -> None:
+        nonlocal recd
+        write(file_chunk)
         recd += len(file_chunk)
         if progress:
             progress_bar(recd, filesize, True)
-        yield file_chunk
+
+    yield from _recv_chunks(rdt, filesize - offset, codec, write_chunk)
 
     if progress:
         print()
 
 
-def send_list(rdt: RDTInterface, list: list) -> None:
+def _recv_chunks(rdt: RDTInterface, size: int, codec: int,
+                 write: Callable) -> Steps:
+    # `size` bytes (once decompressed) chunk by chunk, a compressed
+    # stream is made of frames (see compress_chunks)
+    decompress = CODECS[codec].decompressor() if codec != NO_CODEC else None
+    recd = 0
+    while recd < size:
+        if decompress is None:
+            chunk = yield from rdt.recv_steps(min(size - recd, CHUNK_SIZE))
+        else:
+            length = decode_int(
+                (yield from rdt.recv_steps(FRAME_LEN_SIZE)))
+            chunk = decompress((yield from rdt.recv_steps(length)))
+        recd += len(chunk)
+        write(chunk)
+
+
+def send_delta(rdt: RDTInterface, f, signature: Signature,
+               progress: bool = False) -> Steps:
+    """
+    Send the instructions to rebuild the file from the one of the peer
+    (the one of the signature): [COPY, FIRST, COUNT] for runs of its
+    blocks and [LITERAL, LEN] + data for the bytes it does not have.
+    Instructions are packed together in chunks of up to CHUNK_SIZE.
+
+    Parameters:
+    rdt(RDTInterface): .
+    f(FILE): The file.
+    signature(Signature): Signature of the file of the peer.
+    [progress(bool)]: Flag for showing the progress bar.
+
+    Returns:
+    None
+    """
+    progress &= logger.level < FATAL_LEVEL
+
+    f.seek(0, SEEK_END)
+    filesize = f.tell()
+    f.seek(0)
+
+    def chunks():
+        chunk = bytearray()
+        if progress:
+            progress_bar(0, filesize)
+        for instruction in delta(f, signature):
+            if instruction[0] == COPY:
+                _, first, count = instruction
+                chunk += encode_short(COPY) + encode_int(first) + \
+                    encode_int(count)
+            else:
+                chunk += encode_short(LITERAL) + \
+                    encode_int(len(instruction[1])) + instruction[1]
+            if len(chunk) >= CHUNK_SIZE:
+                yield chunk
+                chunk = bytearray()
+                if progress:
+                    progress_bar(f.tell(), filesize)
+        if chunk:
+            yield chunk
+        if progress:
+            progress_bar(filesize, filesize)
+
+    yield from rdt.send_stream_steps(chunks())
+
+    if progress:
+        print()
+
+
+def recv_delta(rdt: RDTInterface, old, filesize: int, block_size: int,
+               write: Callable) -> Steps:
+    """
+    Receive a file sent with send_delta, rebuilt with the blocks of the
+    old one.
+
+    Parameters:
+    rdt(RDTInterface): .
+    old(FILE): The file of the signature (None if there was none).
+    filesize(int): Size of the file.
+    block_size(int): Size of the blocks of the signature.
+    write(Callable): Called with every file chunk.
+
+    Returns:
+    None
+    """
+    recd = 0
+    while recd < filesize:
+        instruction = decode_int(
+            (yield from rdt.recv_steps(INSTRUCTION_SIZE)))
+        if instruction == COPY:
+            args = yield from rdt.recv_steps(2 * INT_SIZE)
+            old.seek(decode_int(args[:INT_SIZE]) * block_size)
+            left = decode_int(args[INT_SIZE:]) * block_size
+            while left > 0:
+                chunk = old.read(min(left, CHUNK_SIZE))
+                left -= len(chunk)
+                recd += len(chunk)
+                write(chunk)
+        else:
+            left = decode_int((yield from rdt.recv_steps(INT_SIZE)))
+            while left > 0:
+                chunk = yield from rdt.recv_steps(min(left, CHUNK_SIZE))
+                left -= len(chunk)
+                recd += len(chunk)
+                write(chunk)
+
+
+def send_list(rdt: RDTInterface, list: list, codecs: int = 0) -> Steps:
     """
     Send the list of files information about the file with binary format.
 
@@ -264,24 +925,24 @@ def send_list(rdt: RDTInterface, list: list) -> None:
     skt(Socket):Socket.
     list(list(tuple)): List of information about the file [('filename', size,
                        last_mtime), ...]
+    [codecs(int)]: codecs the client accepts.
 
     Returns:
     None
     """
     bytes = ('\n'.join(map(str, list))).encode()
+    codec = choose_codec(codecs, bytes[:SAMPLE_SIZE])
 
-    rdt.send(encode_short(NO_ERR) + encode_int(len(bytes)))
-    chunks = [bytes[i:i+CHUNK_SIZE] for i in range(0, len(bytes), CHUNK_SIZE)]
-
-    last_chunk = False
-    for i, chunk in enumerate(chunks):
-        if i == len(chunks) - 1:
-            last_chunk = True
-
-        rdt.send(chunk, last_chunk)
+    header = encode_short(NO_ERR) + encode_int(len(bytes)) + \
+        encode_short(codec)
+    view = memoryview(bytes)
+    chunks = [view[i:i+CHUNK_SIZE] for i in range(0, len(view), CHUNK_SIZE)]
+    if codec != NO_CODEC:
+        chunks = compress_chunks(chunks, codec)
+    yield from rdt.send_stream_steps(chain([header], chunks))
 
 
-def recv_list(rdt: RDTInterface) -> list:
+def recv_list(rdt: RDTInterface) -> Steps:
     """
     Receives and return a list of files.
 
@@ -292,34 +953,80 @@ def recv_list(rdt: RDTInterface) -> list:
     list(list(tuple)): List of information about the file. [('filename', size,
                        last_mtime), ...]
     """
-    total_len = decode_int(rdt.recv(INT_SIZE))
+    response = yield from rdt.recv_steps(LIST_RESPONSE_SIZE)
+    check_status(response)
+    total_len = decode_int(response[STATUS_SIZE:STATUS_SIZE + INT_SIZE])
+    codec = decode_int(response[STATUS_SIZE + INT_SIZE:])
 
     chunks = []
-    recd = 0
-    while recd < total_len:
-        chunk = rdt.recv(min(total_len - recd, CHUNK_SIZE))
-        recd += len(chunk)
-        chunks.append(chunk.decode())
-
-    if chunks:
-        return list(map(eval, (''.join(chunks)).split('\n')))
+    yield from _recv_chunks(rdt, total_len, codec, chunks.append)
+    data = b''.join(chunks)
+    if data:
+        return list(map(eval, data.decode().split('\n')))
     return []
 
 # -----------------------------------------------------------------------------
 # error msgs
 
 
-def send_file_not_found(rdt: RDTInterface) -> None:
-    rdt.send(add_padding(encode_short(FILE_NOT_FOUND_ERR),
-                         STATUS_SIZE + INT_SIZE), True)
+def send_file_not_found(rdt: RDTInterface,
+                        size: int = DOWNLOAD_RESPONSE_SIZE) -> Steps:
+    yield from rdt.send_steps(
+        add_padding(encode_short(FILE_NOT_FOUND_ERR), size), True)
+    return
+
+
+def send_busy(rdt: RDTInterface, opcode: int, retry_after: int) -> Steps:
+    """
+    Tells the client the server can not take its request now, and the
+    seconds it should wait to try again.
+    """
+    yield from rdt.send_steps(add_padding(
+        encode_short(SERVER_BUSY_ERR) + encode_int(retry_after),
+        RESPONSE_SIZES[opcode]), True)
+    return
+
+
+def send_transfer_failed(rdt: RDTInterface) -> Steps:
+    """
+    Tells the client a range of its upload is not taken, as another one
+    of the same transfer failed (the file has to be uploaded again).
+    """
+    yield from rdt.send_steps(
+        add_padding(encode_short(TRANSFER_FAILED_ERR), RANGE_RESPONSE_SIZE),
+        True)
     return
 
 
-def send_unknown_error(rdt: RDTInterface) -> None:
-    rdt.send(add_padding(encode_short(UNKNOWN_OP_ERR), CHUNK_SIZE), True)
+def send_unknown_error(rdt: RDTInterface) -> Steps:
+    yield from rdt.send_steps(
+        add_padding(encode_short(UNKNOWN_OP_ERR), CHUNK_SIZE), True)
     return
 
 
+class ServerBusy(RuntimeError):
+    """
+    The server refused the request for being busy.
+    """
+
+    def __init__(self, retry_after: int) -> None:
+        self.retry_after = retry_after
+        super().__init__(f"{get_error_msg(SERVER_BUSY_ERR)} Reintentar en "
+                         f"{retry_after} segundos.")
+
+
+def check_status(response: bytearray) -> None:
+    """
+    Raises the error of a response whose status is not NO_ERR.
+    """
+    status = decode_int(response[:STATUS_SIZE])
+    if status == SERVER_BUSY_ERR:
+        raise ServerBusy(
+            decode_int(response[STATUS_SIZE:STATUS_SIZE + INT_SIZE]))
+    if status > 0:
+        raise RuntimeError(get_error_msg(status))
+
+
 def get_error_msg(err_code: int) -> str:
     """
     Receives the error code and return the related message.
@@ -334,6 +1041,12 @@ def get_error_msg(err_code: int) -> str:
         return "Opcode desconocido por el servidor."
     elif err_code == FILE_NOT_FOUND_ERR:
         return "El archivo no existe en el servidor."
+    elif err_code == SERVER_BUSY_ERR:
+        return "El servidor está ocupado."
+    elif err_code == UNSUPPORTED_ERR:
+        return "El servidor no soporta la versión del protocolo o el RDT."
+    elif err_code == TRANSFER_FAILED_ERR:
+        return "La subida falló en el servidor, hay que repetirla."
 
     return ""
 
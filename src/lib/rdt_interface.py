@@ -1,73 +1,361 @@
 from abc import abstractmethod
+from collections import deque
 from os import getenv
-from typing import Callable, Optional
+from secrets import randbits
+from time import perf_counter as now
+from typing import Callable, Generator, Iterable, Optional
 
 # Lib
-from lib.socket_udp import Socket
+from lib.socket_udp import RECV_BUFFER_SIZE, Socket, SocketTimeout
 
 # Typing
 
 
 class RecvCallback(Callable):
+    # the datagram is only valid until the next call (buffers are reused)
     def __call__(self, timeout: Optional[float],
                  start_time: Optional[float]) -> bytearray: ...
 
 
 class SendCallback(Callable):
-    def __call__(self, data: bytearray) -> int: ...
+    # the datagram may be given in parts (e.g. header and payload)
+    def __call__(self, *data: bytearray) -> int: ...
+
+    # optional, sends several datagrams (lists of parts) at once
+    def many(self, datagrams: list) -> int: ...
+
+
+# Operations of the RDTs (and of the protocol on top of them) are
+# generators of steps: every time they have to wait for a datagram they
+# yield (timeout, start_time), and they are resumed with the datagram
+# (valid until the next step) or with a SocketTimeout thrown into them.
+# This way the same state machines run blocking on a recv callback (see
+# RDTInterface.run) or driven by the events of a server event loop.
+Steps = Generator[tuple, bytearray, object]
 
 
 # Types
 ACK_TYPE = b'a'
 DATA_TYPE = b'd'
+TS_DATA_TYPE = b't'  # DATA with a timestamp after the SN
+FEC_TYPE = b'f'  # XOR parity of a group of DATA datagrams (see lib.fec)
+# opening of a session, before its RDT (see lib.protocol.session_request)
+HELLO_TYPE = b'h'
+
+# ACK options (appended after the SN as [KIND, LEN, VALUE])
+SACK_OPT = 1
+MAX_SIZE_OPT = 2  # max datagram size the receiver accepts
+TS_ECHO_OPT = 3  # timestamp of the DATA that triggered the ACK
+RECV_WINDOW_OPT = 4  # datagrams the receiver can take (flow control)
+CUM_ACK_OPT = 5  # last in order SN the receiver has (SR ACKs)
+
+# Connection IDs (CID): every datagram starts with the one of its session,
+# assigned by the server (see Connection)
+NO_CID = 0  # the client does not know it yet (its first datagrams)
+# the low byte tells the server socket that owns the session (its index
+# among the ones bound to the same port, plus 1: see lib.workers)
+CID_OWNER_BITS = 8
+MAX_CID_OWNERS = 2**CID_OWNER_BITS - 1
 
 # Sizes
+CID_SIZE = 4
 TYPE_SIZE = 1
 SN_SIZE = 1
-# Máx datagram size set by UDP is 65507 (2**16 - headers)
-MAX_DATAGRAM_SIZE = min(getenv("MAX_DATAGRAM_SIZE", 2**14), 65507)
-MAX_PAYLOAD_SIZE = MAX_DATAGRAM_SIZE - (TYPE_SIZE + SN_SIZE)
+WIDE_SN_SIZE = 4  # for windows that do not fit in SN_SIZE
+OPT_KIND_SIZE = 1
+OPT_LEN_SIZE = 2
+MAX_SIZE_OPT_SIZE = 4
+RECV_WINDOW_OPT_SIZE = 4
+TS_SIZE = 4  # microseconds (wraps every ~71 minutes)
+FEC_COUNT_SIZE = 1
+FEC_LEN_SIZE = 2
+# Máx datagram size set by UDP is 65507 (2**16 - headers), the one used
+# is negotiated per session (see DatagramSizer)
+MAX_DATAGRAM_SIZE = min(int(getenv("MAX_DATAGRAM_SIZE", 65507)), 65507)
+MAX_PAYLOAD_SIZE = MAX_DATAGRAM_SIZE - (CID_SIZE + TYPE_SIZE + SN_SIZE)
 assert MAX_PAYLOAD_SIZE > 0, "Invalid datagram size, must be smaller"
 
 # Timeouts
 TIMEOUT = 1  # secs (recommended start timeout by RFC 6298)
+MAX_RTO = 60  # secs (upper bound of the RTO and its backoff, RFC 6298)
 MAX_DISCONNECT_TIME = 30  # secs
 MAX_LAST_TIMEOUTS = 10
 DISCONNECT_TIMEOUTS = 50
+ACK_DELAY = 0.02  # secs (max time an ACK can be delayed)
 
 
-def split(datagram: bytearray) -> 'tuple[bytearray, bytearray, bytearray]':
+def split(datagram: bytearray,
+          sn_size: int = SN_SIZE) -> 'tuple[bytearray, bytearray, bytearray]':
     """
-    Splits the datagram according to the RDT protocol.
+    Splits the datagram according to the RDT protocol (in views of the
+    datagram, nothing is copied).
     """
 
+    datagram = memoryview(datagram)
     type = datagram[:TYPE_SIZE]
-    ack = datagram[TYPE_SIZE:TYPE_SIZE + SN_SIZE]
-    payload = datagram[TYPE_SIZE + SN_SIZE:]
+    ack = datagram[TYPE_SIZE:TYPE_SIZE + sn_size]
+    payload = datagram[TYPE_SIZE + sn_size:]
 
     return type, ack, payload
 
 
-def sendto_fixed_addr(skt: Socket, addr: tuple):
-    def send(data: bytearray):
-        return skt.sendto(data, addr)
+def encode_options(options: dict) -> bytearray:
+    """
+    Encodes the ACK options ({kind: value}) to be appended to an ACK.
+    """
+
+    return b''.join(kind.to_bytes(OPT_KIND_SIZE, "big") +
+                    len(value).to_bytes(OPT_LEN_SIZE, "big") + value
+                    for kind, value in options.items() if value)
+
+
+def decode_options(payload: bytearray) -> dict:
+    """
+    Decodes the options of an ACK payload. Unknown kinds are kept too,
+    so they can be safely ignored by the caller.
+    """
+
+    options = {}
+    i = 0
+    while i + OPT_KIND_SIZE + OPT_LEN_SIZE <= len(payload):
+        kind = int.from_bytes(payload[i:i + OPT_KIND_SIZE], "big")
+        i += OPT_KIND_SIZE
+        size = int.from_bytes(payload[i:i + OPT_LEN_SIZE], "big")
+        i += OPT_LEN_SIZE
+        options[kind] = payload[i:i + size]
+        i += size
+
+    return options
+
+
+def encode_max_size(size: int) -> bytearray:
+    return encode_options(
+        {MAX_SIZE_OPT: size.to_bytes(MAX_SIZE_OPT_SIZE, "big")})
+
 
-    return send
+def decode_max_size(options: dict) -> Optional[int]:
+    value = options.get(MAX_SIZE_OPT)
+    return int.from_bytes(value, "big") if value else None
 
 
-def recvfrom_fixed_addr(skt: Socket):
-    def recv(timeout: Optional[int] = None,
-             start_time: int = 0) -> bytearray:
-        return skt.recvfrom(MAX_DATAGRAM_SIZE, timeout, start_time)[0]
-    return recv
+def encode_recv_window(window: int) -> bytearray:
+    return encode_options(
+        {RECV_WINDOW_OPT: window.to_bytes(RECV_WINDOW_OPT_SIZE, "big")})
+
+
+def decode_recv_window(options: dict) -> Optional[int]:
+    value = options.get(RECV_WINDOW_OPT)
+    return int.from_bytes(value, "big") if value else None
+
+
+def timestamp() -> bytes:
+    return (int(now() * 10**6) % 2**(8 * TS_SIZE)).to_bytes(TS_SIZE, "big")
+
+
+def split_timestamp(type: bytearray, payload: bytearray
+                    ) -> 'tuple[Optional[bytes], bytearray]':
+    """
+    Splits the timestamp (if any) from a DATA payload. It is copied, as
+    it may have to be echoed after the datagram buffer is reused.
+    """
+
+    if type != TS_DATA_TYPE:
+        return None, payload
+    return bytes(payload[:TS_SIZE]), payload[TS_SIZE:]
+
+
+def decode_echo_rtt(options: dict) -> Optional[float]:
+    """
+    RTT sample from the timestamp echoed in an ACK (None if there is
+    no echo). The timestamp belongs to the exact transmission that was
+    acked, so re-transmitted datagrams give valid samples too.
+    """
+
+    value = options.get(TS_ECHO_OPT)
+    if not value:
+        return None
+    echo = int.from_bytes(value, "big")
+    return ((int(now() * 10**6) - echo) % 2**(8 * TS_SIZE)) / 10**6
+
+
+def decode_cid(datagram: bytearray) -> int:
+    return int.from_bytes(datagram[:CID_SIZE], "big")
+
+
+def new_cid(owner: int, used) -> int:
+    """
+    Random connection ID (so it can not be guessed from the other ones)
+    owned by the given server socket, not in use.
+    """
+    while True:
+        cid = randbits(8 * CID_SIZE - CID_OWNER_BITS) << CID_OWNER_BITS |\
+            (owner + 1)
+        if cid not in used:
+            return cid
+
+
+class Connection:
+    """
+    End of a session over a UDP socket, given to the RDT as its send
+    (and, for the clients, recv) callback. Every datagram of the RDT goes
+    after the connection ID (CID) of the session, so the server tells
+    the sessions apart by it instead of by their address: the port of a
+    finished session can be used again right away, and a client whose
+    address changes (e.g. a NAT rebinding) keeps its session.
+
+    The server assigns the CID in its reply to the opening of the session
+    (see lib.protocol.session_request). Until the client receives it, it
+    sends NO_CID (and it is told apart by its address).
+    """
+
+    def __init__(self, skt: Socket, addr: tuple, cid: int = NO_CID) -> None:
+        self.skt = skt
+        # where the datagrams are sent (the server moves it if the client
+        # shows up at another address)
+        self.addr = addr
+        self.set_cid(cid)
+        self.buffer = None
+        # datagrams received at once (GRO), returned before reusing the
+        # buffer
+        self.datagrams = deque()
+
+    def set_cid(self, cid: int) -> None:
+        self.cid = cid
+        self.header = cid.to_bytes(CID_SIZE, "big")
+
+    def __call__(self, *data: bytearray) -> int:
+        return self.skt.sendmsg((self.header, *data), self.addr)
+
+    def many(self, datagrams: list) -> int:
+        return self.skt.sendmmsg(
+            [(self.header, *datagram) for datagram in datagrams], self.addr)
+
+    def recv(self, timeout: Optional[int] = None,
+             start_time: int = 0) -> memoryview:
+        """
+        Next datagram of the session (client side). The CID of the first
+        HELLO is the CID of the session, datagrams with another one (of an
+        old session) are dropped, and so are the HELLOs after it (the
+        server answers every re-transmission of the opening).
+        """
+        if self.buffer is None:
+            self.buffer = bytearray(RECV_BUFFER_SIZE)
+        while True:
+            if not self.datagrams:
+                self.datagrams.extend(
+                    self.skt.recvmsg_into(self.buffer, timeout,
+                                          start_time)[0])
+            datagram = self.datagrams.popleft()
+            cid = decode_cid(datagram)
+            hello = datagram[CID_SIZE:CID_SIZE + TYPE_SIZE] == HELLO_TYPE
+            if self.cid == NO_CID and hello:
+                self.set_cid(cid)
+                return datagram[CID_SIZE:]
+            if cid == self.cid and not hello:
+                return datagram[CID_SIZE:]
+
+
+class RecvBuffer:
+    """
+    Destination of the payloads of a recv call. They are copied straight
+    into a bytearray of the requested length, and the bytes that do not
+    fit are kept for the next call.
+    """
+
+    def __init__(self) -> None:
+        self.data = bytearray()
+        self.size = 0
+        self.pending = deque()
+        return
+
+    def start(self, length: int) -> None:
+        self.data = bytearray(length)
+        self.size = 0
+        while self.pending and not self.full():
+            if (leftover := self._copy(self.pending.popleft())):
+                self.pending.appendleft(leftover)
+
+    def write(self, payload: bytearray) -> None:
+        if (leftover := self._copy(payload)):
+            self.pending.append(bytes(leftover))
+
+    def full(self) -> bool:
+        return self.size == len(self.data)
+
+    def get(self) -> bytearray:
+        data = self.data
+        self.data = bytearray()
+        return data
+
+    def _copy(self, payload: bytearray) -> bytearray:
+        size = min(len(payload), len(self.data) - self.size)
+        self.data[self.size:self.size + size] = payload[:size]
+        self.size += size
+        return payload[size:]
+
+
+def run_steps(steps: Steps, recv: RecvCallback):
+    """
+    Runs an operation (see Steps) until it is done, blocking on the recv
+    callback every time it waits for a datagram. Returns the result of
+    the operation.
+    """
+    try:
+        request = next(steps)
+        while True:
+            try:
+                datagram = recv(*request)
+            except SocketTimeout as e:
+                request = steps.throw(e)
+                continue
+            request = steps.send(datagram)
+    except StopIteration as e:
+        return e.value
 
 
 class RDTInterface:
 
+    def run(self, steps: Steps):
+        """
+        Runs an operation blocking on the recv callback of the RDT (see
+        run_steps).
+        """
+        return run_steps(steps, self._recv_datagram)
+
+    def send(self, data, last=False):
+        return self.run(self.send_steps(data, last))
+
+    def send_stream(self, chunks: Iterable, last=True):
+        return self.run(self.send_stream_steps(chunks, last))
+
+    def recv(self, length):
+        return self.run(self.recv_steps(length))
+
     @abstractmethod
-    def send(self, data):
+    def send_steps(self, data, last=False) -> Steps:
         pass
 
+    def send_stream_steps(self, chunks: Iterable, last=True) -> Steps:
+        """
+        Sends every chunk of the iterable, as if they were a single
+        message (the peer may read them with one recv per chunk).
+        Windowed RDTs override it to keep the window full across chunk
+        boundaries; by default every chunk is sent on its own.
+        """
+        chunks = iter(chunks)
+        chunk = next(chunks, None)
+        while chunk is not None:
+            next_chunk = next(chunks, None)
+            yield from self.send_steps(chunk, last and next_chunk is None)
+            chunk = next_chunk
+
+    def get_max_in_flight(self) -> int:
+        """
+        Bytes of a stream that may still be referenced by the RDT (sent
+        but not acked) when it asks send_stream for the next chunk.
+        """
+        return MAX_PAYLOAD_SIZE
+
     @abstractmethod
-    def recv(self, length, timeout):
+    def recv_steps(self, length) -> Steps:
         pass
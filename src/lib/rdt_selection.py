@@ -1,23 +1,81 @@
 from os import getenv
 # Lib
+from lib.congestion import create_congestion_controller
+from lib.datagram_size import DatagramSizer
 from lib.logger import logger
+from lib.pacing import create_pacer
 from lib.go_back_n_v1 import GoBackNV1
 from lib.go_back_n_v2 import GoBackNV2
+from lib.selective_repeat import SelectiveRepeat
 from lib.stop_and_wait import StopAndWait
 
-RDT_VERSION = getenv("RDT_VERSION", 'gbn')
+# RDT variants (ids go in a bitmask, see lib.protocol.session_request)
+RDT_VARIANTS = {
+    's&w': 0,
+    'gbn1': 1,
+    'gbn': 2,
+    'sr': 3,
+}
+DEFAULT_RDT = 'gbn'
+# Variant this end prefers (by default the server picks it for every
+# session, see lib.protocol.negotiate)
+RDT_VERSION = getenv("RDT_VERSION")
+if RDT_VERSION not in RDT_VARIANTS:
+    RDT_VERSION = None
+# Max window this end takes (the smaller one of both ends is used).
+# Windows bigger than 128 datagrams switch to 32-bit SNs
+WINDOW_SIZE = int(getenv("RDT_WINDOW_SIZE", 64))
+# Congestion control for the windowed RDTs: 'aimd', 'cubic' or 'none'
+CC_ALGORITHM = getenv("RDT_CC", 'aimd')
+# Pacing for the windowed RDTs: '' (disabled), 'rtt' or a rate in bytes/s
+PACING = getenv("RDT_PACING", '')
+# Delayed ACKs for the GBN receivers: ack every N in order datagrams
+# (1 acks every datagram)
+ACK_EVERY = int(getenv("RDT_DELAYED_ACK", 1))
+# Timestamps in DATA, echoed in the ACKs for RTT samples ('0' disables)
+TIMESTAMPS = getenv("RDT_TIMESTAMPS", '1') != '0'
+# FEC for gbn and sr: a XOR parity datagram every N DATA datagrams (a
+# power of 2 up to 128, '0' disables). The one of the client is used
+FEC_GROUP = int(getenv("RDT_FEC", 0))
 
 printed = False
 
 
-def create_rdt(send, recv):
+def supported_rdts() -> int:
+    """
+    Bitmask of the RDT variants this end can run.
+    """
+    return sum(1 << rdt for rdt in RDT_VARIANTS.values())
+
+
+def create_rdt(send, recv, params: dict, pacing=PACING, recv_window=None):
+    """
+    RDT of a session, with the settings negotiated for it (see
+    lib.protocol.negotiate).
+    """
     global printed
-    if RDT_VERSION == 'gbn1':
-        r = GoBackNV1(send, recv)
-    elif RDT_VERSION == 's&w':
-        r = StopAndWait(send, recv)
+    window = params['window']
+    cc = create_congestion_controller(CC_ALGORITHM, window)
+    pacer = create_pacer(pacing)
+    # the max datagram size of the peer is known from the start
+    sizer = DatagramSizer(params['datagram_size'])
+    sizer.set_peer_max(params['datagram_size'])
+    if params['rdt'] == 'gbn1':
+        r = GoBackNV1(send, recv, window, cc=cc, pacer=pacer,
+                      ack_every=ACK_EVERY, sizer=sizer,
+                      timestamps=TIMESTAMPS, recv_window=recv_window)
+    elif params['rdt'] == 's&w':
+        r = StopAndWait(send, recv, sizer=sizer, timestamps=TIMESTAMPS)
+    elif params['rdt'] == 'sr':
+        r = SelectiveRepeat(send, recv, window, cc=cc, pacer=pacer,
+                            sizer=sizer, timestamps=TIMESTAMPS,
+                            fec_group=params['fec'],
+                            recv_window=recv_window)
     else:
-        r = GoBackNV2(send, recv)
+        r = GoBackNV2(send, recv, window, cc=cc, pacer=pacer,
+                      ack_every=ACK_EVERY, sizer=sizer,
+                      timestamps=TIMESTAMPS, fec_group=params['fec'],
+                      recv_window=recv_window)
 
     if not printed:
         selected = r.__class__.__name__
@@ -1,87 +1,206 @@
-from threading import Thread
+from collections import deque
+from threading import Semaphore, Thread
 from time import perf_counter as now
+from typing import Optional
 
 # Lib
-from lib.socket_udp import Socket, SocketTimeout
-from lib.client_handler import ClientHandler
+from lib.socket_udp import (BufferPool, RECV_BUFFER_SIZE, Socket,
+                            SocketTimeout)
+from lib.client_handler import ClientHandler, session_params
 from lib.logger import logger
-from lib.rdt_interface import sendto_fixed_addr, MAX_DATAGRAM_SIZE
+from lib.rdt_interface import CID_SIZE, NO_CID, Connection, decode_cid, new_cid
+from lib.session_pool import (MAX_PENDING_SESSIONS, SESSION_WORKERS,
+                              SessionPool)
 from lib.stats import stats
 
 
 MAX_TIME_BLACKLIST = 60
 NEW_CONNECTION_MAX_WAIT = 0.5
+# refused sessions being answered at once (the clients beyond them are
+# ignored until they re-transmit their request)
+MAX_REFUSALS = 16
+
+
+class Blacklist:
+    """
+    Addresses of the sessions that ended before their client used its
+    CID: their datagrams without a CID are ignored for MAX_TIME_BLACKLIST
+    secs (late re-transmissions of the HELLO would start a new session
+    otherwise).
+
+    Every address is kept the same time, so they expire in the order
+    they were added: a FIFO of (time, address) tells the expired ones
+    without looking at the rest.
+    """
+
+    def __init__(self, ttl: float = MAX_TIME_BLACKLIST) -> None:
+        self.ttl = ttl
+        self.times = {}
+        self.order = deque()
+
+    def __contains__(self, addr) -> bool:
+        return addr in self.times
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def add(self, addr) -> None:
+        time = now()
+        self.times[addr] = time
+        self.order.append((time, addr))
+
+    def expire(self) -> None:
+        limit = now() - self.ttl
+        while self.order and self.order[0][0] < limit:
+            time, addr = self.order.popleft()
+            # unless it was added again since
+            if self.times.get(addr) == time:
+                del self.times[addr]
 
 
 class Receiver:
+    """
+    Server engine with a thread per client (see ClientHandler).
 
-    def __init__(self, skt: Socket):
+    Its loop reads every datagram and queues it in the handler of its
+    connection ID (CID). The ones without a CID open a session (a new
+    client, see lib.protocol.session_request).
+    """
+
+    def __init__(self, skt: Socket, sessions: int = SESSION_WORKERS,
+                 max_pending: int = MAX_PENDING_SESSIONS, owner: int = 0):
         self.th = Thread(target=self._run, name='Receiver')
         self.skt = skt
         self.receiving = True
-        self.clients: dict[tuple[str, int], ClientHandler] = {}
-        self.tmp_blacklist = {}
+        # index of the socket among the ones bound to the same port (the
+        # owner of the CIDs it assigns)
+        self.owner = owner
+        self.clients: dict[int, ClientHandler] = {}
+        # address -> CID of the sessions not confirmed yet
+        self.addrs: dict[tuple[str, int], int] = {}
+        self.tmp_blacklist = Blacklist()
+        # handlers whose session ended (appended by their threads)
+        self.finished = deque()
+        self.pool = BufferPool(RECV_BUFFER_SIZE)
+        self.sessions = SessionPool(sessions, max_pending)
+        self.refusals = Semaphore(MAX_REFUSALS)
         self.th.start()
 
-    def _demux(self, addr, data):
+    def _new_handler(self, addr, hello) -> Optional[ClientHandler]:
+        # Handler of a new client, None if it is ignored (not a session
+        # the server supports, or busy)
+        params = session_params(self.skt, addr, hello)
+        if params is None:
+            return None
+        cid = new_cid(self.owner, self.clients)
+        handler = ClientHandler(Connection(self.skt, addr, cid), params,
+                                self.pool, self.finished.append)
+        if not self.sessions.submit(handler):
+            if not self.refusals.acquire(blocking=False):
+                return None
+            handler.refuse(self.sessions.retry_after(), self.refusals)
+        self.clients[cid] = handler
+        self.addrs[addr] = cid
+        logger.debug(
+            f"[Receiver] {addr[0]}:{addr[1]} request assigned to "
+            f"{handler.name}.")
+        stats['requests']['total'] += 1
+        handler.greet()
+        return handler
+
+    def _demux(self, addr, datagrams, buffer):
         """
-        TODO: docs
+        Gives the datagrams (received at once in the buffer, from the
+        same client socket, so of the same session) to the ClientHandler
+        of their CID. The ones without a CID are HELLOs: the handler of
+        their address answers them again, or a new one is created (if it
+        is a new client). The handler gives the buffer back to the pool
+        once the last datagram is used (if that one is dropped because
+        the queue is full, the buffer is just left to the garbage
+        collector).
         """
-        if addr not in self.clients:
-            self.clients[addr] = ClientHandler(
-                sendto_fixed_addr(self.skt, addr), addr)
-            logger.debug(
-                f"[Receiver] {addr[0]}:{addr[1]} request assigned to "
-                f"ClientHandler:{self.clients[addr].id}.")
-            stats['requests']['total'] += 1
-
-        self.clients[addr].push(data)
+        cid = decode_cid(datagrams[0])
+        if cid == NO_CID:
+            handler = self.clients.get(self.addrs.get(addr))
+            if handler is not None:
+                handler.greet()
+            elif addr not in self.tmp_blacklist:
+                self._new_handler(addr, datagrams[0][CID_SIZE:])
+            self.pool.put(buffer)
+            return
+        if (handler := self.clients.get(cid)) is not None:
+            if not handler.confirmed:
+                handler.confirmed = True
+                self.addrs.pop(handler.addr, None)
+            if addr != handler.addr:
+                handler.migrate(addr)
+
+        if handler is None:
+            # of a finished session
+            self.pool.put(buffer)
+            return
+        for data in datagrams[:-1]:
+            handler.push(data[CID_SIZE:])
+        handler.push(datagrams[-1][CID_SIZE:], buffer)
         return
 
     def _run(self):
         try:
             while self.receiving:
                 try:
-                    data, addr = self.skt.recvfrom(
-                        MAX_DATAGRAM_SIZE, NEW_CONNECTION_MAX_WAIT, now())
-
-                    if addr in self.tmp_blacklist and\
-                            self._check_blacklist_time(addr):
-                        continue
-
+                    # every datagram already queued is read at once
+                    batch = self.skt.recvmany(
+                        self.pool, NEW_CONNECTION_MAX_WAIT, now())
+                except SocketTimeout:
+                    batch = []
+                except OSError:
+                    # the socket was closed while waiting
+                    if self.receiving:
+                        raise
+                    batch = []
+
+                for datagrams, addr, buffer in batch:
                     if not addr:
                         logger.debug("[Receiver] Stopped.")
+                        self.receiving = False
                         break
 
-                    self._demux(addr, data)
-                except SocketTimeout:
-                    pass
+                    self._demux(addr, datagrams, buffer)
 
-                self._join_handlers()
+                self._reap()
 
             logger.debug("[Receiver] Joining handlers...")
-            self._join_handlers(True)
+            self._join_handlers()
+            self.sessions.stop()
         except BaseException:
             logger.exception("Unexpected error during execution:")
         return
 
-    def _check_blacklist_time(self, addr):
-        if now() - self.tmp_blacklist[addr] <= MAX_TIME_BLACKLIST:
-            return True
-        self.tmp_blacklist.pop(addr)
-        return False
-
-    def _join_handlers(self, force=False):
-        active_handlers = {}
-
-        for addr, handler in self.clients.items():
-            if force or handler.is_done():
-                self.tmp_blacklist[addr] = now()
-                handler.join(force)
-                continue
-            active_handlers[addr] = handler
-
-        self.clients = active_handlers
+    def _reap(self):
+        # Forgets the handlers that finished since the last call (they
+        # notify it, so the live ones are never scanned) and the
+        # addresses whose blacklist time is over
+        while self.finished:
+            handler = self.finished.popleft()
+            self.clients.pop(handler.cid, None)
+            if not handler.confirmed:
+                self.addrs.pop(handler.addr, None)
+                self.tmp_blacklist.add(handler.addr)
+            handler.join()
+        self.tmp_blacklist.expire()
+
+    def _join_handlers(self):
+        # Stops every handler left (once the socket is closed)
+        for handler in self.clients.values():
+            handler.join(True)
+        self.clients = {}
+        self.addrs = {}
+        self.finished.clear()
+
+    def get_stats(self) -> dict:
+        # the kernel drops are only known along with a datagram otherwise
+        self.skt.update_drops()
+        return stats
 
     def stop(self, force=False):
         logger.debug('[Receiver] Stopping...')
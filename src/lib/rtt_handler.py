@@ -1,29 +1,56 @@
 # Lib
-from lib.rdt_interface import TIMEOUT
+from lib.rdt_interface import MAX_RTO, TIMEOUT
 
 ALPHA = 1/8
 BETA = 1/4
+K = 4
+CLOCK_GRANULARITY = 0.001  # secs
 
 
 class RTTHandler:
+    """
+    Retransmission timeout estimation (RFC 6298).
 
-    def __init__(self, initial=TIMEOUT) -> None:
-        self.initial_timeout = initial
+    Samples of re-transmitted datagrams are ambiguous and must not be
+    added unless they come from an echoed timestamp (Karn's rule). The
+    timeout backed off by timed_out is kept until a new sample arrives.
+
+    Both the computed and the backed off timeout are bounded by
+    max_timeout (60 s). Unlike RFC 6298 there is no 1 s floor (only
+    min_timeout, 0 by default): the transfers run mostly on paths of a
+    few ms, where such a floor would stall every loss for a whole second.
+    """
+
+    def __init__(self, initial=TIMEOUT, min_timeout=0,
+                 max_timeout=MAX_RTO) -> None:
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
         self.timeout = initial
-        self.mean_rtt = initial
-        self.std_rtt = BETA * initial
+        self.mean_rtt = initial  # SRTT
+        self.std_rtt = initial / 2  # RTTVAR
+        self.samples = 0
         return
 
     def get_timeout(self) -> float:
         return self.timeout
 
     def add_sample(self, sample: float) -> None:
-        self.mean_rtt = (1 - ALPHA) * self.mean_rtt + ALPHA * sample
-        self.std_rtt = (1 - BETA) * self.std_rtt + BETA * sample
-        self.timeout = min(self.initial_timeout,
-                           self.mean_rtt + 4 * self.std_rtt)
+        if not self.samples:
+            # the first sample replaces the initial guess
+            self.mean_rtt = sample
+            self.std_rtt = sample / 2
+        else:
+            # the deviation is updated with the SRTT before the sample
+            self.std_rtt = (1 - BETA) * self.std_rtt +\
+                BETA * abs(self.mean_rtt - sample)
+            self.mean_rtt = (1 - ALPHA) * self.mean_rtt + ALPHA * sample
+        self.samples += 1
+        self.timeout = max(self.min_timeout,
+                           min(self.max_timeout,
+                               self.mean_rtt + max(CLOCK_GRANULARITY,
+                                                   K * self.std_rtt)))
         return
 
     def timed_out(self):
-        self.timeout = min(self.initial_timeout, self.timeout * 2)
+        self.timeout = min(self.max_timeout, self.timeout * 2)
         return
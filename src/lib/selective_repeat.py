@@ -0,0 +1,260 @@
+from heapq import heappop, heappush
+from time import perf_counter as now
+
+# Lib
+from lib.rdt_interface import (
+    ACK_TYPE, CUM_ACK_OPT, DISCONNECT_TIMEOUTS, FEC_TYPE,
+    MAX_DISCONNECT_TIME, MAX_LAST_TIMEOUTS, decode_options, encode_options,
+    split, split_timestamp)
+from lib.go_back_n_base import DatagramWindow, decode_sn, encode_sn
+from lib.go_back_n_v2 import GoBackNV2
+from lib.logger import logger
+from lib.socket_udp import SocketTimeout
+
+# ACKs of datagrams sent after one that tell it was lost (as in TCP)
+DUP_ACKS = 3
+
+
+class SelectiveRepeat(GoBackNV2):
+    """
+    Selective Repeat Implementation
+
+    Every datagram has its own retransmission timer and is acknowledged
+    on its own; when a datagram is lost, only that datagram is
+    re-transmitted (instead of the whole window). The receiver buffers
+    out of order datagrams the same way GoBackNV2 does.
+
+    A datagram is re-sent before its timer expires once DUP_ACKS of the
+    ones sent after it were acked (fast re-transmit). A burst of losses
+    is a single loss episode: the congestion window is reduced and the
+    RTO backed off once for it, not for every datagram lost.
+    """
+
+    def _ack(self, sn, ts=None):
+        # [ACK, SN, options, CUM]: every ACK also tells the last in order
+        # SN received, so the datagrams whose own ACK was lost are acked
+        return super()._ack(sn, ts) + encode_options(
+            {CUM_ACK_OPT: encode_sn(self._get_prev(self.sn_recv),
+                                    self.sn_size)})
+
+    def _get_cum_pn(self, options):
+        # last pn the receiver has in order (base - 1 if not told)
+        cum = options.get(CUM_ACK_OPT)
+        if cum is None:
+            return self.base_pn - 1
+        return self._get_pn(decode_sn(cum))
+
+    def _ack_old_datagram(self, sn, ts=None):
+        # Datagrams from the previous window were already delivered, but
+        # their acks could have been lost, so we have to ack them again.
+        if self._in_window(sn, self.sn_recv - self.n):
+            self._send_datagram(self._ack(sn, ts))
+
+    def _retransmit(self, window, pn, timers, retransmitted):
+        self._send_paced(window[pn])
+        del timers[pn]
+        timers[pn] = now()
+        retransmitted.add(pn)
+
+    def send_stream_steps(self, chunks, last_chunk=True):
+        logger.debug('[sr:send] == START SENDING ==')
+
+        timeouts = 0
+        base = 0
+        next_pn = 0
+        self.base_pn = base
+        window = DatagramWindow(self._create_datagrams(chunks))
+        acked = set()
+
+        # pn -> time it was (re)sent, ordered from the oldest timer
+        timers = {}
+        retransmitted = set()
+        # after an ACK, the ones already received are read before
+        # sending, so the new datagrams are sent in a single batch
+        draining = False
+        # the DUP_ACKS highest pns acked (min heap): the datagrams before
+        # the lowest of them are lost (fast re-transmit), the ones before
+        # lost_scan were already checked
+        top_acked = []
+        lost_scan = 0
+        # time of the last reaction to a loss, the datagrams (re)sent
+        # before it belong to the same loss episode
+        recovery = None
+
+        while not window.finished(base):
+
+            if not draining:
+                wnd_end = window.fill(base + self._window())
+                parities = []
+                for pn in range(next_pn, wnd_end):
+                    self._add_parity(window[pn], parities)
+                self._flush_parity(window, wnd_end, parities)
+                self._send_all([window[pn] for pn in range(next_pn, wnd_end)],
+                               parities)
+                for pn in range(next_pn, wnd_end):
+                    timers[pn] = now()
+
+                if next_pn < wnd_end:
+                    logger.debug(
+                        f'[sr:send] Sending new data {next_pn} to {wnd_end} '
+                        f'[{self._get_sn(next_pn)}, {self._get_sn(wnd_end)}]')
+                    next_pn = wnd_end
+
+                oldest = next(iter(timers))
+
+            try:
+                datagram_recd = yield (
+                    (0, now()) if draining
+                    else (self.rtt.get_timeout(), timers[oldest]))
+                type, sn, data = split(datagram_recd, self.sn_size)
+                sn = decode_sn(sn)
+            except SocketTimeout:
+                if draining:
+                    draining = False
+                    continue
+                self.sizer.on_loss(self._get_size(window[oldest]))
+                if recovery is None or timers[oldest] >= recovery:
+                    self.rtt.timed_out()
+                    self.cc.on_timeout()
+                    recovery = now()
+                    timeouts += 1
+                    if timeouts >= DISCONNECT_TIMEOUTS:
+                        raise SocketTimeout()
+                    if last_chunk and window.finished(next_pn) and\
+                            timeouts >= MAX_LAST_TIMEOUTS:
+                        logger.warn('Client request assumed to have been '
+                                    'fulfilled (timeouts limit has been '
+                                    'reached while waiting for ACK).')
+                        base = next_pn
+                        break
+
+                logger.debug(
+                    f'[sr:send] Timed out. Resending pn {oldest} '
+                    f'(sn: {self._get_sn(oldest)})...')
+                self._retransmit(window, oldest, timers, retransmitted)
+                continue
+
+            if type != ACK_TYPE:
+                self._ack_old_datagram(sn)
+                continue
+
+            # got ack, the datagrams up to the cumulative SN are acked
+            # too (their own ACKs may have been lost)
+            pn = self._get_pn(sn)
+            options = decode_options(data)
+            newly_acked = [i for i in range(
+                base, min(self._get_cum_pn(options) + 1, next_pn))
+                if i in timers and i != pn]
+            if pn in timers:
+                start = timers.pop(pn)
+                self._add_rtt_sample(
+                    options, start if pn not in retransmitted else None)
+                newly_acked.append(pn)
+                heappush(top_acked, pn)
+            if not newly_acked:
+                logger.debug(f'[sr:send] Duplicated ack sn: {sn}')
+                continue
+
+            self._update_peer_limits(options)
+            for i in newly_acked:
+                timers.pop(i, None)
+                self.sizer.on_ack(self._get_size(window[i]))
+                acked.add(i)
+                retransmitted.discard(i)
+            draining = True
+            timeouts = 0
+            self.cc.on_ack(len(newly_acked))
+
+            logger.debug(
+                f'[sr:send] Got ack sn: {sn} and pn: {pn} (base: {base})')
+
+            if len(top_acked) > DUP_ACKS:
+                heappop(top_acked)
+            if len(top_acked) == DUP_ACKS and top_acked[0] > lost_scan:
+                for lost in range(max(lost_scan, base), top_acked[0]):
+                    if lost not in timers or lost in retransmitted:
+                        continue
+                    self.sizer.on_loss(self._get_size(window[lost]))
+                    if recovery is None or timers[lost] >= recovery:
+                        self.cc.on_dup_acks()
+                        recovery = now()
+                    logger.debug(
+                        f'[sr:send] Fast re-transmit of pn {lost} '
+                        f'(sn: {self._get_sn(lost)})...')
+                    self._retransmit(window, lost, timers, retransmitted)
+                lost_scan = top_acked[0]
+
+            if base in acked:
+                start = base
+                while base in acked:
+                    acked.remove(base)
+                    base += 1
+                window.release(start, base)
+                self.base_pn = base
+
+        self.sn_send = self._get_sn(base)
+
+        logger.debug(f'[sr:send] Datagram count: {window.end}')
+        logger.debug('[sr:send] == FINISH SENDING ==')
+        return
+
+    def recv_steps(self, length):
+        logger.debug('[sr:recv] == START RECEIVING ==')
+        logger.debug(f'[sr:recv] Length: {length}')
+
+        self.output.start(length)
+        buffer = self.recv_buffer
+
+        while not self.output.full():
+            type, sn, data = split(
+                (yield MAX_DISCONNECT_TIME, now()), self.sn_size)
+            sn = decode_sn(sn)
+
+            if type == ACK_TYPE:
+                logger.debug('[sr:recv] ACK arrived, we expected DATA.')
+                continue
+            if type == FEC_TYPE:
+                if (recovered := self._recover(sn, data)) is None:
+                    continue
+                sn, data = recovered
+                ts = None
+                logger.debug(f'[sr:recv] Rebuilt lost SN {sn} (FEC)')
+            else:
+                # every datagram is acked on its own, echoing its timestamp
+                ts, data = split_timestamp(type, data)
+
+            if not self._in_window(sn, self.sn_recv):
+                logger.debug(
+                    f'[sr:recv] Old SN received ({sn}, expected '
+                    f'{self.sn_recv}). Re-sending its ack...')
+                self._ack_old_datagram(sn, ts)
+                continue
+
+            if sn not in buffer:
+                if type != FEC_TYPE:
+                    # (the rebuilt ones were added by the decoder)
+                    self._fec_add(sn, data)
+
+                if sn != self.sn_recv:
+                    # copied, the datagram buffer is reused
+                    buffer[sn] = bytes(data)
+                    logger.debug(
+                        f'[sr:recv] Future SN received, buffering {sn} '
+                        f'(expecting {self.sn_recv})')
+                else:
+                    self._consume(data, buffer)
+                    logger.debug(
+                        '[sr:recv] Good SN received. Consumed buffer, now '
+                        f'expecting: {self.sn_recv}, before: {sn}')
+
+            # (once consumed, so the cumulative SN of the ACK includes it)
+            logger.debug(f'[sr:recv] Sending ack ({sn})...')
+            self._send_datagram(self._ack(sn, ts))
+
+        result = self.output.get()
+
+        logger.debug(f'[sr:recv] Total data received: {result[:10]} '
+                     f'- len {len(result)} -')
+        logger.debug('[sr:recv] == FINISH RECEIVING ==')
+
+        return result
@@ -0,0 +1,113 @@
+from collections import deque
+from math import ceil
+from threading import Condition, Thread
+from time import perf_counter as now
+
+# Lib
+from lib.logger import logger
+from lib.stats import stats
+
+SESSION_WORKERS = 64
+MAX_PENDING_SESSIONS = 256
+# weight of the last session in the mean duration (for the retry after)
+DURATION_GAIN = 0.125
+INITIAL_DURATION = 1  # secs
+
+
+class SessionPool:
+    """
+    Fixed set of threads that run the sessions (ClientHandler.run), so a
+    burst of clients does not start a thread for each one of them.
+
+    Sessions wait in a queue while every thread is busy, up to
+    max_pending of them (besides the ones an idle thread is about to
+    take): the ones beyond that are not admitted (see submit), so the
+    server keeps serving the ones it has at full speed instead of
+    slowing down all of them.
+    """
+
+    def __init__(self, workers: int = SESSION_WORKERS,
+                 max_pending: int = MAX_PENDING_SESSIONS) -> None:
+        self.workers = workers
+        self.max_pending = max_pending
+        self.cv = Condition()
+        self.pending = deque()
+        self.busy = 0
+        self.running = True
+        # mean duration of the sessions (to tell when to retry)
+        self.duration = INITIAL_DURATION
+        stats['sessions']['workers'] += workers
+        self.threads = [Thread(target=self._work, name=f'SessionWorker:{i}')
+                        for i in range(workers)]
+        for th in self.threads:
+            th.start()
+
+    def _update_stats(self) -> None:
+        # (called with the lock held)
+        sessions = stats['sessions']
+        sessions['busy'] = self.busy
+        sessions['pending'] = len(self.pending)
+        sessions['max-busy'] = max(sessions['max-busy'], self.busy)
+        sessions['max-pending'] = max(sessions['max-pending'],
+                                      len(self.pending))
+
+    def submit(self, session) -> bool:
+        """
+        Queues a session to be run by the first free thread.
+
+        Returns:
+        Whether it was admitted (False if every thread is busy and the
+        queue is full).
+        """
+        with self.cv:
+            # the queued sessions that an idle thread did not take yet
+            # are not waiting for a busy one
+            idle = self.workers - self.busy
+            if len(self.pending) >= self.max_pending + idle:
+                stats['sessions']['refused'] += 1
+                return False
+            self.pending.append(session)
+            self._update_stats()
+            self.cv.notify()
+        return True
+
+    def retry_after(self) -> int:
+        """
+        Seconds a refused client should wait before trying again: about
+        the time the sessions queued now take to start.
+        """
+        with self.cv:
+            waves = len(self.pending) / self.workers + 1
+        return max(1, ceil(waves * self.duration))
+
+    def _work(self) -> None:
+        while True:
+            with self.cv:
+                while self.running and not self.pending:
+                    self.cv.wait()
+                # pending sessions are still run once stopped (they end
+                # right away if they were stopped too)
+                if not self.pending:
+                    return
+                session = self.pending.popleft()
+                self.busy += 1
+                self._update_stats()
+
+            start = now()
+            try:
+                session.run()
+            except BaseException:
+                logger.exception("Unexpected error during execution:")
+
+            with self.cv:
+                self.busy -= 1
+                self.duration += DURATION_GAIN * \
+                    (now() - start - self.duration)
+                self._update_stats()
+
+    def stop(self) -> None:
+        with self.cv:
+            self.running = False
+            self.cv.notify_all()
+        for th in self.threads:
+            th.join()
@@ -1,26 +1,182 @@
-from socket import (SOL_SOCKET, SO_REUSEADDR, socket,
-                    AF_INET, SOCK_DGRAM, SHUT_RDWR, timeout)
+from collections import deque
+from ctypes import addressof, create_string_buffer
+from os import fstat
+from socket import (CMSG_SPACE, IPPROTO_UDP, SOL_SOCKET, SO_RCVBUF,
+                    SO_REUSEADDR, SO_REUSEPORT, SO_SNDBUF, socket, AF_INET,
+                    SOCK_DGRAM, SHUT_RDWR, timeout)
+import socket as sockets
+import select
+from struct import pack, unpack
 from time import perf_counter as now
+from typing import Optional
 
 # Lib
+from lib.logger import logger
 from lib.stats import stats
 
 # Exceptions
 SocketTimeout = timeout
 
+MAX_POOL_BUFFERS = 256
+
+# Linux UDP GSO / GRO (not every python version has the constants)
+UDP_SEGMENT = getattr(sockets, 'UDP_SEGMENT', 103)
+UDP_GRO = getattr(sockets, 'UDP_GRO', 104)
+UDP_MAX_SEGMENTS = 64
+GSO_MAX_SIZE = 65507  # the segments must fit in a single UDP datagram
+# Datagrams dropped by the kernel for the socket, given on every recv
+SO_RXQ_OVFL = getattr(sockets, 'SO_RXQ_OVFL', 40)
+# (otherwise read from the drops column of /proc/net/udp)
+PROC_NET_UDP = '/proc/net/udp'
+# Classic BPF program that picks the socket of every datagram among the
+# ones bound to the same port (Linux >= 4.5)
+SO_ATTACH_REUSEPORT_CBPF = getattr(sockets, 'SO_ATTACH_REUSEPORT_CBPF', 51)
+CMSG_SIZE = 2 * CMSG_SPACE(4)  # GRO segment size and drops
+# A whole GRO batch fits (and so does any UDP datagram)
+RECV_BUFFER_SIZE = 2**16
+MAX_RECV_BATCH = 64  # datagrams read per wakeup
+
+# Waiting with poll(2) and reading with MSG_DONTWAIT, so there are no
+# settimeout calls per datagram (settimeout is used where it is missing)
+MSG_DONTWAIT = getattr(sockets, 'MSG_DONTWAIT', None)
+POLL = hasattr(select, 'poll') and MSG_DONTWAIT is not None
+
+
+class BufferPool:
+    """
+    Pool of reusable receive buffers, so a new one is not allocated for
+    every datagram. Buffers may be taken and given back from different
+    threads.
+    """
+
+    def __init__(self, size: int,
+                 max_buffers: int = MAX_POOL_BUFFERS) -> None:
+        self.size = size
+        self.max_buffers = max_buffers
+        self.buffers = deque()
+        return
+
+    def get(self) -> bytearray:
+        try:
+            return self.buffers.pop()
+        except IndexError:
+            return bytearray(self.size)
+
+    def put(self, buffer: bytearray) -> None:
+        if len(self.buffers) < self.max_buffers:
+            self.buffers.append(buffer)
+
 
 class Socket:
 
-    def __init__(self) -> None:
+    def __init__(self, rcvbuf: int = None, sndbuf: int = None) -> None:
         """
         Inicialization of socket class.
-        Wrapper around socket(2).
+        Wrapper around socket(2) and setsockopt(2).
+
+        Parameters:
+        [rcvbuf(int)]: receive buffer size (SO_RCVBUF), in bytes.
+        [sndbuf(int)]: send buffer size (SO_SNDBUF), in bytes.
         """
 
         self.skt = socket(AF_INET, SOCK_DGRAM)
+        self._set_buffer_size(SO_RCVBUF, rcvbuf, 'net.core.rmem_max')
+        self._set_buffer_size(SO_SNDBUF, sndbuf, 'net.core.wmem_max')
+        self.gso = self._enable_gso()
+        self.gro = self._enable_gro()
+        self.rxq_ovfl = self._enable_rxq_ovfl()
+        self.drops = 0
+        # datagrams bigger than this are never sent with GSO (their size
+        # was rejected, e.g. for being bigger than the MTU of the route)
+        self.gso_limit = GSO_MAX_SIZE
+        self.poller = None
+        if POLL:
+            self.poller = select.poll()
+            self.poller.register(self.skt, select.POLLIN)
         return
 
-    def bind(self, host, port) -> None:
+    def _set_buffer_size(self, option: int, size: Optional[int],
+                         limit: str) -> None:
+        if not size:
+            return
+        self.skt.setsockopt(SOL_SOCKET, option, size)
+        # linux doubles the size (for its bookkeeping) up to the limit
+        if (current := self.skt.getsockopt(SOL_SOCKET, option)) < size:
+            logger.warning(f'Socket buffer of {size} bytes requested but '
+                           f'{current} bytes were set (see {limit}).')
+
+    def get_buffer_sizes(self) -> 'tuple[int, int]':
+        return (self.skt.getsockopt(SOL_SOCKET, SO_RCVBUF),
+                self.skt.getsockopt(SOL_SOCKET, SO_SNDBUF))
+
+    def _enable_gso(self) -> bool:
+        # the option can be read on kernels that support GSO (>= 4.18)
+        try:
+            self.skt.getsockopt(IPPROTO_UDP, UDP_SEGMENT)
+            return hasattr(self.skt, 'sendmsg')
+        except OSError:
+            return False
+
+    def _enable_gro(self) -> bool:
+        if not hasattr(self.skt, 'recvmsg_into'):
+            return False
+        try:
+            self.skt.setsockopt(IPPROTO_UDP, UDP_GRO, 1)
+            return True
+        except OSError:
+            return False
+
+    def _enable_rxq_ovfl(self) -> bool:
+        if not hasattr(self.skt, 'recvmsg_into'):
+            return False
+        try:
+            self.skt.setsockopt(SOL_SOCKET, SO_RXQ_OVFL, 1)
+            return True
+        except OSError:
+            return False
+
+    def _count_drops(self, drops: int) -> None:
+        # the kernel gives the total for the socket
+        if drops > self.drops:
+            stats['kernel-drops'] += drops - self.drops
+            self.drops = drops
+
+    def get_drops(self) -> Optional[int]:
+        """
+        Datagrams dropped by the kernel for this socket (because its
+        receive queue was full), read from /proc/net/udp.
+
+        Returns:
+        Number of datagrams dropped (None if it can not be known).
+        """
+
+        try:
+            inode = str(fstat(self.skt.fileno()).st_ino)
+            with open(PROC_NET_UDP) as f:
+                for line in f:
+                    # ... uid timeout inode ref pointer drops
+                    fields = line.split()
+                    if len(fields) > 12 and fields[9] == inode:
+                        return int(fields[12])
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def update_drops(self) -> None:
+        """
+        Updates stats['kernel-drops'] with the drops of this socket
+        (they are only received along with a datagram otherwise).
+        """
+
+        if (drops := self.get_drops()) is not None:
+            self._count_drops(drops)
+
+    def _wait(self, timeout: float, start_time: float) -> None:
+        wait_time = timeout - (now() - start_time)
+        if wait_time <= 0 or not self.poller.poll(wait_time * 1000):
+            raise SocketTimeout()
+
+    def bind(self, host, port, reuseport: bool = False) -> None:
         """
         Binds the socket to the received address and port number.
         Wrapper around bind(2) and setsockopt(2).
@@ -28,15 +184,46 @@ class Socket:
         Parameters:
         host(str): Host address.
         port(int): Port number.
+        [reuseport(bool)]: let other sockets bind the same port
+        (SO_REUSEPORT), the kernel spreads the clients among them by
+        their address.
 
         Returns:
         None.
         """
 
+        if reuseport:
+            self.skt.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
         self.skt.bind((host, port))
         self.skt.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
         return
 
+    def set_reuseport_filter(self, program: list) -> bool:
+        """
+        Sets the program that picks the socket of every datagram among
+        the ones bound to the same port: it runs on the UDP payload and
+        returns the index of the socket (in the order they were bound).
+        Datagrams it gives an index out of range to are spread by the
+        kernel as usual.
+        Wrapper around setsockopt(2) (SO_ATTACH_REUSEPORT_CBPF).
+
+        Parameters:
+        program(list): classic BPF instructions, as (code, jt, jf, k).
+
+        Returns:
+        Whether it could be set.
+        """
+
+        code = create_string_buffer(
+            b''.join(pack('=HBBI', *instruction) for instruction in program))
+        # struct sock_fprog (the kernel copies the program)
+        fprog = pack('HP', len(program), addressof(code))
+        try:
+            self.skt.setsockopt(SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF, fprog)
+            return True
+        except OSError:
+            return False
+
     def sendto(self, data: bytearray, addr: tuple) -> int:
         """
         Sends the data through the UDP socket.
@@ -54,6 +241,83 @@ class Socket:
         stats['bytes']['sent'] += sent
         return sent
 
+    def sendmsg(self, buffers: list, addr: tuple) -> int:
+        """
+        Sends a datagram made of several buffers (scatter-gather), so
+        the header and the payload do not have to be joined first.
+        Wrapper around sendmsg(2) (sendto(2) where it is missing).
+
+        Parameters:
+        buffers(list): parts of the datagram to be send.
+        addr(tuple): destination address.
+
+        Returns:
+        Number of bytes sent.
+        """
+
+        if not hasattr(self.skt, 'sendmsg'):
+            return self.sendto(b''.join(buffers), addr)
+
+        sent = self.skt.sendmsg(buffers, [], 0, addr)
+        stats['bytes']['sent'] += sent
+        return sent
+
+    def sendmmsg(self, datagrams: list, addr: tuple) -> int:
+        """
+        Sends several datagrams (each one made of several buffers) to
+        the same address. Runs of datagrams of the same size are sent
+        with a single sendmsg(2) using UDP GSO (the kernel splits them),
+        the rest (or all of them where GSO is missing) one by one.
+
+        Parameters:
+        datagrams(list): datagrams to be send, as lists of buffers.
+        addr(tuple): destination address.
+
+        Returns:
+        Number of bytes sent.
+        """
+
+        sent = 0
+        i = 0
+        while i < len(datagrams):
+            end, size = self._gso_run(datagrams, i)
+            if end - i > 1:
+                try:
+                    count = self.skt.sendmsg(
+                        [b for datagram in datagrams[i:end] for b in datagram],
+                        [(IPPROTO_UDP, UDP_SEGMENT, pack('=H', size))],
+                        0, addr)
+                    stats['bytes']['sent'] += count
+                    sent += count
+                    i = end
+                    continue
+                except OSError:
+                    # this size can not be segmented, send them one by one
+                    self.gso_limit = size - 1
+
+            sent += self.sendmsg(datagrams[i], addr)
+            i += 1
+        return sent
+
+    def _gso_run(self, datagrams: list, start: int) -> 'tuple[int, int]':
+        # datagrams that can be sent in a single GSO call: they all have
+        # the same size, except the last one that can be smaller
+        size = sum(len(b) for b in datagrams[start])
+        if not self.gso or size > self.gso_limit:
+            return start + 1, size
+
+        end = start + 1
+        total = size
+        while end < len(datagrams) and end - start < UDP_MAX_SEGMENTS:
+            length = sum(len(b) for b in datagrams[end])
+            if length > size or total + length > GSO_MAX_SIZE:
+                break
+            total += length
+            end += 1
+            if length < size:
+                break
+        return end, size
+
     def recvfrom(self, maxlen: int, timeout: float = None,
                  start_time: float = 0) -> bytearray:
         """
@@ -85,6 +349,143 @@ class Socket:
         stats['bytes']['recd'] += len(recd[0])
         return recd
 
+    def recvfrom_into(self, buffer: bytearray, timeout: float = None,
+                      start_time: float = 0) -> tuple:
+        """
+        Receives a datagram into the given buffer with timeout.
+        Wrapper around recvfrom(2).
+
+        Parameters:
+        buffer(bytearray): where the datagram is received.
+        timeout(float): time to block on recv.
+        start_time(float): start point for the timeout.
+
+        Returns:
+        View of the datagram received (in the buffer) and its address.
+        """
+
+        if timeout is None:
+            # Recv without timeout
+            size, addr = self.skt.recvfrom_into(buffer)
+        elif self.poller is not None:
+            # Recv with timeout, only waiting if nothing was received yet
+            try:
+                size, addr = self.skt.recvfrom_into(buffer, 0, MSG_DONTWAIT)
+            except BlockingIOError:
+                self._wait(timeout, start_time)
+                size, addr = self.skt.recvfrom_into(buffer)
+        else:
+            # Recv with timeout
+            try:
+                self.skt.settimeout(timeout - (now() - start_time))
+            except ValueError:
+                raise SocketTimeout()
+
+            size, addr = self.skt.recvfrom_into(buffer)
+            self.skt.settimeout(None)
+
+        stats['bytes']['recd'] += size
+        return memoryview(buffer)[:size], addr
+
+    def recvmsg_into(self, buffer: bytearray, timeout: float = None,
+                     start_time: float = 0) -> tuple:
+        """
+        Receives into the given buffer with timeout, where several
+        datagrams may arrive at once (UDP GRO). The kernel drops counter
+        comes along (SO_RXQ_OVFL).
+        Wrapper around recvmsg(2) (recvfrom(2) where both are missing).
+
+        Parameters:
+        buffer(bytearray): where the datagrams are received (it should
+        have RECV_BUFFER_SIZE bytes).
+        timeout(float): time to block on recv.
+        start_time(float): start point for the timeout.
+
+        Returns:
+        Views of the datagrams received (in the buffer) and their
+        address.
+        """
+
+        if not self.gro and not self.rxq_ovfl:
+            data, addr = self.recvfrom_into(buffer, timeout, start_time)
+            return [data], addr
+
+        if timeout is None:
+            recd = self.skt.recvmsg_into([buffer], CMSG_SIZE)
+        elif self.poller is not None:
+            try:
+                recd = self.skt.recvmsg_into(
+                    [buffer], CMSG_SIZE, MSG_DONTWAIT)
+            except BlockingIOError:
+                self._wait(timeout, start_time)
+                recd = self.skt.recvmsg_into([buffer], CMSG_SIZE)
+        else:
+            try:
+                self.skt.settimeout(timeout - (now() - start_time))
+            except ValueError:
+                raise SocketTimeout()
+
+            recd = self.skt.recvmsg_into([buffer], CMSG_SIZE)
+            self.skt.settimeout(None)
+
+        size, ancdata, _, addr = recd
+        stats['bytes']['recd'] += size
+        data = memoryview(buffer)[:size]
+        # (an empty read, e.g. once the socket is shut down, is a single
+        # empty datagram, and comes with a GRO size of 0)
+        segment = max(size, 1)
+        for level, type, value in ancdata:
+            if level == IPPROTO_UDP and type == UDP_GRO:
+                # GRO coalesces datagrams of the same size (the last one
+                # may be smaller)
+                segment = unpack('=i', value[:4])[0] or segment
+            elif level == SOL_SOCKET and type == SO_RXQ_OVFL:
+                self._count_drops(unpack('=I', value[:4])[0])
+        return [data[i:i + segment] for i in range(0, size, segment)] or\
+            [data], addr
+
+    def recvmany(self, pool: BufferPool, timeout: float = None,
+                 start_time: float = 0) -> list:
+        """
+        Receives all the datagrams already queued in the socket (up to
+        MAX_RECV_BATCH reads), blocking with timeout only for the first
+        one.
+
+        Parameters:
+        pool(BufferPool): where the buffers are taken from.
+        timeout(float): time to block on recv.
+        start_time(float): start point for the timeout.
+
+        Returns:
+        List of (datagrams, address, buffer) for every read, as given by
+        recvmsg_into. The buffers must be given back to the pool once
+        their datagrams were used.
+        """
+
+        buffer = pool.get()
+        try:
+            batch = [(*self.recvmsg_into(buffer, timeout, start_time),
+                      buffer)]
+        except BaseException:
+            pool.put(buffer)
+            raise
+
+        if self.poller is None or not batch[0][1]:
+            return batch
+
+        while len(batch) < MAX_RECV_BATCH:
+            buffer = pool.get()
+            try:
+                # the time is already out: only what is queued is read
+                batch.append((*self.recvmsg_into(buffer, 0, now()),
+                              buffer))
+            except SocketTimeout:
+                pool.put(buffer)
+                break
+            if not batch[-1][1]:
+                break
+        return batch
+
     def close(self):
         """
         Shutdowns and closes the socket, releasing resources.
@@ -97,11 +498,15 @@ class Socket:
         None.
         """
 
+        if self.skt.fileno() != -1:
+            self.update_drops()
+
         try:
+            # (it wakes up a blocked recv, but fails if not connected)
             self.skt.shutdown(SHUT_RDWR)
-            self.skt.close()
         except OSError:
-            return
+            pass
+        self.skt.close()
 
     def __del__(self):
         """
@@ -1,3 +1,4 @@
+from copy import deepcopy
 from datetime import datetime
 
 # Lib
@@ -9,17 +10,37 @@ stats = {
         "download-file": 0,
         "list-files": 0,
         "invalid": 0,
-        "total": 0
+        "total": 0,
+        # sessions whose client changed its address
+        "migrated": 0
     },
     "files": {
         "uploads": 0,
         "downloads": 0
     },
+    # threads of the session pool, the ones running a session and the
+    # sessions waiting for one (now and at most), and the refused ones
+    "sessions": {
+        "workers": 0,
+        "busy": 0,
+        "max-busy": 0,
+        "pending": 0,
+        "max-pending": 0,
+        "refused": 0
+    },
     "bytes": {
         "sent": 0,
         "recd": 0
     },
+    # datagrams dropped by the kernel before we could read them (full
+    # receive queue), unlike the ones lost in the network
+    "kernel-drops": 0,
+    # datagrams dropped because the queue of their handler was full
+    "queue-drops": 0,
+    # datagrams lost in the network but rebuilt from a FEC parity
+    "fec-recovered": 0,
     "transfer-speeds": [],
+    "cwnd": [],
     "start-time": datetime.now(),
     "runtime": 0
 }
@@ -34,7 +55,30 @@ def std(it):
     return (sum(map(lambda x: (avg - x)**2, it)) ** 0.5) / (len(it) - 1)
 
 
-def print_stats():
+def _add_stats(total: dict, other: dict) -> None:
+    for key, value in other.items():
+        if isinstance(value, dict):
+            _add_stats(total[key], value)
+        elif isinstance(value, list):
+            total[key].extend(value)
+        elif isinstance(value, datetime):
+            total[key] = min(total[key], value)
+        else:
+            total[key] += value
+
+
+def merge_stats(all_stats: list) -> dict:
+    """
+    Stats of several processes (e.g. the workers of the server) as a
+    single one: counters are added up and samples are put together.
+    """
+    merged = deepcopy(all_stats[0])
+    for other in all_stats[1:]:
+        _add_stats(merged, other)
+    return merged
+
+
+def print_stats(stats: dict = stats):
     stats["runtime"] = str(datetime.now() - stats["start-time"])
     print("\n===========================================")
     print("=                  STATS                  =")
@@ -48,11 +92,28 @@ def print_stats():
     print(f"  * list-files: {requests['list-files']}")
     print(f"  * invalid: {requests['invalid']}")
     print(f"  * total: {requests['total']}")
+    print(f"  * migrated (new client address): {requests['migrated']}")
     print()
+    sessions = stats['sessions']
+    if sessions['workers']:
+        print("> Sessions:")
+        workers = sessions['workers']
+        print(f"  * Pool utilization: {sessions['busy']}/{workers} threads "
+              f"({100 * sessions['busy'] / workers:.0f}%, max "
+              f"{100 * sessions['max-busy'] / workers:.0f}%)")
+        print(f"  * Queue depth: {sessions['pending']} "
+              f"(max {sessions['max-pending']})")
+        print(f"  * Refused (busy): {sessions['refused']}")
+        print()
     print("> Bytes transferred:")
     bytes = stats['bytes']
     print(f"  * Sent: {get_size_readable(bytes['sent'])}")
     print(f"  * Received: {get_size_readable(bytes['recd'])}")
+    print(f"  * Dropped by the kernel (receive queue full): "
+          f"{stats['kernel-drops']} datagrams")
+    print(f"  * Dropped by the server (handler queue full): "
+          f"{stats['queue-drops']} datagrams")
+    print(f"  * Rebuilt from FEC parities: {stats['fec-recovered']} datagrams")
     print()
     print("> Transfer speeds:")
     transfer_speeds = stats['transfer-speeds']
@@ -69,6 +130,20 @@ def print_stats():
     else:
         print("  * No files were transfered.")
     print()
+    print("> Congestion window (datagrams):")
+    cwnds = [cwnd for cwnd in stats['cwnd'] if cwnd['max'] > 0]
+    if len(cwnds) > 0:
+        finals = [cwnd['final'] for cwnd in cwnds]
+        exits = [cwnd['slow-start-exit'] for cwnd in cwnds
+                 if cwnd['slow-start-exit'] is not None]
+        print(f"  * final min - max: {min(finals)} - {max(finals)}")
+        print(f"  * avg - max: {mean([cwnd['mean'] for cwnd in cwnds]):.2f}"
+              f" - {max(cwnd['max'] for cwnd in cwnds)}")
+        if len(exits) > 0:
+            print(f"  * avg slow start exit: {mean(exits):.4f} s")
+    else:
+        print("  * No data was sent with a congestion window.")
+    print()
     print("> Files:")
     files = stats['files']
     print(f"  * Uploads: {files['uploads']}")
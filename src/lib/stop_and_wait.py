@@ -1,10 +1,17 @@
 from time import perf_counter as now
 
 # Lib
-from lib.rdt_interface import (ACK_TYPE, DATA_TYPE, DISCONNECT_TIMEOUTS,
-                               MAX_DISCONNECT_TIME, MAX_PAYLOAD_SIZE,
-                               MAX_LAST_TIMEOUTS, RDTInterface, RecvCallback,
-                               SendCallback, split)
+from lib.datagram_size import DatagramSizer
+from lib.rdt_interface import (ACK_TYPE, CID_SIZE, DATA_TYPE,
+                               DISCONNECT_TIMEOUTS, MAX_DISCONNECT_TIME,
+                               MAX_LAST_TIMEOUTS,
+                               RDTInterface, RecvBuffer, RecvCallback,
+                               SN_SIZE, SendCallback, TS_DATA_TYPE,
+                               TS_ECHO_OPT, TS_SIZE, TYPE_SIZE,
+                               decode_echo_rtt, decode_max_size,
+                               decode_options, encode_max_size,
+                               encode_options, split, split_timestamp,
+                               timestamp)
 from lib.logger import logger
 from lib.rtt_handler import RTTHandler
 from lib.socket_udp import SocketTimeout
@@ -28,29 +35,57 @@ class StopAndWait(RDTInterface):
     Stop and Wait protocol implementation.
     """
 
-    def __init__(self, send: SendCallback, recv: RecvCallback) -> None:
+    def __init__(self, send: SendCallback, recv: RecvCallback,
+                 sizer: DatagramSizer = None,
+                 timestamps: bool = True) -> None:
         self._send_datagram = send
         self._recv_datagram = recv
         self.sn_send = b'0'
         self.sn_recv = b'0'
+        self.output = RecvBuffer()
         self.stopped = False
         self.rtt = RTTHandler()
+        # the datagram size is negotiated: our max size goes in every ACK
+        self.sizer = sizer or DatagramSizer()
+        self.ack_options = encode_max_size(self.sizer.max_size)
+        # DATA can carry a timestamp for the peer to echo in its ACKs
+        self.timestamps = timestamps
+        self.data_type = TS_DATA_TYPE if timestamps else DATA_TYPE
+        self.header_size = CID_SIZE + TYPE_SIZE + SN_SIZE +\
+            (TS_SIZE if timestamps else 0)
         return
 
-    def send(self, data: bytearray, last=False):
+    def _ack(self, sn: bytearray, ts: bytes = None) -> bytearray:
+        # [ACK, SN, options]
+        ack = ACK_TYPE + sn + self.ack_options
+        if ts is not None:
+            ack += encode_options({TS_ECHO_OPT: ts})
+        return ack
+
+    def _send(self, header: bytearray, payload: bytearray):
+        if self.timestamps:
+            # [DATA, SN, TS, payload]
+            return self._send_datagram(header, timestamp(), payload)
+        return self._send_datagram(header, payload)
+
+    def send_steps(self, data: bytearray, last=False):
         logger.debug('[s&w:send] == START SENDING ==')
-        logger.debug(f'[s&w:send] Data to send: {data[:10]} - '
+        logger.debug(f'[s&w:send] Data to send: {bytes(data[:10])} - '
                      f'len {len(data)} -')
 
-        for i in range(0, len(data), MAX_PAYLOAD_SIZE):
-            # We divide total data in segments of max size MAX_PAYLOAD_SIZE
-            payload = data[i:(i + MAX_PAYLOAD_SIZE)]
-            datagram = DATA_TYPE + self.sn_send + payload
+        view = memoryview(data)
+        i = 0
+        while i < len(view):
+            # We divide total data in segments of the current datagram size
+            # (views of the data, the header is sent along with them)
+            size = self.sizer.get_size() - self.header_size
+            datagram = (self.data_type + self.sn_send, view[i:(i + size)])
 
             # We send the datagram
-            logger.debug(f'[s&w:send] Sending datagram ({datagram[:10]} - '
-                         f'len {len(datagram)})...')
-            self._send_datagram(datagram)
+            logger.debug(f'[s&w:send] Sending datagram '
+                         f'({bytes(datagram[1][:10])} - '
+                         f'len {len(datagram[1])})...')
+            self._send(*datagram)
             start = now()
             timeouts = 0
             datagram_ackd = False
@@ -58,14 +93,14 @@ class StopAndWait(RDTInterface):
             while not datagram_ackd:
                 try:
                     # We block receiving a datagram...
-                    datagram_recd = self._recv_datagram(
-                        self.rtt.get_timeout(), start)
-                    type, sn, _ = split(datagram_recd)
+                    datagram_recd = yield self.rtt.get_timeout(), start
+                    type, sn, options = split(datagram_recd)
                 except SocketTimeout:
+                    self.sizer.on_loss(self.header_size + len(datagram[1]))
                     timeouts += 1
                     if timeouts >= DISCONNECT_TIMEOUTS:
                         raise SocketTimeout()
-                    if last and i + MAX_PAYLOAD_SIZE >= len(data) and\
+                    if last and i + size >= len(data) and\
                             timeouts >= MAX_LAST_TIMEOUTS:
                         # MAX_LAST_TIMEOUTS reached and we are sending
                         # last piece of data, we assume data arrived
@@ -78,76 +113,84 @@ class StopAndWait(RDTInterface):
                     # Time out! We re-send the datagram
                     logger.debug(
                         '[s&w:send] Timed out. Re-sending datagram '
-                        f'{datagram[:10]} - len {len(datagram)} -')
+                        f'{bytes(datagram[1][:10])} - '
+                        f'len {len(datagram[1])} -')
                     self.rtt.timed_out()
-                    self._send_datagram(datagram)
+                    self._send(*datagram)
                     start = now()
                     continue
 
                 # Datagram has arrived
-                if type == DATA_TYPE:
+                if type != ACK_TYPE:
                     # Datagram is data type, so we re-send last sn_recv.
                     logger.debug('[s&w:send] DATA received. Re-sending'
                                  ' last ACK with sn_recv.')
-                    self._send_datagram(
-                        ACK_TYPE + _get_prev(self.sn_recv))
+                    self._send_datagram(self._ack(_get_prev(self.sn_recv)))
                     continue
 
                 # Datagram is ACK type, we check if it matches our sn_send.
                 if (datagram_ackd := (sn == self.sn_send)):
-                    self.rtt.add_sample(now() - start)
+                    options = decode_options(options)
+                    # Karn's rule: after a re-transmission only the echoed
+                    # timestamp tells which transmission was acked
+                    if (sample := decode_echo_rtt(options)) is not None:
+                        self.rtt.add_sample(sample)
+                    elif not timeouts:
+                        self.rtt.add_sample(now() - start)
+                    if (peer_max := decode_max_size(options)) is not None:
+                        self.sizer.set_peer_max(peer_max)
+                    self.sizer.on_ack(self.header_size + len(datagram[1]))
                     logger.debug(
                         f'[s&w:send] Good ACK received. (current timeout: '
                         f'{self.rtt.get_timeout()*1000} ms)')
                 else:
-                    logger.debug(f'[s&w:send] Wrong ACK received ({sn}, '
-                                 f'expected {self.sn_send}).')
+                    logger.debug(f'[s&w:send] Wrong ACK received '
+                                 f'({bytes(sn)}, expected {self.sn_send}).')
 
             self.sn_send = _get_next(self.sn_send)
+            i += size
 
         logger.debug('[s&w:send] == FINISH SENDING ==')
         return
 
-    def recv(self, length):
+    def recv_steps(self, length):
         logger.debug('[s&w:recv] == START RECEIVING ==')
         logger.debug(f'[s&w:recv] Length: {length}')
 
-        result = []
-        total_recd = 0
+        self.output.start(length)
 
-        while total_recd < length:
-            type, sn, data = split(
-                self._recv_datagram(MAX_DISCONNECT_TIME, now()))
+        while not self.output.full():
+            type, sn, data = split((yield MAX_DISCONNECT_TIME, now()))
 
             if type == ACK_TYPE:
                 logger.debug('[s&w:recv] ACK arrived, we expected DATA.')
                 continue
+            ts, data = split_timestamp(type, data)
 
             # If seq numbers dont't match we re-send the last ack
             if sn != self.sn_recv:
                 logger.debug(
-                    f'[s&w:recv] Wrong SN received ({sn}, '
+                    f'[s&w:recv] Wrong SN received ({bytes(sn)}, '
                     f'expected {self.sn_recv}). Re-sending '
                     f'last ackd SN ({self.sn_recv})...')
-                self._send_datagram(ACK_TYPE + _get_prev(self.sn_recv))
+                self._send_datagram(self._ack(_get_prev(self.sn_recv), ts))
                 continue
 
             # If seq numbers match, we keep the data and continue
             logger.debug(
-                f'[s&w:recv] Good SN received. Data received: {data[:10]} - '
-                f'len {len(data)} -')
-            result.append(data)
-            total_recd += len(data)
+                f'[s&w:recv] Good SN received. Data received: '
+                f'{bytes(data[:10])} - len {len(data)} -')
+            self.output.write(data)
 
             logger.debug(
                 f'[s&w:recv] Sending ack ({self.sn_recv})...')
-            self._send_datagram(ACK_TYPE + self.sn_recv)
+            self._send_datagram(self._ack(self.sn_recv, ts))
             self.sn_recv = _get_next(self.sn_recv)
 
-        result = b''.join(result)
+        result = self.output.get()
 
         logger.debug(f'[s&w:recv] Total data received: {result[:10]} '
-                     f'- len {len(data)} -')
+                     f'- len {len(result)} -')
         logger.debug('[s&w:recv] == FINISH RECEIVING ==')
 
         return result
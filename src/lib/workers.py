@@ -0,0 +1,130 @@
+from multiprocessing import get_context
+from signal import SIGINT, SIG_IGN, signal
+from typing import Callable
+
+# Lib
+from lib.client_handler import Session
+from lib.logger import logger
+from lib.rdt_interface import CID_OWNER_BITS, MAX_CID_OWNERS
+from lib.socket_udp import Socket
+from lib.stats import merge_stats, stats
+
+# commands of the server process to its workers
+CLIENTS_CMD = 'clients'
+STATS_CMD = 'stats'
+STOP_CMD = 'stop'
+
+# Classic BPF opcodes
+BPF_LD_W_ABS = 0x20
+BPF_ALU_AND_K = 0x54
+BPF_ALU_SUB_K = 0x14
+BPF_RET_A = 0x16
+# Every datagram goes to the worker that owns its CID (so the session is
+# found even if the client changed its address), the ones without a CID
+# (new clients) are spread by the kernel
+CID_STEERING = [
+    (BPF_LD_W_ABS, 0, 0, 0),  # A = CID
+    (BPF_ALU_AND_K, 0, 0, 2**CID_OWNER_BITS - 1),  # A = owner + 1
+    (BPF_ALU_SUB_K, 0, 0, 1),  # A = owner (NO_CID: out of range)
+    (BPF_RET_A, 0, 0, 0),
+]
+
+
+def _work(conn, index, engine, host, port, rcvbuf, sndbuf):
+    # Worker process: serves the clients the kernel gives to its socket,
+    # and answers the commands of the server process
+    signal(SIGINT, SIG_IGN)  # the server process stops the workers
+    try:
+        skt = Socket(rcvbuf, sndbuf)
+        skt.bind(host, port, reuseport=True)
+        if not skt.set_reuseport_filter(CID_STEERING) and index == 0:
+            logger.warning('[Workers] Datagrams can not be steered by '
+                           'CID: a client that changes its address may '
+                           'lose its session.')
+        receiver = engine(skt, owner=index)
+    except BaseException as e:
+        conn.send(e)
+        return
+    conn.send(None)
+
+    while True:
+        command, arg = conn.recv()
+        if command == CLIENTS_CMD:
+            conn.send(len(receiver.clients))
+        elif command == STATS_CMD:
+            conn.send(receiver.get_stats())
+        elif command == STOP_CMD:
+            receiver.stop(arg)
+            conn.send(stats)
+            return
+
+
+class Workers:
+    """
+    Server running in several processes (so it is not limited to a
+    single core by the GIL), each one with its own socket bound to the
+    same port (SO_REUSEPORT) and its own engine (Receiver or
+    EventReceiver). The kernel picks the socket of every datagram by
+    hashing its addresses, so all the datagrams of a client go to the
+    same worker. Once a session has a CID, its datagrams are sent to the
+    worker that assigned it instead (see CID_STEERING).
+
+    Same interface as the engines of a single process.
+    """
+
+    def __init__(self, count: int, engine: Callable, host: str, port: int,
+                 rcvbuf: int = None, sndbuf: int = None):
+        if count > MAX_CID_OWNERS:
+            raise ValueError(f'At most {MAX_CID_OWNERS} workers.')
+        context = get_context('fork')
+        # the ranges of an upload may be received by different workers
+        self.manager = context.Manager()
+        Session.range_uploads = self.manager.dict()
+        Session.failed_uploads = self.manager.dict()
+        Session.range_lock = context.Lock()
+
+        # (process, connection)
+        self.workers = []
+        for i in range(count):
+            conn, child_conn = context.Pipe()
+            process = context.Process(
+                target=_work, name=f'Worker:{i}',
+                args=(child_conn, i, engine, host, port, rcvbuf, sndbuf))
+            process.start()
+            # one at a time: the index of a socket for the kernel is the
+            # order it was bound in
+            if (error := conn.recv()) is not None:
+                process.join()
+                self._stop(self.workers)
+                raise error
+            self.workers.append((process, conn))
+        logger.debug(f'[Workers] {count} workers started.')
+
+    def _request(self, command: str, arg=None) -> list:
+        for _, conn in self.workers:
+            conn.send((command, arg))
+        return [conn.recv() for _, conn in self.workers]
+
+    def _stop(self, workers: list) -> list:
+        # Stops the workers (forced), returns their last stats
+        for _, conn in workers:
+            conn.send((STOP_CMD, True))
+        final = [conn.recv() for _, conn in workers]
+        for process, _ in self.workers:
+            process.join()
+        self.manager.shutdown()
+        return final
+
+    def get_stats(self) -> dict:
+        return merge_stats(self._request(STATS_CMD))
+
+    def stop(self, force=False):
+        logger.debug('[Workers] Stopping...')
+        # none of them is stopped until all of them can be: the kernel
+        # would give the clients of a closed socket to the other ones
+        if not force and sum(self._request(CLIENTS_CMD)) > 0:
+            raise RuntimeWarning("Some Handlers havent finished yet.")
+        # from now on the stats of this process are the ones of all the
+        # workers
+        stats.update(merge_stats(self._stop(self.workers)))
+        logger.debug('[Workers] Joined.')